@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import time
+import traceback
+import cv2
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ConfigHandler import ConfigHandler
+from Find_Bact import FindBacteria
+from OverviewStore import OVERVIEW_EXT, load_overview, load_info
+
+#Batch reprocessing of stored overviews. Every Scan .hdf5 file and every
+#overview directory (Z and R-Z as .csv or .npy) below the given roots is run
+#through FindBacteria.full_correction + find_bacteria in a process pool. The
+#results are streamed into one JSON lines file, one record per source with its
+#status, so an interrupted run can be continued with --resume.
+
+def find_sources(roots):
+    sources = []
+    for root in roots:
+        if os.path.isfile(root):
+            sources.append(root)
+            continue
+        for path, dirs, files in os.walk(root):
+            dirs.sort()
+            names = set(os.path.splitext(f) for f in files)
+            if any(('Z', ext) in names and ('R-Z', ext) in names for ext in OVERVIEW_EXT):
+                sources.append(path)
+            for f in sorted(files):
+                if os.path.splitext(f)[1].lower() in ['.hdf5', '.h5']:
+                    sources.append(os.path.join(path, f))
+    return sources
+
+def hdf5_to_dict(group):
+    #inverse of Scan.dict_to_hdf5 for the small Info entries
+    adict = {}
+    for key, value in group.items():
+        if isinstance(value, h5py.Group):
+            adict[key] = hdf5_to_dict(value)
+        else:
+            value = value[()]
+            if isinstance(value, bytes):
+                value = value.decode()
+            elif isinstance(value, np.ndarray):
+                if value.dtype.kind in 'SO':
+                    value = [x.decode() if isinstance(x, bytes) else x for x in value]
+                else:
+                    value = value.tolist()
+                value = value[0] if len(value) == 1 else value
+            adict[key] = value
+    return adict
+
+def load_source(source, config):
+    #returns forward, backward and the AFM and Characteristics settings, the
+    #ones of the config go over the ones stored with the source
+    if os.path.isfile(source):
+        with h5py.File(source, 'r') as hdf:
+            forward = hdf['Data/AFM/Z'][()]
+            backward = hdf['Data/AFM/R-Z'][()]
+            info = hdf5_to_dict(hdf['Info']) if 'Info' in hdf else {}
+    else:
+        channels = load_overview(source)
+        (forward, backward) = (channels['Z'], channels['R-Z'])
+        info = load_info(source)
+    afm = dict(info.get('AFM', {}))
+    characteristics = dict(info.get('Characteristics', {}))
+    if config:
+        afm.update(config['AFM'])
+        characteristics.update(config['Characteristics'])
+    return forward, backward, afm, characteristics
+
+def process(source, config):
+    start = time.time()
+    record = {'source': source}
+    try:
+        forward, backward, afm, characteristics = load_source(source, config)
+        if not afm or not characteristics:
+            raise ValueError('No AFM/Characteristics settings, use --config')
+        ratio = afm['dx'] / afm['px']
+        limit = afm['hlimit'] * 10**(-6)
+        f = FindBacteria(characteristics, ratio)
+        data = f.full_correction(forward, backward, limit)
+        bac_found = f.find_bacteria(data, limit)
+        bacteria = {}
+        if bac_found:
+            bact_dict = f.get_dict()
+            for key in bact_dict['Bacteria'].keys():
+                bacteria[key] = {}
+                for k in bact_dict['Bacteria'][key]['Points'].keys():
+                    if 'Coord' not in bact_dict['Bacteria'][key]['Points'][k]:
+                        continue
+                    (px, py) = bact_dict['Bacteria'][key]['Points'][k]['Coord']
+                    newx = ((px * ratio) - (afm['dx'] / 2)) + afm.get('x0', afm['dx'] / 2)
+                    newy = ((py * ratio) - (afm['dy'] / 2)) + afm.get('y0', afm['dy'] / 2)
+                    bacteria[key][k] = {'Pixel': [int(px), int(py)], 'Coord': [round(newx, 2), round(newy, 2)]}
+        record['status'] = 'ok' if bac_found else 'no_bacteria'
+        record['bacteria'] = bacteria
+        record['shape'] = list(forward.shape)
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+        record['traceback'] = traceback.format_exc()
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+def init_worker():
+    #one OpenCV thread per process, the pool provides the parallelism
+    cv2.setNumThreads(1)
+
+def done_sources(output):
+    done = set()
+    if os.path.exists(output):
+        with open(output) as file:
+            for line in file:
+                try:
+                    done.add(json.loads(line)['source'])
+                except (ValueError, KeyError):
+                    pass
+    return done
+
+def run_batch(roots, output, config=None, workers=None, resume=False, progress=print):
+    sources = find_sources(roots)
+    if resume:
+        done = done_sources(output)
+        sources = [s for s in sources if s not in done]
+    counts = {'ok': 0, 'no_bacteria': 0, 'error': 0}
+    start = time.time()
+    with open(output, 'a' if resume else 'w') as file:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            futures = [pool.submit(process, s, config) for s in sources]
+            for n, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                counts[record['status']] += 1
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                progress('[{}/{}] {} {} ({:.1f} files/s)'.format(n, len(sources), record['status'], record['source'],
+                                                                n / max(time.time() - start, 10**(-6))))
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-run the bacteria detection on stored overviews.')
+    parser.add_argument('roots', nargs='+', help='directories to search or single .hdf5 files')
+    parser.add_argument('--output', default='batch_results.jsonl')
+    parser.add_argument('--config', default=None, help='scan.ini with the AFM and Characteristics settings, '
+                        'needed for .csv/.npy directories without info.json, overrides the settings stored with the overviews')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--resume', action='store_true', help='skip sources already in the output file')
+    args = parser.parse_args()
+    config = ConfigHandler().read_config(args.config) if args.config else None
+    counts = run_batch(args.roots, args.output, config, args.workers, args.resume)
+    print('Done: {} ok, {} without bacteria, {} errors'.format(counts['ok'], counts['no_bacteria'], counts['error']))
+
+if __name__ == '__main__':
+    main()
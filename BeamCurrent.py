@@ -0,0 +1,55 @@
+import threading
+import numpy as np
+
+class CurrentBuffer:
+    '''
+    Ring buffer of timestamped beam current samples, filled from the PV
+    monitor (Epics_Control). For the acquisition window of a measurement it
+    gives the time series together with the mean and integral, the current
+    is taken as constant until the next sample.
+    '''
+    def __init__(self, size=2**16):
+        self.size = size
+        self.times = np.zeros(size)
+        self.values = np.zeros(size)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, t, value):
+        with self._lock:
+            i = self.count % self.size
+            self.times[i] = t
+            self.values[i] = value
+            self.count += 1
+
+    def samples(self):
+        #all samples in the buffer, oldest first
+        with self._lock:
+            if self.count <= self.size:
+                return self.times[:self.count].copy(), self.values[:self.count].copy()
+            i = self.count % self.size
+            return np.roll(self.times, -i), np.roll(self.values, -i)
+
+    def stats(self, t0, t1):
+        '''
+        Samples from t0 to t1 (starting with the value at t0), the time
+        weighted mean and the integral (current * s). None if there is no
+        sample at or before t1. Without a sample at or before t0 the
+        window starts at the first sample and Current_Partial is 1.
+        '''
+        times, values = self.samples()
+        first = np.searchsorted(times, t0, side='right') - 1
+        last = np.searchsorted(times, t1, side='right')
+        if last == 0:
+            return None
+        partial = int(first < 0)
+        first = max(first, 0)
+        times = times[first:last].copy()
+        values = values[first:last]
+        times[0] = max(times[0], t0)
+        edges = np.append(times, max(t1, times[-1]))
+        integral = float(np.sum(values * np.diff(edges)))
+        duration = edges[-1] - edges[0]
+        mean = integral / duration if duration > 0 else float(values[-1])
+        return {'Current': mean, 'Current_Integral': integral, 'Current_Partial': partial,
+                'Current_Series': {'Time': times, 'Value': values}}
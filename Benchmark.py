@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import cv2
+import h5py
+import numpy as np
+from datetime import datetime
+from Find_Bact import FindBacteria
+import OverviewStore
+from SimNeaSNOM import SimSample
+
+#Benchmark of the Find_Bact processing pipeline. Every stage is timed on its
+#own, on synthetic overviews (SimSample) of growing size and bacteria density
+#and on recorded overviews. Results are written as JSON, two result files can
+#be compared with --compare to spot regressions between versions.
+
+STAGES = ['stripe', 'tail', 'plane', 'range', 'normalize', 'bilateral', 'canny', 'contours', 'features', 'reference', 'find_bacteria']
+
+CHARACTERISTICS = {'length': [1.8, 5.], 'width': [0.5, 1.3], 'height': [0.3, 0.6], 'corona': 0.5, 'climit': 0.2,
+                   'plane_order': 1, 'plane_mask': 0, 'stripe_mode': 'diff', 'line_order': 1}
+
+def synthetic_overview(size, density, pixel=0.1, seed=0):
+    #density in bacteria per 100 um^2, the pixel size stays fixed so the
+    #bacteria keep their size in pixels while the field grows
+    field = size * pixel
+    sample = SimSample(size=field, center=(field / 2, field / 2), bacteria=max(1, int(density * field * field / 100)),
+                       drift=(0., 0.), seed=seed)
+    forward, backward = sample.afm_image(field / 2, field / 2, field, field, size, size, 0)
+    return forward, backward, pixel
+
+def load_overview(path, ratio=None):
+    #Scan output (.hdf5) or an overview directory with Z and R-Z as .csv or .npy
+    if os.path.isfile(path):
+        with h5py.File(path, 'r') as hdf:
+            forward = hdf['Data/AFM/Z'][()]
+            backward = hdf['Data/AFM/R-Z'][()]
+            if ratio is None:
+                ratio = hdf['Info/AFM/dx'][0] / hdf['Info/AFM/px'][0]
+        return forward, backward, ratio
+    channels = OverviewStore.load_overview(path)
+    if ratio is None:
+        raise ValueError('The pixel size (--ratio) is needed for {}'.format(path))
+    return channels['Z'], channels['R-Z'], ratio
+
+class StageTimer:
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.results = {}
+
+    def run(self, stage, fn, *args):
+        if self.memory:
+            snap = tracemalloc.take_snapshot()
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        out = fn(*args)
+        elapsed = time.perf_counter() - start
+        entry = self.results.setdefault(stage, {'time_s': 0.})
+        entry['time_s'] += elapsed
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1] - base
+            #blocks still allocated after the stage (results and leaks)
+            blocks = sum(s.count_diff for s in tracemalloc.take_snapshot().compare_to(snap, 'filename'))
+            entry['peak_bytes'] = max(entry.get('peak_bytes', 0), peak)
+            entry['alloc_blocks'] = entry.get('alloc_blocks', 0) + blocks
+        return out
+
+def run_pipeline(forward, backward, ratio, timer, hlimit=0.6, params=CHARACTERISTICS):
+    limit = hlimit * 10**(-6)
+    f = FindBacteria(params, ratio)
+    if f._stripe_mode == 'diff':
+        z_data = timer.run('stripe', f.stripe_correction, forward)
+        r_data = timer.run('stripe', f.stripe_correction, backward)
+    else:
+        z_data = timer.run('stripe', lambda d: f.stripe_correction(d, f.stripe_mask(d)), forward)
+        r_data = timer.run('stripe', lambda d: f.stripe_correction(d, f.stripe_mask(d)), backward)
+    data = timer.run('tail', f.tail_correction, z_data, r_data)
+    if f._plane_mask:
+        data = timer.run('plane', lambda d: f.plane_correction(d, f.bacteria_mask(f.plane_correction(d.copy()))), data)
+    else:
+        data = timer.run('plane', f.plane_correction, data)
+    data = timer.run('range', f.range_correction, data, limit)
+
+    norm = timer.run('normalize', f.normalize, data)
+    img = timer.run('bilateral', f.denoise, norm)
+    canny = timer.run('canny', f.find_edges, img)
+    contours = timer.run('contours', f.trace_contours, canny)
+    timer.run('features', f.candidate_features, contours, data)
+
+    #the reference search only runs inside find_bacteria, time it there
+    find_references = f.find_references
+    f.find_references = lambda *args: timer.run('reference', find_references, *args)
+    found = timer.run('find_bacteria', f.find_bacteria, data, limit)
+    return len(f.get_dict()['Bacteria']) if found else 0
+
+def benchmark(source, forward, backward, ratio, repeat=3, memory=True, **info):
+    #best of `repeat` for the times, one extra traced run for the memory
+    records = {}
+    for _ in range(repeat):
+        timer = StageTimer()
+        found = run_pipeline(forward.copy(), backward.copy(), ratio, timer)
+        for stage, entry in timer.results.items():
+            records[stage] = min(records.get(stage, np.inf), entry['time_s'])
+    mem = {}
+    if memory:
+        tracemalloc.start()
+        timer = StageTimer(memory=True)
+        run_pipeline(forward.copy(), backward.copy(), ratio, timer)
+        tracemalloc.stop()
+        mem = timer.results
+    results = []
+    for stage in STAGES:
+        if stage not in records:
+            continue
+        entry = {'source': source, 'shape': list(forward.shape), 'bacteria': found, 'stage': stage,
+                 'time_s': records[stage]}
+        entry.update(info)
+        if stage in mem:
+            entry['peak_bytes'] = mem[stage]['peak_bytes']
+            entry['alloc_blocks'] = mem[stage]['alloc_blocks']
+        results.append(entry)
+    return results
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ''
+    return {'datetime': datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'opencv': cv2.__version__, 'machine': platform.node(), 'cpus': os.cpu_count()}
+
+def key(entry):
+    return (entry['source'], tuple(entry['shape']), entry.get('density'), entry['stage'])
+
+def compare(old_path, new_path, tolerance=0.2):
+    with open(old_path) as file:
+        old = {key(e): e for e in json.load(file)['results']}
+    with open(new_path) as file:
+        new = json.load(file)['results']
+    regressions = 0
+    for e in new:
+        if key(e) not in old:
+            continue
+        ratio = e['time_s'] / old[key(e)]['time_s'] if old[key(e)]['time_s'] > 0 else np.inf
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  <-- slower'
+            regressions += 1
+        print('{:<24} {:>11} {:>6} {:<14} {:9.4f}s -> {:9.4f}s  x{:5.2f}{}'.format(
+            os.path.basename(e['source'])[:24], 'x'.join(str(x) for x in e['shape']), str(e.get('density', '')),
+            e['stage'], old[key(e)]['time_s'], e['time_s'], ratio, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the Find_Bact pipeline stages.')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[256, 512, 1024, 2048, 4096])
+    parser.add_argument('--densities', type=float, nargs='*', default=[1., 4.], help='bacteria per 100 um^2')
+    parser.add_argument('--recorded', nargs='*', default=[], help='Scan .hdf5 files or overview directories (.csv/.npy)')
+    parser.add_argument('--ratio', type=float, default=None, help='um per pixel for recorded overview directories')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--output', default='benchmark_{}.json'.format(datetime.now().strftime('%Y-%m-%d_%H%M')))
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.tolerance) else 0
+
+    results = []
+    for size in args.sizes:
+        for density in args.densities:
+            forward, backward, ratio = synthetic_overview(size, density)
+            print('synthetic {0}x{0}, density {1}'.format(size, density))
+            results += benchmark('synthetic', forward, backward, ratio, args.repeat, not args.no_memory, density=density)
+    for path in args.recorded:
+        forward, backward, ratio = load_overview(path, args.ratio)
+        print(path)
+        results += benchmark(os.path.abspath(path), forward, backward, ratio, args.repeat, not args.no_memory)
+
+    for e in results:
+        print('{:<10} {:>11} {:<14} {:9.4f}s {:>8} MB'.format(os.path.basename(e['source'])[:10], 'x'.join(str(x) for x in e['shape']),
+              e['stage'], e['time_s'], round(e.get('peak_bytes', 0) / 2**20, 1)))
+    with open(args.output, 'w') as file:
+        json.dump({'meta': metadata(), 'results': results}, file, indent=1)
+    print('Saved to', args.output)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,13 +1,16 @@
 import configparser as cfg
 
+CONFIG_KEYS = ['Info', 'AFM', 'Fourier', 'Channel', 'Characteristics', 'Measurement']
+
 class ConfigHandler(object):
     def __init__(self):
         self.config = cfg.ConfigParser()
         
-    def read_config(self, path, keys):
+    def read_config(self, path, keys=CONFIG_KEYS):
+        config = self.config
         config.read(path)
         flag = all(key in config.sections() for key in keys) and all(key in keys for key in config.sections())
-        if not config_flag:
+        if not flag:
             raise ValueError('Wrong or Corrupted Config')
         new_dict = {}
         for section in config.sections():
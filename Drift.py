@@ -0,0 +1,127 @@
+import cv2
+import numpy as np
+
+#Drift of the sample between repeated scans of the same area, from the FFT
+#phase correlation of the leveled height data.
+
+def prepare(data):
+    #float32 without NaNs and offset, as cv2.phaseCorrelate needs it
+    img = np.array(data, dtype=np.float32)
+    img[~np.isfinite(img)] = np.nanmedian(img) if np.isfinite(img).any() else 0
+    img -= img.mean()
+    #heights are in m, scale to unit variance
+    std = img.std()
+    return img / std if std > 0 else img
+
+def phase_shift(reference, image):
+    '''
+    Sub-pixel shift (dx, dy) of `image` against `reference` in pixels, i.e.
+    a feature at p in reference is at p + (dx, dy) in image, and the height
+    of the correlation peak (0..1) as confidence.
+    '''
+    reference = prepare(reference)
+    image = prepare(image)
+    window = cv2.createHanningWindow(reference.shape[::-1], cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(reference, image, window)
+    return (dx, dy), response
+
+class DriftTracker:
+    '''
+    Registers every scan against the one before. Together with the scan
+    positions this gives the drift of the sample since the first scan (um)
+    and, from the last two results, its speed, so the next scan can be put
+    where the sample is going to be. Registrations with a confidence below
+    min_confidence are skipped (the drift is kept from before).
+    '''
+    def __init__(self, ratio, min_confidence=0.05):
+        self.ratio = ratio
+        self.min_confidence = min_confidence
+        self.reference = None
+        self.origin = None
+        self.ref_position = None
+        self.ref_drift = None
+        #(time, position, drift, confidence) of every scan
+        self.history = []
+
+    def update(self, data, t, position):
+        #data: leveled scan, t: time of the scan, position: its (x0, y0) in um
+        position = np.asarray(position, dtype=float)
+        if self.reference is None or self.reference.shape != data.shape:
+            self.reference = data
+            self.origin = self.ref_position = position
+            self.ref_drift = np.zeros(2)
+            self.history = [(t, position, self.ref_drift, 1.)]
+            return self.ref_drift, 1.
+        (dx, dy), response = phase_shift(self.reference, data)
+        if response < self.min_confidence:
+            drift = self.history[-1][2]
+        else:
+            #what moved in the image plus what the stage was moved
+            drift = self.ref_drift + np.array((dx, dy)) * self.ratio + (position - self.ref_position)
+            self.reference = data
+            self.ref_position = position
+            self.ref_drift = drift
+        self.history.append((t, position, drift, response))
+        return drift, response
+
+    def velocity(self):
+        #um/s from the last two registered scans
+        valid = [h for h in self.history if h[3] >= self.min_confidence]
+        if len(valid) < 2 or valid[-1][0] == valid[-2][0]:
+            return np.zeros(2)
+        return (valid[-1][2] - valid[-2][2]) / (valid[-1][0] - valid[-2][0])
+
+    def next_position(self, t):
+        #(x0, y0) for a scan at time t
+        last_t, _, drift, _ = self.history[-1]
+        return tuple(self.origin + drift + self.velocity() * (t - last_t))
+
+class DriftModel:
+    '''
+    Kalman filter for the offset (um) of the sample against the overview,
+    with a constant velocity model per axis. Every refinement scan gives a
+    measured offset (update), in between the offset and its uncertainty are
+    predicted. accel is the process noise (um^2/s^3), noise the standard
+    deviation of a measured offset, offset_std and speed_std the start
+    uncertainty (um, um/s).
+
+    The defaults assume nothing about the drift speed: speed_std 0.01 um/s
+    (36 um/h) covers fast thermal drift. With the rescan threshold of 0.1 um
+    the first refinement therefore only holds for about 9 s, then the speed
+    is measured and every refinement about doubles the time to the next one
+    (about 10, 18, 34, 66 s for a steady drift) up to rescan_age.
+    '''
+    def __init__(self, accel=10**(-10), noise=0.05, offset_std=1., speed_std=0.01):
+        self.accel = accel
+        self.noise = noise
+        #state per axis (rows x, y): offset, speed; the covariance is the same for both axes
+        self.state = np.zeros((2, 2))
+        self.cov = np.diag([offset_std**2, speed_std**2])
+        self.time = None
+        self.last_update = None
+
+    def _propagate(self, t):
+        dt = 0. if self.time is None else max(0., t - self.time)
+        F = np.array([[1., dt], [0., 1.]])
+        Q = self.accel * np.array([[dt**3 / 3, dt**2 / 2], [dt**2 / 2, dt]])
+        return self.state @ F.T, F @ self.cov @ F.T + Q
+
+    def predict(self, t):
+        #offset (x, y) at time t and its standard deviation
+        state, cov = self._propagate(t)
+        return state[:, 0].copy(), np.sqrt(cov[0, 0])
+
+    def update(self, t, offset):
+        state, cov = self._propagate(t)
+        gain = cov[:, 0] / (cov[0, 0] + self.noise**2)
+        state = state + np.outer(np.asarray(offset, dtype=float) - state[:, 0], gain)
+        self.cov = cov - np.outer(gain, cov[0, :])
+        self.state = state
+        self.time = t
+        self.last_update = t
+
+    def needs_rescan(self, t, threshold, max_age):
+        #rescan if the predicted offset is too uncertain or the last one is too old
+        if self.last_update is None or t - self.last_update > max_age:
+            return True
+        return self.predict(t)[1] > threshold
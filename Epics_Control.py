@@ -1,45 +1,146 @@
 import epics
-import time  
+import queue
+import threading
+import time
+from BeamCurrent import CurrentBuffer
+
+#Beam monitoring for the measurement. The pyepics callbacks only put the new
+#values into a queue, a state machine on its own thread works through them and
+#tells the observers (callback(message, data)) when to stop and restart:
+#
+#  RUNNING   -- machine state leaves IDLE -->                  INJECTION  ('epics_stop')
+#  RUNNING   -- current jumps by more than limit for debounce s --> BEAM_ERROR ('epics_error', (old, new))
+#  INJECTION -- machine state back to IDLE -->                 SETTLING
+#  SETTLING  -- settle s later -->                             RUNNING    ('epics_restart')
+#  BEAM_ERROR -- current back within limit * hysteresis for debounce s --> RUNNING ('epics_restart')
+#
+#Every current value also goes with the time it arrived into self.current, a
+#ring buffer the measurement takes the current of each Fourier point from.
+#
+#A state PV that can not be read at startup (caget gives None) counts as an
+#injection: the monitor starts paused in INJECTION and only runs after the PV
+#reports IDLE and the settle time is over. Until then the Scheduler of the job
+#queue does not start a job (Scheduler.wait_for_beam).
+
+STATE_PV = 'MLSOPCCP:curState'
+CURRENT_PV = 'CUM1ZK3RP:rdCur'
 
 class Epics_Control:
-    def __init__(self):
+    def __init__(self, limit=0.2, hysteresis=0.5, debounce=1., settle=60.):
         self.observer = []
-        self.limit = 0.2
-        self.paused = False
-        self.writing = False
-        self.cur_state = epics.caget('MLSOPCCP:curState')
-        state = epics.PV('MLSOPCCP:curState')
-        state.add_callback(self.on_change)
-        self.cur_value = epics.caget('CUM1ZK3RP:rdCur')
-        current = epics.PV('CUM1ZK3RP:rdCur')
-        current.add_callback(self.on_change)
-        
+        self.limit = limit
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.settle = settle
+        self.events = queue.Queue()
+        self.cur_state = epics.caget(STATE_PV)
+        self.cur_value = epics.caget(CURRENT_PV)
+        self.current = CurrentBuffer()
+        if self.cur_value is not None:
+            self.current.add(time.time(), self.cur_value)
+        #also INJECTION if the state PV is not reachable (None)
+        self.state = 'RUNNING' if self.cur_state == 'IDLE' else 'INJECTION'
+        self.paused = self.state != 'RUNNING'
+        #time since the current is out of (or back in) its band, settle deadline
+        self.since = None
+        self.deadline = None
+        self._thread = threading.Thread(target=self.run, name='epics_control', daemon=True)
+        self._thread.start()
+        self._pvs = [epics.PV(STATE_PV), epics.PV(CURRENT_PV)]
+        for pv in self._pvs:
+            pv.add_callback(self.on_change)
+
     def bind_to(self, callback):
         self.observer.append(callback)
-        
+
     def on_change(self, pvname=None, value=None, char_value=None, **kws):
-        if pvname == 'MLSOPCCP:curState':
-            if self.cur_state == value:
+        #pyepics callback thread: only hand the value over
+        if pvname == CURRENT_PV and value is not None:
+            #host time, the points are timed with the same clock (not the IOC's)
+            self.current.add(time.time(), value)
+        self.events.put((pvname, value, time.monotonic()))
+
+    def stop(self):
+        for pv in self._pvs:
+            pv.clear_callbacks()
+        self.events.put(None)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def run(self):
+        while True:
+            timeout = None if self.deadline is None else max(0., self.deadline - time.monotonic())
+            try:
+                event = self.events.get(timeout=timeout)
+            except queue.Empty:
+                self.on_timer(time.monotonic())
+                continue
+            if event is None:
                 return
-            if self.cur_state == 'IDLE':
-                self.paused = True
-                self.send_message('epics_stop')
-            elif value == 'IDLE':
-                time.sleep(60)
-                self.send_message('epics_restart')
-                self.paused = False
-            self.cur_state = value
-        elif pvname == 'CUM1ZK3RP:rdCur':
+            pvname, value, t = event
+            if pvname == STATE_PV:
+                self.on_state(value, t)
+            elif pvname == CURRENT_PV:
+                self.on_current(value, t)
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                self.on_timer(time.monotonic())
+
+    def on_state(self, value, t):
+        if value == self.cur_state:
+            return
+        self.cur_state = value
+        if value != 'IDLE':
             if not self.paused:
-                if abs(value) > abs(self.cur_value * (1+self.limit)) or abs(value) < abs(self.cur_value * (1-self.limit)):
-                    self.paused = True
-                    self.send_message(('epics_error', (cur_value, value)))
+                self.send_message('epics_stop')
+            self.set_state('INJECTION')
+        elif self.state == 'INJECTION':
+            #the beam needs some time after the injection
+            self.set_state('SETTLING')
+            self.deadline = t + self.settle
+
+    def on_timer(self, t):
+        self.deadline = None
+        if self.state == 'SETTLING':
+            self.set_state('RUNNING')
+            self.send_message('epics_restart')
+
+    def on_current(self, value, t):
+        if self.state == 'RUNNING':
+            if self.deviation(value) > self.limit:
+                #debounced, a single outlier does not stop the measurement
+                self.since = t if self.since is None else self.since
+                if t - self.since >= self.debounce:
+                    self.set_state('BEAM_ERROR')
+                    self.send_message('epics_error', (self.cur_value, value))
+                    return
+            else:
+                self.since = None
+                self.cur_value = value
+        elif self.state == 'BEAM_ERROR':
+            if self.deviation(value) <= self.limit * self.hysteresis:
+                self.since = t if self.since is None else self.since
+                if t - self.since >= self.debounce:
+                    self.set_state('RUNNING')
+                    self.cur_value = value
+                    self.send_message('epics_restart')
+            else:
+                self.since = None
+        else:
+            #reference for the time after the injection
             self.cur_value = value
-    
-    def send_message(self, text):
-        while self.writing:
-            time.sleep(0.01)
-        self.writing = True
+
+    def deviation(self, value):
+        if not self.cur_value:
+            return 0.
+        return abs(abs(value) - abs(self.cur_value)) / abs(self.cur_value)
+
+    def set_state(self, state):
+        self.state = state
+        self.paused = state != 'RUNNING'
+        self.since = None
+        if state != 'SETTLING':
+            self.deadline = None
+
+    def send_message(self, message, data=None):
         for callback in self.observer:
-            callback(text)
-        self.writing = False
+            callback(message, data)
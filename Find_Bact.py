@@ -1,10 +1,15 @@
 import cv2
 import numpy as np
 import copy
+from Leveling import fit_background, level_lines
 
 class FindBacteria:
     
-    def __init__(self, bac_params, ratio):
+    #per contour statistics, lengths in um, area in um^2, heights like data
+    FEATURE_DTYPE = np.dtype([('length', 'f8'), ('width', 'f8'), ('angle', 'f8'), ('area', 'f8'),
+                              ('h_max', 'f8'), ('h_mean', 'f8')])
+    
+    def __init__(self, bac_params, ratio, ref_candidates=5):
         self._dict = {}
         #Parameter to define a bacteria, usually as tuple of (min, max)
         self._length = bac_params['length']#tuple
@@ -12,6 +17,11 @@ class FindBacteria:
         self._height = bac_params['height']#tuple
         self._corona = int(bac_params['corona'] / ratio)#single value
         self._limit = bac_params['climit']#single value
+        self._plane_order = int(bac_params.get('plane_order', 1))#order of the background polynomial
+        self._plane_mask = bool(bac_params.get('plane_mask', 0))#exclude bacteria from the background fit
+        self._stripe_mode = bac_params.get('stripe_mode', 'diff')#line leveling: diff, poly or median
+        self._line_order = int(bac_params.get('line_order', 1))#order of the per line polynomial
+        self._ref_candidates = ref_candidates#number of ranked reference points kept
         self._ratio = ratio
         
     def __enter__(self):
@@ -31,27 +41,29 @@ class FindBacteria:
         edged = cv2.Canny(image, lower, upper)
         return edged
     
-    def plane_correction(self, raw):
-        null_val = np.average(raw)
+    def plane_correction(self, raw, mask=None):
+        null_val = np.nanmean(raw)
         raw[np.isnan(raw)] = null_val
-        m = raw.shape
-        X1, X2 = np.mgrid[:m[0], :m[1]]
-        X = np.hstack((np.reshape(X1, (m[0]*m[1], 1)), np.reshape(X2, (m[0]*m[1], 1))))
-        X = np.hstack((np.ones((m[0]*m[1], 1)), X))
-        YY = np.reshape(raw, (m[0]*m[1], 1))
-        theta = np.dot(np.dot(np.linalg.pinv(np.dot(X.transpose(), X)), X.transpose()), YY)
-        plane = np.reshape(np.dot(X, theta), m)
+        plane = fit_background(raw, self._plane_order, mask)
         return (raw - plane)
     
+    def bacteria_mask(self, data):
+        #everything clearly above the substrate level is treated as bacteria
+        return data > np.nanmedian(data) + self._height[0] * 10**(-6) / 2
+    
     def tail_correction(self, forward, backward):
         shape = forward.shape
         comb_data = np.array([np.ndarray.flatten(forward), np.ndarray.flatten(backward)])
         return np.reshape(np.nanmin(comb_data, axis=0), shape)
     
-    def stripe_correction(self, data):
-        for x in range(len(data)):
-            data[x] = data[x] - np.median(data[x] - data[x-1])
-        return data
+    def stripe_correction(self, data, mask=None):
+        return level_lines(data, self._stripe_mode, self._line_order, mask)
+    
+    def stripe_mask(self, data):
+        #rough leveling just to locate the bacteria for the masked line modes
+        leveled = level_lines(data, 'diff')
+        leveled = leveled - fit_background(leveled, 1)
+        return self.bacteria_mask(leveled)
             
     def range_correction(self, data, limit):
         data = data - np.nanmin(data)
@@ -59,44 +71,163 @@ class FindBacteria:
         return data
     
     def full_correction(self, forward, backward, limit):
-        z_data = self.stripe_correction(forward)
-        r_data = self.stripe_correction(backward)
+        if self._stripe_mode == 'diff':
+            z_data = self.stripe_correction(forward)
+            r_data = self.stripe_correction(backward)
+        else:
+            z_data = self.stripe_correction(forward, self.stripe_mask(forward))
+            r_data = self.stripe_correction(backward, self.stripe_mask(backward))
         data = self.tail_correction(z_data, r_data)
-        data = self.plane_correction(data)
+        if self._plane_mask:
+            leveled = self.plane_correction(data.copy())
+            data = self.plane_correction(data, self.bacteria_mask(leveled))
+        else:
+            data = self.plane_correction(data)
         data = self.range_correction(data, limit)
         return data
     
-    def find_all_contours(self, data):
+    def normalize(self, data):
         self.norm = cv2.normalize(data,None,0,255,cv2.NORM_MINMAX , cv2.CV_8U)
-        img = cv2.bilateralFilter(self.norm.copy(),10,50,50, cv2.BORDER_WRAP)
+        return self.norm
+    
+    def denoise(self, norm):
+        return cv2.bilateralFilter(norm.copy(),10,50,50, cv2.BORDER_WRAP)
+    
+    def find_edges(self, img):
         _,thresh = cv2.threshold(img,100,255,cv2.THRESH_BINARY)
-        canny = self.auto_canny(thresh)
+        return self.auto_canny(thresh)
+    
+    def trace_contours(self, canny):
         contours, _ = cv2.findContours(canny, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-        contours = [cv2.convexHull(x) for x in contours]
+        return [cv2.convexHull(x) for x in contours]
+    
+    def find_all_contours(self, data):
+        #split in stages so they can be timed on their own (Benchmark.py)
+        img = self.denoise(self.normalize(data))
+        contours = self.trace_contours(self.find_edges(img))
         self._dict['Contours_IMG'] = cv2.drawContours(self.norm.copy(), contours, -1, 255, 2)
         return contours
     
     def get_center(self, contours):
-        cont = contours.sort(key=cv2.contourArea, reverse=True)
+        #centroid of the largest contour
+        cont = max(contours, key=cv2.contourArea)
         M = cv2.moments(cont)
-        return (int(M['m10']/M['m00']), int(M['m01']/M['m00']))
+        return (M['m10']/M['m00'], M['m01']/M['m00'])
+    
+    def candidate_features(self, contours, data):
+        #One label image for all contours and per label statistics. Where
+        #hulls overlap the label image gives the shared pixels to one of
+        #them, so candidates whose bounding boxes overlap get their own mask.
+        features = np.zeros(len(contours), dtype=self.FEATURE_DTYPE)
+        if len(contours) == 0:
+            return features
+        for i, c in enumerate(contours):
+            (_,_),size,angle = cv2.minAreaRect(c)
+            angle = 90 + angle if size[1] > size[0] else 180 + angle
+            features['angle'][i] = np.deg2rad(angle)
+            features['width'][i] = min(size) * self._ratio
+            features['length'][i] = max(size) * self._ratio
+        
+        labels = np.zeros(data.shape, np.int32)
+        for i in sorted(range(len(contours)), key=lambda i: cv2.contourArea(contours[i]), reverse=True):
+            cv2.drawContours(labels, [contours[i]], 0, i + 1, -1)
+        lab = labels.ravel()
+        inside = lab > 0
+        lab = lab[inside] - 1
+        values = data.ravel()[inside]
+        finite = np.isfinite(values)
+        
+        features['area'] = np.bincount(lab, minlength=len(contours)) * self._ratio * self._ratio
+        h_max = np.full(len(contours), -np.inf)
+        np.maximum.at(h_max, lab[finite], values[finite])
+        count = np.bincount(lab[finite], minlength=len(contours))
+        total = np.bincount(lab[finite], weights=values[finite], minlength=len(contours))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            features['h_mean'] = total / count
+        features['h_max'] = np.where(count > 0, h_max, np.nan)
+        
+        rects = np.array([cv2.boundingRect(c) for c in contours])
+        (x0, y0) = (rects[:, 0], rects[:, 1])
+        (x1, y1) = (x0 + rects[:, 2], y0 + rects[:, 3])
+        overlap = ((x0[:, None] < x1[None, :]) & (x0[None, :] < x1[:, None]) &
+                   (y0[:, None] < y1[None, :]) & (y0[None, :] < y1[:, None]))
+        np.fill_diagonal(overlap, False)
+        for i in np.flatnonzero(overlap.any(axis=1)):
+            (x, y, w, h) = rects[i]
+            mask = np.zeros((h, w), np.uint8)
+            cv2.drawContours(mask, [contours[i]], 0, 1, -1, offset=(-int(x), -int(y)))
+            values = data[y:y + h, x:x + w][mask == 1]
+            values = values[np.isfinite(values)]
+            features['area'][i] = np.count_nonzero(mask) * self._ratio * self._ratio
+            features['h_max'][i] = values.max() if len(values) else np.nan
+            features['h_mean'][i] = values.mean() if len(values) else np.nan
+        return features
+    
+    def polygon_distance(self, contour, points):
+        #cv2.pointPolygonTest(contour, p, True) for many points at once:
+        #distance to the closest edge, positive inside (even-odd rule)
+        poly = contour.reshape(-1, 2).astype(np.float64)
+        a = poly[:, None, :]
+        b = np.roll(poly, -1, axis=0)[:, None, :]
+        p = np.asarray(points, np.float64)[None, :, :]
+        ab = b - a
+        length = np.maximum((ab * ab).sum(axis=2), 10**(-12))
+        t = np.clip(((p - a) * ab).sum(axis=2) / length, 0, 1)
+        nearest = a + t[:, :, None] * ab
+        dist = np.sqrt(((p - nearest)**2).sum(axis=2).min(axis=0))
+        px, py = p[0, :, 0], p[0, :, 1]
+        x1, y1, x2, y2 = a[:, :, 0], a[:, :, 1], b[:, :, 0], b[:, :, 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cross = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+        inside = cross.sum(axis=0) % 2 == 1
+        return np.where(inside, dist, -dist)
+    
+    def find_references(self, data_sqr, contour, offset, top):
+        #A pixel is a valid reference if every pixel of the window within the
+        #corona radius is below climit * top, i.e. the nearest pixel above
+        #the limit is further away than the corona. The distance transform
+        #treats the outside of the window as valid, like the clipped disk.
+        ref_mask = (data_sqr < self._limit * top).astype(np.uint8)
+        if ref_mask.size == 0:
+            return np.empty((0, 2), int)
+        dist = cv2.distanceTransform(ref_mask, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+        dist = np.minimum(dist, data_sqr.shape[0] + data_sqr.shape[1])
+        rows, cols = np.where(np.rint(dist.astype(np.float64)**2) > self._corona * self._corona)
+        references = np.column_stack((cols + offset[0], rows + offset[1]))
+        if len(references) == 0:
+            return references
+        if len(references) > self._ref_candidates:
+            references = references[self.shortlist(contour, references, self._ref_candidates)]
+        #closest to (or inside) the bacteria first
+        rank = np.concatenate([self.polygon_distance(contour, chunk) for chunk in np.array_split(references, len(references) // 4096 + 1)])
+        order = np.argsort(-rank, kind='stable')[:self._ref_candidates]
+        return references[order]
+    
+    def shortlist(self, contour, points, count, margin=3):
+        #The raster distance to the filled contour is within ~1 px of the
+        #exact one, so only points up to `margin` px behind the count-th
+        #closest can make it into the exact ranking. The canvas covers the
+        #contour and the points, so nothing of the contour is clipped.
+        bx, by, bw, bh = cv2.boundingRect(contour)
+        ox = min(bx, points[:, 0].min())
+        oy = min(by, points[:, 1].min())
+        w = max(bx + bw, points[:, 0].max() + 1) - ox
+        h = max(by + bh, points[:, 1].max() + 1) - oy
+        canvas = np.full((h, w), 255, np.uint8)
+        cv2.drawContours(canvas, [contour - np.array([ox, oy], contour.dtype)], 0, 0, -1)
+        approx = cv2.distanceTransform(canvas, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)[points[:, 1] - oy, points[:, 0] - ox]
+        cut = np.partition(approx, count - 1)[count - 1] + margin
+        return np.flatnonzero(approx <= cut)
     
     def find_bacteria(self, data, top):
         contours = self.find_all_contours(data)
-        bacteria = []
+        features = self.candidate_features(contours, data)
+        self._dict['Features'] = features
         
-        for c in contours:
-            (_,_),size,angle = cv2.minAreaRect(c)
-            angle = 90 + angle if size[1] > size[0] else 180 + angle
-            angle = np.deg2rad(angle)
-            width = min(size) * self._ratio
-            length = max(size) * self._ratio
-            if self._width[0] <= width <= self._width[1] and self._length[0] <= length <= self._length[1]:
-                mask = np.zeros(data.shape, np.uint8)
-                cv2.drawContours(mask, [c], 0, 1, -1)
-                h_upper = np.nanmax(data[np.where(mask==1)])
-                if self._height[0] * 10**(-6) <= h_upper <= self._height[1] * 10**(-6):
-                    bacteria.append( (c, angle) )
+        size_ok = ((self._width[0] <= features['width']) & (features['width'] <= self._width[1]) &
+                   (self._length[0] <= features['length']) & (features['length'] <= self._length[1]))
+        height_ok = ((self._height[0] * 10**(-6) <= features['h_max']) & (features['h_max'] <= self._height[1] * 10**(-6)))
+        bacteria = [(contours[i], features['angle'][i]) for i in np.flatnonzero(size_ok & height_ok)]
                     
         self._dict['Bacteria_IMG'] = cv2.drawContours(self.norm.copy(), [x[0] for x in bacteria], -1, 255, 2)
         if len(bacteria) > 0:
@@ -144,19 +275,10 @@ class FindBacteria:
                 x2 = box_x + width - self._corona
                 y1 = box_y + self._corona
                 y2 = box_y + height - self._corona
-                data_sqr = data.copy()[y1:y2, x1:x2]
-                ref_mask = np.zeros(data_sqr.shape)
-                references = []
-                (mask_x, mask_y) = np.where(data_sqr < self._limit * top)
-                ref_mask[(mask_x, mask_y)] = 1
-                for x,y in zip(mask_x, mask_y):
-                    YY, XX = np.ogrid[-x : data_sqr.shape[0]-x, -y : data_sqr.shape[1]-y]
-                    mask = XX * XX + YY * YY <= self._corona * self._corona
-                    if all(ref_mask[mask]):
-                        references.append((y + x1, x + y1))
+                references = self.find_references(data[y1:y2, x1:x2], bact[0], (x1, y1), top)
                 if len(references) > 0:
-                    references.sort(key=lambda x: cv2.pointPolygonTest(bact[0], (x[0], x[1]), True), reverse=True)
-                    self._dict['Bacteria'][bact_name]['Points']['Reference']['Coord'] = references[0]
+                    self._dict['Bacteria'][bact_name]['Reference_Candidates'] = references
+                    self._dict['Bacteria'][bact_name]['Points']['Reference']['Coord'] = (int(references[0][0]), int(references[0][1]))
                     data_sqr_img = cv2.normalize(self.norm.copy(),None,0,255,cv2.NORM_MINMAX , cv2.CV_8U)
                     for key in self._dict['Bacteria'][bact_name]['Points'].keys():
                         cv2.circle(data_sqr_img, self._dict['Bacteria'][bact_name]['Points'][key]['Coord'], 3, 255, -1)
@@ -0,0 +1,71 @@
+import threading
+import h5py
+import numpy as np
+
+def dict_to_hdf5(group, adict):
+    #Nested dicts become groups, everything else datasets. Existing groups
+    #are merged and existing datasets replaced, so parts of a measurement can
+    #be written again (e.g. a repeated refinement scan) without touching the
+    #rest of the file.
+    for key, value in adict.items():
+        if isinstance(value, dict):
+            next_group = group.require_group(key)
+            dict_to_hdf5(next_group, value)
+        else:
+            if key in group:
+                del group[key]
+            try:
+                group.create_dataset(key, data=np.atleast_1d(value))
+            except TypeError:
+                #special type for strings
+                group.create_dataset(key, data=np.array(value, dtype=h5py.special_dtype(vlen=bytes)))
+
+class HDF5Stream:
+    '''
+    HDF5 file that is written while the measurement runs. Every overview,
+    refinement scan and Fourier point is written (and flushed) as soon as it
+    is there, so it does not have to be kept in memory and is not lost if the
+    program dies.
+    '''
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = h5py.File(path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def write(self, name, value, flush=True):
+        #name is the path of the group/dataset, e.g. 'Data/Bacteria/Bacteria1/AFM'
+        with self._lock:
+            parent, _, key = name.rstrip('/').rpartition('/')
+            group = self._file.require_group(parent) if parent else self._file
+            dict_to_hdf5(group, {key: value})
+            if flush:
+                self._file.flush()
+
+    def read(self, name):
+        with self._lock:
+            return self._file[name][()]
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._file
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
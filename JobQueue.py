@@ -0,0 +1,272 @@
+import argparse
+import copy
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from ConfigHandler import ConfigHandler
+from Journal import Journal, journal_path
+from Scan import Scan
+from RunScan import Reporter, make_backend, start_epics, summary
+
+#Job queue for a beamtime: every job is a snapshot of scan.ini, optionally
+#with its own scan region, and a priority. The scheduler runs the jobs one
+#after the other through Scan.full_scan within a wall clock budget. The queue
+#is a JSON file that is replaced atomically after every change, so it
+#survives a crash or restart; a job that was running then is continued from
+#its journal first.
+#
+#  python JobQueue.py add --config scan.ini --x0 40 --y0 60 --priority 2 --estimate 2h
+#  python JobQueue.py list
+#  python JobQueue.py run --budget 8h
+
+REGION_KEYS = ['x0', 'y0', 'dx', 'dy', 'px', 'py']
+#measurement points assumed for a job without an estimate
+DEFAULT_POINTS = 20
+#settings that decide how long a job takes, jobs that agree in these are comparable
+SHAPE_KEYS = {'AFM': ['dx', 'dy', 'px', 'py', 't_int'], 'Fourier': ['resolution', 'averaging', 't_int_f']}
+
+def default_estimate(config):
+    #overview (trace and retrace) plus DEFAULT_POINTS Fourier points, from
+    #the dwell times (ms); refinement scans and moves are not included
+    afm = config['AFM']
+    fourier = config['Fourier']
+    overview = 2 * afm['px'] * afm['py'] * afm['t_int'] / 1000
+    point = fourier['resolution'] * fourier['averaging'] * fourier['t_int_f'] / 1000
+    return overview + DEFAULT_POINTS * point
+
+def job_shape(config):
+    return tuple(config[section][key] for section, keys in sorted(SHAPE_KEYS.items()) for key in keys)
+
+def parse_duration(text):
+    #seconds from '90', '90s', '30m' or '8h'
+    text = str(text).strip().lower()
+    factor = {'s': 1, 'm': 60, 'h': 3600}.get(text[-1:], None)
+    if factor is None:
+        return float(text)
+    return float(text[:-1]) * factor
+
+class JobQueue:
+    def __init__(self, path='jobs.json'):
+        self.path = path
+        self.jobs = []
+        self.next_id = 1
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as file:
+            state = json.load(file)
+        self.jobs = state['jobs']
+        self.next_id = state['next_id']
+
+    def save(self):
+        #written next to the old file and moved over it, a crash leaves one of the two
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump({'next_id': self.next_id, 'jobs': self.jobs}, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path)
+
+    def add(self, config, region=None, priority=0, name='', estimate=None):
+        config = copy.deepcopy(config)
+        for key, value in (region or {}).items():
+            config['AFM'][key] = value
+        config['Measurement']['iterations'] = 1
+        job = {'id': self.next_id, 'name': name or 'Job{}'.format(self.next_id), 'priority': priority,
+               'estimate': estimate, 'config': config, 'status': 'queued', 'added': time.time(),
+               'started': None, 'finished': None, 'journal': None, 'hdf5': None, 'error': None}
+        self.next_id += 1
+        self.jobs.append(job)
+        self.save()
+        return job
+
+    def get(self, job_id):
+        for job in self.jobs:
+            if job['id'] == job_id:
+                return job
+        raise KeyError('No job {}'.format(job_id))
+
+    def remove(self, job_id):
+        self.jobs.remove(self.get(job_id))
+        self.save()
+
+    def update(self, job, **values):
+        job.update(values)
+        self.save()
+
+    def estimate(self, job):
+        #given estimate, else the longest finished job of the same shape or
+        #the default from the dwell times
+        if job['estimate'] is not None:
+            return job['estimate']
+        shape = job_shape(job['config'])
+        durations = [j['finished'] - j['started'] for j in self.jobs
+                     if j['status'] == 'done' and job_shape(j['config']) == shape]
+        if durations:
+            return max(durations)
+        return default_estimate(job['config'])
+
+    def pending(self):
+        #interrupted jobs first, then by priority (high first) and age
+        jobs = [j for j in self.jobs if j['status'] in ('queued', 'running', 'interrupted')]
+        return sorted(jobs, key=lambda j: (j['status'] == 'queued', -j['priority'], j['added']))
+
+    def next_job(self, remaining):
+        #the first pending job that fits into the remaining budget (s)
+        for job in self.pending():
+            if self.estimate(job) <= remaining:
+                return job
+        return None
+
+class Scheduler:
+    '''
+    Runs the jobs of a JobQueue until the queue is empty or the budget (s)
+    is used up. A job still running at the end of the budget is stopped and
+    continued from its journal on the next run. While EPICS reports an
+    injection or beam error no job is started; a job that does not fit into
+    what is left of the budget after waiting is passed over for a smaller
+    one, the ones that can not run at all are marked skipped at the end.
+    '''
+    def __init__(self, queue, budget, backend=None, epics=True):
+        self.queue = queue
+        self.budget = budget
+        self.backend = backend
+        self.reporter = Reporter()
+        self.epics_ctrl = start_epics(self.reporter) if epics and backend is None else None
+        self.start = None
+
+    def remaining(self):
+        return self.budget - (time.time() - self.start)
+
+    def wait_for_beam(self):
+        #False if the budget ran out while waiting; also waits while the state
+        #PV could not be read at the start (INJECTION until it reports IDLE)
+        if self.epics_ctrl is None or not self.epics_ctrl.paused:
+            return True
+        print('Waiting for the beam ({})'.format(self.epics_ctrl.state))
+        while self.epics_ctrl.paused:
+            if self.remaining() <= 0:
+                return False
+            time.sleep(1)
+        return True
+
+    def run(self):
+        self.start = time.time()
+        try:
+            while self.remaining() > 0:
+                if not self.wait_for_beam():
+                    break
+                job = self.queue.next_job(self.remaining())
+                if job is None:
+                    break
+                self.run_job(job)
+        finally:
+            if self.epics_ctrl is not None:
+                self.epics_ctrl.stop()
+        for job in self.queue.pending():
+            if job['status'] == 'queued' and self.queue.estimate(job) > self.budget:
+                #can not be done in a budget like this one
+                self.queue.update(job, status='skipped', error='estimate {:.0f} s > budget'.format(self.queue.estimate(job)))
+        left = self.queue.pending()
+        print('Scheduler: {:.0f} s used, {} jobs left'.format(time.time() - self.start, len(left)))
+        return left
+
+    def run_job(self, job):
+        config = job['config']
+        #continued if it got as far as the detection, else started again
+        resume = (job['status'] != 'queued' and job['journal'] and os.path.exists(job['journal'])
+                  and Journal.load(job['journal'])['bacteria'])
+        print('{} {} (priority {}, estimate {:.0f} s, {:.0f} s left)'.format(
+            'Resuming' if resume else 'Starting', job['name'], job['priority'], self.queue.estimate(job), self.remaining()))
+        start = time.time()
+        if not resume:
+            self.queue.update(job, status='running', started=start)
+        else:
+            self.queue.update(job, status='running')
+        deadline = None
+        try:
+            with Scan(copy.deepcopy(config), backend=self.backend) as scan:
+                deadline = threading.Timer(max(0., self.remaining()), scan.abort)
+                deadline.daemon = True
+                deadline.start()
+                self.reporter.attach(scan)
+                #the journal is known as soon as the file names are set up
+                scan.bind_to('log', lambda log: self.queue.update(job, journal=journal_path(log), hdf5=scan.hdf5_path))
+                if self.epics_ctrl is not None:
+                    scan.set_current_buffer(self.epics_ctrl.current)
+                if resume:
+                    scan.resume_scan(job['journal'])
+                else:
+                    scan.full_scan(1)
+        except KeyboardInterrupt:
+            self.queue.update(job, status='interrupted')
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            self.queue.update(job, status='failed', finished=time.time(), error='{}: {}'.format(type(e).__name__, e))
+            return
+        finally:
+            if deadline is not None:
+                deadline.cancel()
+        if scan.aborted:
+            print('Budget used up, {} is continued on the next run'.format(job['name']))
+            self.queue.update(job, status='interrupted')
+            return
+        self.queue.update(job, status='done', finished=time.time())
+        print(summary(job['hdf5'] or scan.hdf5_path, time.time() - start))
+
+def main():
+    parser = argparse.ArgumentParser(description='Job queue for unattended measurements.')
+    parser.add_argument('--queue', default='jobs.json', help='state file of the queue')
+    sub = parser.add_subparsers(dest='command', required=True)
+    add = sub.add_parser('add', help='add a job with the settings of scan.ini')
+    add.add_argument('--config', default=os.path.join(os.getcwd(), 'scan.ini'))
+    add.add_argument('--name', default='')
+    add.add_argument('--priority', type=int, default=0, help='higher runs first')
+    add.add_argument('--estimate', default=None, help='expected duration, e.g. 5400, 90m or 1.5h; default from finished '
+                     'jobs with the same scan settings, else from the dwell times with {} points'.format(DEFAULT_POINTS))
+    for key in REGION_KEYS:
+        add.add_argument('--' + key, type=float, default=None, help='scan region, default from scan.ini')
+    sub.add_parser('list', help='show the jobs')
+    remove = sub.add_parser('remove', help='remove a job')
+    remove.add_argument('id', type=int)
+    requeue = sub.add_parser('requeue', help='queue a failed or skipped job again')
+    requeue.add_argument('id', type=int)
+    run = sub.add_parser('run', help='run the queued jobs')
+    run.add_argument('--budget', default='12h', help='wall clock budget, e.g. 28800, 480m or 8h')
+    run.add_argument('--sim', action='store_true', help='simulated microscope instead of the neaSNOM')
+    run.add_argument('--speed', type=float, default=100., help='speed up of the simulation')
+    run.add_argument('--seed', type=int, default=None, help='sample of the simulation')
+    run.add_argument('--no-epics', action='store_true', help='no beam monitoring')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue)
+    if args.command == 'add':
+        config = ConfigHandler().read_config(args.config)
+        region = {key: getattr(args, key) for key in REGION_KEYS if getattr(args, key) is not None}
+        estimate = parse_duration(args.estimate) if args.estimate else None
+        job = queue.add(config, region, args.priority, args.name, estimate)
+        print('Added job {} ({})'.format(job['id'], job['name']))
+    elif args.command == 'list':
+        for job in sorted(queue.jobs, key=lambda j: j['id']):
+            afm = job['config']['AFM']
+            print('{:3d} {:12s} {:11s} priority {:2d} estimate {:6.0f} s  ({:g}, {:g}) {:g}x{:g} um {}'.format(
+                job['id'], job['name'], job['status'], job['priority'], queue.estimate(job),
+                afm['x0'], afm['y0'], afm['dx'], afm['dy'], job['error'] or ''))
+    elif args.command == 'remove':
+        queue.remove(args.id)
+    elif args.command == 'requeue':
+        queue.update(queue.get(args.id), status='queued', journal=None, hdf5=None, error=None)
+    elif args.command == 'run':
+        try:
+            Scheduler(queue, parse_duration(args.budget), make_backend(args), not args.no_epics).run()
+        except KeyboardInterrupt:
+            print('Aborted, the queue continues with the interrupted job on the next run')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
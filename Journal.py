@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+
+#Journal of a running measurement (JSON lines next to the .hdf5 file). Every
+#step is written and synced as soon as it is done, so an interrupted
+#measurement can be continued with Scan.resume_scan.
+
+def to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def journal_path(hdf5_path):
+    return os.path.splitext(hdf5_path)[0] + '.journal'
+
+class Journal:
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, mode)
+
+    def write(self, event, **data):
+        record = dict(event=event, time=time.time(), **data)
+        line = json.dumps(record, default=to_json)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @staticmethod
+    def load(path):
+        '''
+        State of the journaled measurement: settings (info), .hdf5 file,
+        overview, detected bacteria in measurement order and the points
+        measured so far per bacterium. A line cut off by a crash is ignored.
+        '''
+        state = {'info': None, 'hdf5': None, 'overview': None, 'bacteria': {}, 'points': {}, 'done': False}
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                event = record['event']
+                if event == 'setup':
+                    state['info'] = record['info']
+                    state['hdf5'] = record['hdf5']
+                elif event == 'overview':
+                    state['overview'] = record['path']
+                elif event == 'detection':
+                    state['bacteria'] = record['bacteria']
+                elif event == 'point':
+                    state['points'].setdefault(record['bacterium'], [])
+                    if record['point'] not in state['points'][record['bacterium']]:
+                        state['points'][record['bacterium']].append(record['point'])
+                elif event == 'done':
+                    state['done'] = True
+        for bact in state['bacteria'].values():
+            for point in bact['Points'].values():
+                if 'Coord' in point:
+                    point['Coord'] = tuple(point['Coord'])
+            if 'Reference_Candidates' in bact:
+                bact['Reference_Candidates'] = np.array(bact['Reference_Candidates'])
+        return state
@@ -0,0 +1,95 @@
+import numpy as np
+
+#Background leveling without building an N x k design matrix. The normal
+#equations of a polynomial surface z = sum c_ab * y^a * x^b only need the
+#moments sum(w * y^a * x^b) and sum(w * z * y^a * x^b). Those are separable
+#and can be accumulated as (rows x k) @ (rows x cols) @ (cols x k) products.
+
+def _axis_powers(n, order):
+    #coordinates are scaled to [-1, 1] to keep higher orders well conditioned
+    t = np.linspace(-1.0, 1.0, n) if n > 1 else np.zeros(1)
+    return np.vander(t, order + 1, increasing=True)
+
+def _terms(order):
+    return [(a, b) for a in range(order + 1) for b in range(order + 1 - a)]
+
+def fit_background(data, order=1, mask=None):
+    '''
+    Least-squares polynomial background of total degree `order` for a 2D
+    array. Pixels where `mask` is nonzero (e.g. bacteria) and non-finite
+    pixels are excluded from the fit. Returns the background with the shape
+    of `data`.
+    '''
+    order = int(order)
+    rows, cols = data.shape
+    weight = np.isfinite(data)
+    if mask is not None:
+        weight &= ~np.asarray(mask, dtype=bool)
+    weight = weight.astype(np.float64)
+    values = np.where(weight > 0, data, 0.0).astype(np.float64)
+
+    py = _axis_powers(rows, 2 * order)
+    px = _axis_powers(cols, 2 * order)
+    moments = py.T @ weight @ px
+    z_moments = py[:, :order + 1].T @ values @ px[:, :order + 1]
+
+    terms = _terms(order)
+    gram = np.array([[moments[a + c, b + d] for (c, d) in terms] for (a, b) in terms])
+    rhs = np.array([z_moments[a, b] for (a, b) in terms])
+    theta = np.linalg.pinv(gram) @ rhs
+
+    coeff = np.zeros((order + 1, order + 1))
+    for (a, b), t in zip(terms, theta):
+        coeff[a, b] = t
+    return py[:, :order + 1] @ coeff @ px[:, :order + 1].T
+
+def level_plane(data, order=1, mask=None):
+    return data - fit_background(data, order, mask)
+
+#Line by line leveling. Every mode works on all rows at once.
+
+LINE_MODES = ['diff', 'poly', 'median']
+
+def line_offsets_diff(data):
+    #Same as setting median(data[x] - data[x-1]) to 0 row after row (row 0
+    #is compared with the last row). The median is shift invariant, so the
+    #sequential correction is the cumulative sum of the raw row medians.
+    steps = np.median(data - np.roll(data, 1, axis=0), axis=1)
+    return np.cumsum(steps)
+
+def line_background_poly(data, order=1, mask=None):
+    #polynomial of degree `order` fitted to every row, masked pixels excluded
+    order = int(order)
+    rows, cols = data.shape
+    weight = np.isfinite(data)
+    if mask is not None:
+        weight &= ~np.asarray(mask, dtype=bool)
+    weight = weight.astype(np.float64)
+    values = np.where(weight > 0, data, 0.0).astype(np.float64)
+    vander = _axis_powers(cols, order)
+    outer = (vander[:, :, None] * vander[:, None, :]).reshape(cols, -1)
+    gram = (weight @ outer).reshape(rows, order + 1, order + 1)
+    rhs = values @ vander
+    theta = np.einsum('rkl,rl->rk', np.linalg.pinv(gram), rhs)
+    return theta @ vander.T
+
+def line_offsets_median(data, mask=None):
+    #median of every row, masked pixels excluded; empty rows are not shifted
+    if mask is None:
+        masked = data
+    else:
+        masked = np.where(mask, np.nan, data)
+    valid = np.any(np.isfinite(masked), axis=1)
+    offsets = np.zeros(data.shape[0])
+    if valid.any():
+        offsets[valid] = np.nanmedian(masked[valid], axis=1)
+    return offsets
+
+def level_lines(data, mode='diff', order=1, mask=None):
+    if mode == 'diff':
+        return data - line_offsets_diff(data)[:, None]
+    elif mode == 'poly':
+        return data - line_background_poly(data, order, mask)
+    elif mode == 'median':
+        return data - line_offsets_median(data, mask)[:, None]
+    raise ValueError('Unknown line leveling mode: {}'.format(mode))
@@ -0,0 +1,82 @@
+import queue
+import tkinter as tk
+import threading
+import time
+
+class LogConsole(object):
+    '''
+    Replacement for sys.stdout while a scan runs. write() can be called from
+    any thread, it only queues the text (and appends it to the log file).
+    The Tk thread takes everything queued every interval ms and inserts it
+    into the text widget in one go, keeping the last max_lines lines.
+    '''
+    def __init__(self, text_widget, stream, interval=100, max_lines=1000):
+        self.text_space = text_widget
+        self.stream = stream
+        self.interval = interval
+        self.max_lines = max_lines
+        self.queue = queue.Queue()
+        self.file = None
+        self.line_start = True
+        self._lock = threading.Lock()
+        self.text_space.after(self.interval, self.drain)
+
+    def write(self, string):
+        self.queue.put(string)
+        with self._lock:
+            if self.file is not None:
+                self.write_file(string)
+
+    def writelines(self, strings):
+        for string in strings:
+            self.write(string)
+
+    def write_file(self, string):
+        #every line with the time it was printed
+        for line in string.splitlines(True):
+            if self.line_start:
+                self.file.write(time.strftime('%H:%M:%S '))
+            self.file.write(line)
+            self.line_start = line.endswith('\n')
+
+    def flush(self):
+        with self._lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def set_log_file(self, path):
+        #the whole output goes to path (next to the .hdf5 file) from now on
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(path, 'a', encoding='utf-8')
+            self.line_start = True
+            self.file.write(time.strftime('--- %Y-%m-%d %H:%M:%S ---\n'))
+
+    def close(self):
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def drain(self):
+        strings = []
+        try:
+            while len(strings) < 10000:
+                strings.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            if strings:
+                self.text_space.insert('end', ''.join(strings))
+                lines = int(self.text_space.index('end-1c').split('.')[0])
+                if lines > self.max_lines:
+                    self.text_space.delete('1.0', '{}.0'.format(lines - self.max_lines + 1))
+                self.text_space.see('end')
+            self.text_space.after(self.interval, self.drain)
+        except tk.TclError:
+            #the scan window is closed
+            pass
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
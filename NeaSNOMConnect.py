@@ -1,25 +1,141 @@
 import sys
-import clr
 import time
+import threading
+
+class LatencyStats:
+    #running count, mean and max of a latency in seconds
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = 0.
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.,
+                'max': self.max, 'last': self.last}
+
+
+class Publisher:
+    '''
+    Delivers observer data on its own thread so slow callbacks (GUI) do not
+    hold up the polling of the microscope. Every observer name has one slot
+    with the latest value, older values that were not delivered yet are
+    replaced (and counted as dropped). A name is published at most every
+    `intervals[name]` seconds.
+    '''
+    def __init__(self, observers, intervals):
+        self._observers = observers
+        self.intervals = intervals
+        self._slots = {}
+        self._last = {}
+        self._cond = threading.Condition()
+        self._busy = False
+        self._running = True
+        self.latency = {}
+        self.dropped = {}
+        self._thread = None
+
+    def post(self, name, *args):
+        if not self._observers[name]:
+            return
+        with self._cond:
+            if name in self._slots:
+                self.dropped[name] = self.dropped.get(name, 0) + 1
+            self._slots[name] = (time.perf_counter(), args)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='publisher', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def wants(self, name):
+        #False if the data would not be published now anyway (saves fetching it)
+        return bool(self._observers[name]) and time.perf_counter() >= self._last.get(name, 0.) + self.intervals.get(name, 0.)
+
+    def _next(self):
+        #the due slot that waits longest, or the time until the next one is due
+        now = time.perf_counter()
+        wait = None
+        for name in self._slots:
+            due = self._last.get(name, 0.) + self.intervals.get(name, 0.)
+            if due <= now:
+                return name, 0.
+            wait = due - now if wait is None else min(wait, due - now)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                name, wait = self._next()
+                while name is None and self._running:
+                    self._cond.wait(wait)
+                    name, wait = self._next()
+                if name is None:
+                    return
+                posted, args = self._slots.pop(name)
+                self._last[name] = time.perf_counter()
+                self._busy = True
+            try:
+                for callback in self._observers[name]:
+                    callback(*args)
+            except Exception as e:
+                print('Publisher: {} callback failed: {!r}'.format(name, e))
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self.latency.setdefault(name, LatencyStats()).add(time.perf_counter() - posted)
+                    self._cond.notify_all()
+
+    def flush(self, timeout=5.):
+        #waits until the values posted so far are delivered, ignoring the rate limits
+        end = time.perf_counter() + timeout
+        with self._cond:
+            for name in self._slots:
+                self._last[name] = 0.
+            self._cond.notify_all()
+            while (self._slots or self._busy) and time.perf_counter() < end:
+                self._cond.wait(end - time.perf_counter())
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join()
+
 
 class NeaSNOMConnect:
 
     def __init__(self, ip, path='/home/sachse03/pc/Python/updates/SDK/', con_needed = True):
+        self._progress = 0
+        self._aborted = False
+        self.afm_channel = 'Z'
+        self.plot_channel = 'O2A'
+        self._observers = {}
+        self._observers['Progress'] = []
+        self._observers['Cur_Data'] = []
+        self._observers['Fourier'] = []
+        self._ip = ip
+        self._path = path
+        self._wait_for_injection = False
+        self._meas_completed = False
+        #completion checks start every poll_min seconds and back off to
+        #poll_max, the data is published at most every publish_interval
+        self.poll_min = 0.005
+        self.poll_max = 0.1
+        self.poll_backoff = 1.5
+        self.poll_latency = LatencyStats()
+        self._publisher = Publisher(self._observers, {'Progress': 0.1, 'Cur_Data': 0.2, 'Fourier': 0.2})
         if con_needed:
-            self._progress = 0
-            self._aborted = False
-            self.afm_channel = 'Z'
-            self.plot_channel = 'O2A'
-            self._observers = {}
-            self._observers['Progress'] = []
-            self._observers['Cur_Data'] = []
-            self._observers['Fourier'] = []
-            self._ip = ip
-            self._path = path
-            self._wait_for_injection = False
-            self._meas_completed = False
             ##### Import all DLLs in the folder
             sys.path.append(self._path)
+            ##### pythonnet is only needed (and available) on the measurement PC
+            import clr
             ##### Load the main DLL
             clr.AddReference('Nea.Client.Hardware')
             ##### Import the DLL as element neaSDK
@@ -40,7 +156,14 @@ class NeaSNOMConnect:
     def __enter__(self):
         return self
 
+    def abort(self):
+        #from another thread: the running scan is cancelled and returns no data
+        self._aborted = True
+        if self._connected:
+            self.neaMic.CancelCurrentProcedure()
+
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._publisher.stop()
         if self._connected:
             if exc_type == 'abort':
                 self._aborted = True
@@ -68,6 +191,25 @@ class NeaSNOMConnect:
     
     def bind_to(self, name, callback):
         self._observers[name].append(callback)
+
+    def set_polling(self, poll_min=None, poll_max=None, backoff=None):
+        if poll_min is not None:
+            self.poll_min = poll_min
+        if poll_max is not None:
+            self.poll_max = poll_max
+        if backoff is not None:
+            self.poll_backoff = backoff
+
+    def set_publish_interval(self, name, seconds):
+        self._publisher.intervals[name] = seconds
+
+    def get_stats(self):
+        #poll: time of one poll of the microscope, the observer names: time
+        #from polling the value until all callbacks have returned
+        stats = {'poll': self.poll_latency.as_dict()}
+        for name, latency in self._publisher.latency.items():
+            stats[name] = dict(latency.as_dict(), dropped=self._publisher.dropped.get(name, 0))
+        return stats
     
     def pause(self):
         if self._scan:
@@ -87,16 +229,38 @@ class NeaSNOMConnect:
     
     def set_progress(self, progress):
         self._progress = progress
-        for callback in self._observers['Progress']:
-            callback(progress)
+        self._publisher.post('Progress', progress)
             
     def set_data(self, data):
-        for callback in self._observers['Cur_Data']:
-            callback(data)
+        #with the progress it belongs to, the polled progress can be ahead
+        self._publisher.post('Cur_Data', data, self._progress)
             
     def set_fourier_data(self, data):
-        for callback in self._observers['Fourier']:
-            callback(data)
+        self._publisher.post('Fourier', data)
+
+    def poll_scan(self, channel, publish, stop=None):
+        '''
+        Polls the running scan until it is completed (or stop() is True).
+        The completion check backs off from poll_min to poll_max but is not
+        put off by more than half of the estimated remaining time, the
+        channel data is only fetched when it is going to be published.
+        '''
+        delay = self.poll_min
+        start = time.perf_counter()
+        while not self._scan.IsCompleted and not self._aborted and not (stop and stop()):
+            t = time.perf_counter()
+            progress = self._scan.Progress
+            self.set_progress(progress)
+            if self._publisher.wants(publish[0]):
+                publish[1](channel.GetData())
+            self.poll_latency.add(time.perf_counter() - t)
+            if progress > 0:
+                remaining = (t - start) * (1 - progress) / progress
+                delay = min(delay, max(self.poll_min, remaining / 2))
+            time.sleep(delay)
+            delay = min(delay * self.poll_backoff, self.poll_max)
+        self.set_progress(self._scan.Progress)
+        self._publisher.flush()
         
     def get_wait_for_injection(self):
         return self._wait_for_injection
@@ -106,6 +270,9 @@ class NeaSNOMConnect:
     
     def get_meas_completed(self):
         return self._meas_completed
+
+    def set_meas_completed(self, boolean):
+        self._meas_completed = boolean
     
     def is_started(self):
         return self._scan.IsStarted
@@ -157,10 +324,7 @@ class NeaSNOMConnect:
             for c in channel_names:
                 self._channel[c] = self._image.GetChannel(c)
             print('Scanning..')
-            while not self._scan.IsCompleted:
-                self.set_progress(self._scan.Progress)
-                self.set_data(self._channel[self.afm_channel].GetData())
-                time.sleep(0.1)
+            self.poll_scan(self._channel[self.afm_channel], ('Cur_Data', self.set_data))
             if self._aborted:
                 return {}
             else:
@@ -199,10 +363,7 @@ class NeaSNOMConnect:
             for c in channel_names:
                 _channel[c] = _image.GetChannel(c)
             print('Scanning..')
-            while not self._scan.IsCompleted and not self._wait_for_injection:
-                self.set_progress(self._scan.Progress)
-                self.set_fourier_data(_channel[self.plot_channel].GetData())
-                time.sleep(0.1)
+            self.poll_scan(_channel[self.plot_channel], ('Fourier', self.set_fourier_data), stop=self.get_wait_for_injection)
             if self._scan.IsCompleted and not self._aborted:
                 self._meas_completed = True
                 _data = {}
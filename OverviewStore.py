@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+import h5py
+import numpy as np
+from Journal import to_json
+
+#Overview channels are stored as one .npy file per channel. They are written
+#without text conversion and memory-mapped on reload. The old CSV directories
+#(and Scan .hdf5 files) can still be loaded, CSV export runs in the background.
+#The settings of the scan go into info.json next to the channels.
+
+OVERVIEW_EXT = ['.npy', '.csv']
+INFO_NAME = 'info.json'
+
+def save_info(path, info):
+    if info is not None:
+        with open(os.path.join(path, INFO_NAME), 'w') as file:
+            json.dump(info, file, indent=1, default=to_json)
+
+def save_overview(path, channels, info=None):
+    os.makedirs(path, exist_ok = True)
+    for k in channels.keys():
+        np.save(os.path.join(path, k + '.npy'), channels[k])
+    save_info(path, info)
+
+def load_info(path):
+    #settings (Info of the scan) stored with an overview directory, {} if there are none
+    try:
+        with open(os.path.join(path, INFO_NAME)) as file:
+            return json.load(file)
+    except OSError:
+        return {}
+
+def export_csv(path, channels, info=None):
+    #writes the CSV copies on a background thread, returns the thread
+    def write():
+        os.makedirs(path, exist_ok = True)
+        for k in channels.keys():
+            np.savetxt(os.path.join(path, k + '.csv'), channels[k], delimiter=',')
+        save_info(path, info)
+    thread = threading.Thread(target=write, name='csv_export')
+    thread.start()
+    return thread
+
+def load_overview(path):
+    '''
+    Loads the overview channels from a directory with .npy (preferred) or
+    .csv files, or from the Data/AFM group of a Scan .hdf5 file. The .npy
+    files are memory-mapped copy-on-write, so the arrays can be changed
+    without touching the files.
+    '''
+    channels = {}
+    if os.path.isfile(path):
+        with h5py.File(path, 'r') as hdf:
+            for k in hdf['Data/AFM'].keys():
+                channels[k] = hdf['Data/AFM'][k][()]
+        return channels
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            c, ext = os.path.splitext(f)
+            if ext == '.npy':
+                channels[c] = np.load(os.path.join(root, f), mmap_mode='c')
+            elif ext == '.csv' and c not in channels and c + '.npy' not in files:
+                channels[c] = np.loadtxt(os.path.join(root, f), delimiter=',')
+    return channels
@@ -0,0 +1,104 @@
+import numpy as np
+
+#Visiting order of the stage positions of a measurement with little stage
+#travel: a nearest neighbour path from the current stage position, improved
+#with 2-opt moves. The path is open, the stage does not return to the start.
+
+def distance_matrix(points, start=None):
+    #node 0 is the start (no distance to anything if start is None), the
+    #points follow and the last node is a free end of the path
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    n = len(points)
+    dist = np.zeros((n + 2, n + 2))
+    dist[1:n + 1, 1:n + 1] = np.hypot(points[:, None, 0] - points[None, :, 0], points[:, None, 1] - points[None, :, 1])
+    if start is not None:
+        dist[0, 1:n + 1] = dist[1:n + 1, 0] = np.hypot(points[:, 0] - start[0], points[:, 1] - start[1])
+    return dist
+
+def path_length(points, order, start=None):
+    dist = distance_matrix(points, start)
+    path = [0] + [i + 1 for i in order] + [len(dist) - 1]
+    return float(dist[path[:-1], path[1:]].sum())
+
+def nearest_neighbour(dist):
+    path = [0]
+    left = set(range(1, len(dist) - 1))
+    while left:
+        candidates = list(left)
+        nxt = candidates[int(np.argmin(dist[path[-1], candidates]))]
+        path.append(nxt)
+        left.remove(nxt)
+    return path + [len(dist) - 1]
+
+def two_opt(dist, path, max_passes=100):
+    #reverses path[i:j+1] as long as that makes the path shorter
+    path = np.array(path)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, len(path) - 2):
+            a, b = path[i - 1], path[i]
+            c, d = path[i + 1:-1], path[i + 2:]
+            delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+            j = int(np.argmin(delta))
+            if delta[j] < -10**(-9):
+                path[i:i + j + 2] = path[i:i + j + 2][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return list(path)
+
+def plan_order(points, start=None):
+    '''
+    Indices of `points` (N x 2) in visiting order, starting next to `start`
+    (x, y) or anywhere if start is None.
+    '''
+    if len(points) < 2:
+        return list(range(len(points)))
+    dist = distance_matrix(points, start)
+    path = two_opt(dist, nearest_neighbour(dist))
+    return [int(i) - 1 for i in path[1:-1]]
+
+def order_points(points, start=None):
+    #the measurement points of one bacterium, points without a position stay at the end
+    names = [k for k in points.keys() if 'Coord' in points[k]]
+    order = plan_order([points[k]['Coord'] for k in names], start)
+    ordered = {}
+    for visit, i in enumerate(order):
+        ordered[names[i]] = points[names[i]]
+        ordered[names[i]]['Visit'] = visit
+    for k in points.keys():
+        if k not in ordered:
+            ordered[k] = points[k]
+    return ordered
+
+def plan_measurement(bacteria, start):
+    '''
+    Orders the bacteria (by their Center) and the points of every bacterium.
+    The detection names are kept, the position in the measurement is stored
+    as 'Visit'. Returns the ordered dict and the estimated travel (um) of the
+    detection order and of the planned order.
+    '''
+    names = list(bacteria.keys())
+    centers = [bacteria[k]['Points']['Center']['Coord'] for k in names]
+    order = plan_order(centers, start)
+
+    def travel(keys, point_order):
+        total = path_length([bacteria[k]['Points']['Center']['Coord'] for k in keys], range(len(keys)), start)
+        for k in keys:
+            points = [bacteria[k]['Points'][p]['Coord'] for p in point_order(k)]
+            total += path_length(points, range(len(points)), bacteria[k]['Points']['Center']['Coord'])
+        return total
+
+    def detection_points(k):
+        return [p for p in bacteria[k]['Points'].keys() if 'Coord' in bacteria[k]['Points'][p]]
+
+    before = travel(names, detection_points)
+    ordered = {}
+    for visit, i in enumerate(order):
+        key = names[i]
+        ordered[key] = bacteria[key]
+        ordered[key]['Visit'] = visit
+        ordered[key]['Points'] = order_points(bacteria[key]['Points'], bacteria[key]['Points']['Center']['Coord'])
+    after = travel([names[i] for i in order], detection_points)
+    return ordered, {'Travel_Detection': round(before, 2), 'Travel_Planned': round(after, 2),
+                     'Travel_Saved': round(before - after, 2), 'Order': [names[i] for i in order]}
@@ -0,0 +1,69 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+def snapshot(value):
+    #copy of the dict structure (not of the arrays) as it is now
+    if isinstance(value, dict):
+        return {k: snapshot(v) for k, v in value.items()}
+    return value
+
+class Pipeline:
+    '''
+    Runs the work around the measurement next to the microscope: CPU work
+    (conversion, detection, previews) goes to a thread pool, file I/O to a
+    single thread that runs its jobs strictly in the order they were
+    submitted. Everything written through io() therefore ends up in the
+    file in the same order as when it was written directly.
+    '''
+    def __init__(self, workers=None):
+        self.workers = workers if workers else min(4, os.cpu_count() or 1)
+        self._cpu = None
+        self._io = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _track(self, future):
+        with self._lock:
+            self._pending = [f for f in self._pending if not f.done() or f.exception() is not None]
+            self._pending.append(future)
+        return future
+
+    def compute(self, fn, *args, **kwargs):
+        if self._cpu is None:
+            self._cpu = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pipeline_cpu')
+        return self._track(self._cpu.submit(fn, *args, **kwargs))
+
+    def io(self, fn, *args, **kwargs):
+        #arguments that are futures are resolved in the I/O thread, so a write
+        #can be queued before the data it needs is computed
+        if self._io is None:
+            self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline_io')
+        def job():
+            return fn(*[a.result() if hasattr(a, 'result') else a for a in args], **kwargs)
+        return self._track(self._io.submit(job))
+
+    def drain(self):
+        #waits for everything submitted so far, raises the first error
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        error = None
+        for future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            for executor in (self._cpu, self._io):
+                if executor is not None:
+                    executor.shutdown(wait=True)
+            self._cpu = None
+            self._io = None
@@ -0,0 +1,261 @@
+import threading
+import tkinter as tk
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+#Previews for the scan window. The drawing runs in the Tk thread, the scan
+#thread only hands over the newest data.
+
+def last_valid_row(data):
+    #index of the last row with at least one value (the running average pass)
+    valid = np.flatnonzero(~np.isnan(data).all(axis=1))
+    return valid[-1] if len(valid) else 0
+
+def decimate(y, width):
+    '''
+    Min/max per pixel column for a line plot `width` pixels wide: looks the
+    same as the full line but has at most 2 * width points. Returns x, y.
+    '''
+    n = len(y)
+    if width <= 0 or n <= 2 * width:
+        return np.arange(n), y
+    starts = np.linspace(0, n, width, endpoint=False).astype(int)
+    with np.errstate(invalid='ignore'):
+        low = np.fmin.reduceat(y, starts)
+        high = np.fmax.reduceat(y, starts)
+    x = np.repeat(starts, 2)
+    return x, np.column_stack((low, high)).ravel()
+
+class TraceBuffer:
+    '''
+    Newest interferogram, from the scan thread to the Tk thread. put()
+    copies into a buffer that is kept as long as shape and dtype stay the
+    same, take() returns a copy of the two rows that are drawn (the running
+    averaging pass and the one before) or None if nothing new came.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self.changed = False
+
+    def put(self, data):
+        data = np.asarray(data)
+        with self.lock:
+            if self.data is None or self.data.shape != data.shape or self.data.dtype != data.dtype:
+                self.data = np.empty(data.shape, data.dtype)
+            np.copyto(self.data, data)
+            self.changed = True
+
+    def take(self):
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+            data = np.atleast_2d(self.data)
+            row = last_valid_row(data)
+            return data[max(row - 1, 0):row + 1].copy()
+
+class LivePlot:
+    '''
+    Interferogram of the running Fourier scan: the current averaging pass in
+    red, the one before in light blue. The lines are kept and only their
+    data is changed, every interval ms the axes background is restored and
+    the lines are blitted on top. A full redraw is only needed when the
+    y range or the window size changes.
+    '''
+    def __init__(self, master, interval=100, figsize=(10, 4), dpi=100):
+        self.interval = interval
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.ax.yaxis.set_visible(False)
+        self.ax.xaxis.set_visible(False)
+        self.fig.tight_layout()
+        (self.previous,) = self.ax.plot([], [], 'b', linewidth=0.5, alpha=0.2, animated=True)
+        (self.current,) = self.ax.plot([], [], 'r', linewidth=0.5, animated=True)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=master)
+        self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.trace = TraceBuffer()
+        self.canvas.get_tk_widget().after(self.interval, self.refresh)
+
+    def set_data(self, data):
+        #scan thread: only keep (a copy of) the newest data, it is drawn on the
+        #next refresh while the scan already fills its buffer again
+        self.trace.put(data)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        self.ax.draw_artist(self.previous)
+        self.ax.draw_artist(self.current)
+
+    def refresh(self):
+        widget = self.canvas.get_tk_widget()
+        try:
+            rows = self.trace.take()
+            if rows is not None:
+                self.update_lines(rows)
+            widget.after(self.interval, self.refresh)
+        except Exception as e:
+            #the window is closed
+            if widget.winfo_exists():
+                print('LivePlot: {!r}'.format(e))
+                widget.after(self.interval, self.refresh)
+
+    def update_lines(self, rows):
+        #rows from TraceBuffer.take, the last one is the running pass
+        width = int(self.ax.bbox.width)
+        self.current.set_data(*decimate(rows[-1], width))
+        if len(rows) > 1:
+            self.previous.set_data(*decimate(rows[0], width))
+        else:
+            self.previous.set_data([], [])
+        if self.rescale(rows) or self.background is None:
+            #new limits: full redraw, on_draw takes the new background
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
+            self.canvas.blit(self.ax.bbox)
+
+    def rescale(self, rows):
+        #True if the axes limits had to be changed
+        if not np.isfinite(rows).any():
+            return False
+        low, high = np.nanmin(rows), np.nanmax(rows)
+        margin = 0.05 * (high - low) if high > low else 1.
+        x_max = max(rows.shape[1] - 1, 1)
+        (y0, y1) = self.ax.get_ylim()
+        #grow at once, shrink only if the data uses less than half of the range
+        if (self.ax.get_xlim() != (0, x_max) or low < y0 or high > y1
+                or (high > low and high - low < 0.5 * (y1 - y0))):
+            self.ax.set_xlim(0, x_max)
+            self.ax.set_ylim(low - margin, high + margin)
+            return True
+        return False
+
+def ppm(rgb):
+    #uint8 (h, w, 3) array as binary PPM, Tk reads it without decoding
+    (h, w) = rgb.shape[:2]
+    return b'P6 %d %d 255\n' % (w, h) + np.ascontiguousarray(rgb, dtype=np.uint8).tobytes()
+
+class PlotPreview:
+    '''
+    Spectrum preview in a Tk PhotoImage. One offscreen Agg figure with one
+    line is kept and redrawn, its RGB buffer goes to Tk as PPM. post() can
+    be called from any thread as often as the data comes in, it only keeps
+    the newest data. The Tk thread looks for it every interval ms and draws
+    it, frames in between are skipped (counted in self.skipped).
+    '''
+    def __init__(self, image, master, interval=200, size=(400, 400), dpi=100):
+        self.image = image
+        self.master = master
+        self.interval = interval
+        self.fig = Figure(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.ax.xaxis.set_visible(False)
+        self.ax.yaxis.set_visible(False)
+        self.fig.tight_layout()
+        (self.line,) = self.ax.plot([], [])
+        self.pending = None
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self.master.after(self.interval, self.draw)
+
+    def render(self, y):
+        #RGB image of the spectrum y
+        self.line.set_data(np.arange(len(y)), y)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[..., :3]
+
+    def post(self, y):
+        with self._lock:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = y
+
+    def draw(self):
+        if not self.master.winfo_exists():
+            #the scan window is closed, the image outlives it
+            return
+        with self._lock:
+            y = self.pending
+            self.pending = None
+        try:
+            if y is not None:
+                self.image.put(ppm(self.render(y)))
+            self.master.after(self.interval, self.draw)
+        except tk.TclError:
+            pass
+
+def pgm(gray):
+    #uint8 (h, w) array as binary PGM
+    (h, w) = gray.shape
+    return b'P5 %d %d 255\n' % (w, h) + np.ascontiguousarray(gray, dtype=np.uint8).tobytes()
+
+def colormap_lut(name):
+    #(256, 3) uint8 lookup table of a matplotlib colormap, None for gray
+    if not name or name == 'gray':
+        return None
+    from matplotlib import colormaps
+    try:
+        cmap = colormaps[name]
+    except KeyError:
+        print('Unknown colormap {}, using gray'.format(name))
+        return None
+    return (cmap(np.arange(256))[:, :3] * 255).round().astype(np.uint8)
+
+class ImagePreview:
+    '''
+    uint8 preview image in a Tk PhotoImage, passed as PGM (or as PPM with a
+    colormap lut) without any encoding. show() can be called from any
+    thread, it only builds the image data and keeps the newest one; the Tk
+    thread looks for it every interval ms and puts it (like LogConsole). A
+    frame equal to the one shown is not put again.
+    '''
+    def __init__(self, image, master, lut=None, interval=100):
+        self.image = image
+        self.master = master
+        self.lut = lut
+        self.interval = interval
+        self.last = None
+        self.pending = None
+        self._lock = threading.Lock()
+        self.master.after(self.interval, self.refresh)
+
+    def show(self, frame):
+        frame = np.asarray(frame, dtype=np.uint8)
+        if self.last is not None and self.last.shape == frame.shape and np.array_equal(self.last, frame):
+            return False
+        self.last = frame.copy()
+        if frame.ndim == 3:
+            data = ppm(frame)
+        elif self.lut is not None:
+            data = ppm(self.lut[frame])
+        else:
+            data = pgm(frame)
+        with self._lock:
+            self.pending = data
+        return True
+
+    def refresh(self):
+        if not self.master.winfo_exists():
+            #the scan window is closed, the image outlives it
+            return
+        with self._lock:
+            data = self.pending
+            self.pending = None
+        try:
+            if data is not None:
+                self.image.put(data)
+            self.master.after(self.interval, self.refresh)
+        except tk.TclError:
+            pass
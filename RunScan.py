@@ -0,0 +1,176 @@
+import argparse
+import copy
+import functools
+import os
+import sys
+import time
+from ConfigHandler import ConfigHandler
+from Journal import Journal, journal_path
+from Scan import Scan
+import Batch
+
+#Command line runner without the Tk window, e.g. for unattended runs over
+#ssh. 'scan' runs Scan.full_scan for the settings in scan.ini against the
+#microscope or the simulator (SimNeaSNOM), 'resume' continues an interrupted
+#scan from its journal and 'batch' is the reprocessing of Batch.py. Nothing
+#here imports tkinter.
+
+class Reporter:
+    '''
+    Observer for a Scan: prints the progress of the running scan (overview,
+    refinement or Fourier point) at most every interval seconds, with px/s
+    for AFM scans and the measured points/min for Fourier scans, and the
+    EPICS messages, which pause the measurement as in the GUI.
+    '''
+    def __init__(self, interval=5.):
+        self.interval = interval
+        self.scan = None
+        self.label = None
+        self.fourier_start = None
+        self.last = 0.
+
+    def attach(self, scan):
+        self.scan = scan
+        self.label = None
+        self.fourier_start = None
+        scan.bind_to('progress', self.on_progress)
+
+    def on_progress(self, progress):
+        now = time.time()
+        (label, px, start) = self.scan.stage
+        if label != self.label:
+            #the next scan has started
+            self.label = label
+            self.last = 0.
+            if not px and self.fourier_start is None:
+                self.fourier_start = start
+        if now - self.last < self.interval and progress < 1:
+            return
+        self.last = now
+        if px:
+            rate = '{:.0f} px/s'.format(progress * px / max(now - start, 10**(-6)))
+        else:
+            rate = '{:.1f} points/min'.format(self.scan.points_measured * 60 / max(now - self.fourier_start, 10**(-6)))
+        print('{} {:5.1f} % ({})'.format(label, progress * 100, rate))
+
+    def on_epics(self, message, data=None):
+        if message == 'epics_stop':
+            print('Detected Start of Injection.')
+        elif message == 'epics_restart':
+            print('Injection is finished.')
+        elif message == 'epics_error':
+            print('Detected Currency Drop. Old: {} - New: {}'.format(data[0], data[1]))
+        try:
+            self.scan.set_wait_for_injection(message != 'epics_restart')
+        except AttributeError:
+            pass
+
+def summary(hdf5_path, seconds):
+    #bacteria and points measured in one iteration, from its journal
+    try:
+        state = Journal.load(journal_path(hdf5_path))
+    except OSError:
+        return 'no journal for {}'.format(hdf5_path)
+    points = sum(len(p) for p in state['points'].values())
+    return '{} bacteria, {} points in {:.0f} s ({:.1f} points/min) -> {}'.format(
+        len(state['bacteria']), points, seconds, points * 60 / max(seconds, 10**(-6)), hdf5_path)
+
+def make_backend(args):
+    if not args.sim:
+        return None
+    from SimNeaSNOM import SimNeaSNOMConnect, SimSample
+    sample = SimSample(seed=args.seed)
+    return functools.partial(SimNeaSNOMConnect, sample=sample, speed=args.speed)
+
+def start_epics(reporter):
+    #beam monitoring only where pyepics is installed
+    try:
+        from Epics_Control import Epics_Control
+    except ImportError:
+        return None
+    epics_ctrl = Epics_Control()
+    epics_ctrl.bind_to(reporter.on_epics)
+    return epics_ctrl
+
+def run_scans(scan_dict, iterations, csv_path='', backend=None, epics=True):
+    reporter = Reporter()
+    epics_ctrl = start_epics(reporter) if epics and backend is None else None
+    total = time.time()
+    try:
+        for step in range(1, iterations + 1):
+            print('Iteration {} of {}'.format(step, iterations))
+            start = time.time()
+            with Scan(copy.deepcopy(scan_dict), backend=backend) as scan:
+                reporter.attach(scan)
+                if epics_ctrl is not None:
+                    scan.set_current_buffer(epics_ctrl.current)
+                scan.full_scan(step, csv_path)
+            print(summary(scan.hdf5_path, time.time() - start))
+    finally:
+        if epics_ctrl is not None:
+            epics_ctrl.stop()
+    print('Done: {} iterations in {:.0f} s'.format(iterations, time.time() - total))
+
+def run_resume(scan_dict, path, backend=None, epics=True):
+    reporter = Reporter()
+    epics_ctrl = start_epics(reporter) if epics and backend is None else None
+    start = time.time()
+    try:
+        with Scan(copy.deepcopy(scan_dict), backend=backend) as scan:
+            reporter.attach(scan)
+            if epics_ctrl is not None:
+                scan.set_current_buffer(epics_ctrl.current)
+            scan.resume_scan(path)
+        if scan.journal is not None:
+            print(summary(scan.hdf5_path, time.time() - start))
+    finally:
+        if epics_ctrl is not None:
+            epics_ctrl.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs measurements without the GUI.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    backend = argparse.ArgumentParser(add_help=False)
+    backend.add_argument('--sim', action='store_true', help='simulated microscope instead of the neaSNOM')
+    backend.add_argument('--speed', type=float, default=100., help='speed up of the simulation')
+    backend.add_argument('--seed', type=int, default=None, help='sample of the simulation')
+    backend.add_argument('--no-epics', action='store_true', help='no beam monitoring')
+    scan = sub.add_parser('scan', parents=[backend], help='full scans with the settings of scan.ini')
+    scan.add_argument('--config', default=os.path.join(os.getcwd(), 'scan.ini'))
+    scan.add_argument('--iterations', type=int, default=None, help='default: Iterations of scan.ini')
+    scan.add_argument('--overview', default='', help='use this overview (_NPY/_CSV directory or .hdf5) instead of scanning one')
+    scan.add_argument('--dest', default=None, help='overrides dest_path of scan.ini')
+    resume = sub.add_parser('resume', parents=[backend], help='continue an interrupted scan')
+    resume.add_argument('journal', help='.journal file of the scan')
+    resume.add_argument('--config', default=os.path.join(os.getcwd(), 'scan.ini'))
+    batch = sub.add_parser('batch', help='re-run the bacteria detection on stored overviews (Batch.py)')
+    batch.add_argument('roots', nargs='+')
+    batch.add_argument('--output', default='batch_results.jsonl')
+    batch.add_argument('--config', default=None)
+    batch.add_argument('--workers', type=int, default=None)
+    batch.add_argument('--resume', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'batch':
+        config = ConfigHandler().read_config(args.config) if args.config else None
+        counts = Batch.run_batch(args.roots, args.output, config, args.workers, args.resume)
+        print('Done: {} ok, {} without bacteria, {} errors'.format(counts['ok'], counts['no_bacteria'], counts['error']))
+        return
+
+    scan_dict = ConfigHandler().read_config(args.config)
+    try:
+        if args.command == 'resume':
+            #the settings of the interrupted scan come from its journal
+            run_resume(scan_dict, args.journal, make_backend(args), not args.no_epics)
+            return
+        if args.dest is not None:
+            scan_dict['Measurement']['dest_path'] = args.dest
+        iterations = args.iterations if args.iterations else int(scan_dict['Measurement'].get('iterations', 1))
+        scan_dict['Measurement']['iterations'] = iterations
+        run_scans(scan_dict, iterations, args.overview, make_backend(args), not args.no_epics)
+    except KeyboardInterrupt:
+        print('Aborted, continue with: python RunScan.py resume <.journal file>')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,32 @@
 import sys
-import clr
 import time
 import cv2
 import numpy as np
 import ctypes
 import os
-import epics
-import System
 import h5py
 import configparser as cfg
-import matplotlib.pyplot as plt
-from System import Array, Int32
-from System.Runtime.InteropServices import GCHandle, GCHandleType
+try:
+    #pythonnet and pyepics are only needed on the measurement PC
+    import clr
+    import System
+    from System import Array, Int32
+    from System.Runtime.InteropServices import GCHandle, GCHandleType
+except ImportError:
+    clr = None
+try:
+    import epics
+except ImportError:
+    epics = None
 from datetime import datetime
 from NeaSNOMConnect import NeaSNOMConnect
 from Find_Bact import *
+from HDF5Stream import HDF5Stream, dict_to_hdf5
+from OverviewStore import save_overview, export_csv, load_overview
+from PathPlanner import plan_measurement, order_points
+from Pipeline import Pipeline, snapshot
+from Drift import DriftTracker, DriftModel, phase_shift
+from Journal import Journal, journal_path
 
 
 _MAP_NET_NP = {
@@ -31,23 +43,19 @@ _MAP_NET_NP = {
     'Boolean': np.dtype('bool'),
 }
 
-def asNumpyArray(netArray):
-    '''
-    Given a CLR `System.Array` returns a `numpy.ndarray`.  See _MAP_NET_NP for
-    the mapping of CLR types to Numpy dtypes.
-    '''
-    dims = np.empty(netArray.Rank, dtype=int)
-    for I in range(netArray.Rank):
-        dims[I] = netArray.GetLength(I)
+def net_array_info(netArray):
+    #shape and numpy dtype of a CLR `System.Array`
+    dims = tuple(netArray.GetLength(I) for I in range(netArray.Rank))
     netType = netArray.GetType().GetElementType().Name
-
     try:
-        npArray = np.empty(dims, order='C', dtype=_MAP_NET_NP[netType])
+        return dims, _MAP_NET_NP[netType]
     except KeyError:
         raise NotImplementedError("asNumpyArray does not yet support System type {}".format(netType) )
 
+def net_array_copy(netArray, npArray):
+    #copies the CLR array into the C-contiguous npArray of the same size
+    sourceHandle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
     try: # Memmove
-        sourceHandle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
         sourcePtr = sourceHandle.AddrOfPinnedObject().ToInt64()
         destPtr = npArray.__array_interface__['data'][0]
         ctypes.memmove(destPtr, sourcePtr, npArray.nbytes)
@@ -55,21 +63,174 @@ def asNumpyArray(netArray):
         if sourceHandle.IsAllocated: sourceHandle.Free()
     return npArray
 
+def asNumpyArray(netArray):
+    '''
+    Given a CLR `System.Array` returns a `numpy.ndarray`.  See _MAP_NET_NP for
+    the mapping of CLR types to Numpy dtypes. Numpy arrays (simulated
+    backend) are returned as they are.
+    '''
+    if isinstance(netArray, np.ndarray):
+        return netArray
+    dims, dtype = net_array_info(netArray)
+    return net_array_copy(netArray, np.empty(dims, order='C', dtype=dtype))
+
+def convert_channels(channels):
+    return {k: asNumpyArray(channels[k]) for k in channels.keys()}
+
+class NetArrayConverter:
+    '''
+    Converts CLR arrays into numpy arrays. For data that is polled over and
+    over (live image, live plot) convert(..., view=True) fills a
+    preallocated buffer per key, shape and dtype instead of allocating a new
+    array every time.
+    '''
+    def __init__(self):
+        self._buffers = {}
+
+    def buffer(self, key, shape, dtype):
+        try:
+            buf = self._buffers[key]
+            if buf.shape == shape and buf.dtype == dtype:
+                return buf
+        except KeyError:
+            pass
+        buf = np.empty(shape, order='C', dtype=dtype)
+        self._buffers[key] = buf
+        return buf
+
+    def convert(self, netArray, key, view=False):
+        '''
+        By default a new array that belongs to the caller. With view=True a
+        read-only view of the buffer of key, which is only valid until the
+        next convert of the same key overwrites it: use it right away in the
+        converting thread and copy what is handed on to another thread.
+        '''
+        if isinstance(netArray, np.ndarray):
+            npArray = netArray if view else netArray.copy()
+        else:
+            dims, dtype = net_array_info(netArray)
+            out = self.buffer(key, dims, dtype) if view else np.empty(dims, order='C', dtype=dtype)
+            npArray = net_array_copy(netArray, out)
+        if view:
+            npArray = npArray.view()
+            npArray.flags.writeable = False
+        return npArray
+
+    def clear(self):
+        self._buffers = {}
+
+class LivePreview:
+    '''
+    Preview of an overview while it is scanned. Only the rows finished since
+    the last update (taken from the scan progress) are copied out of the
+    channel data, added to the running min/max and resized into the matching
+    band of the preview, so an update costs about the new rows plus the
+    normalization of the (small) preview, not the full image.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.data = None
+
+    def reset(self, shape, dtype):
+        self.data = np.full(shape, np.nan, dtype=dtype)
+        self.small = np.full((self.size[1], self.size[0]), np.nan, dtype=np.float32)
+        self.image = np.zeros(self.small.shape, dtype=np.uint8)
+        self.rows = 0
+        self.small_rows = 0
+        self.low = np.inf
+        self.high = -np.inf
+        #area weights of the source rows for every preview row
+        edges = np.arange(self.small.shape[0] + 1) * shape[0] / self.small.shape[0]
+        r = np.arange(shape[0])
+        self.weights = np.clip(np.minimum(r + 1, edges[1:, None]) - np.maximum(r, edges[:-1, None]), 0, None)
+        self.weights /= self.weights.sum(axis=1, keepdims=True)
+
+    def copy_rows(self, source, r0, r1):
+        if isinstance(source, np.ndarray):
+            self.data[r0:r1] = source[r0:r1]
+            return
+        row_bytes = self.data.strides[0]
+        sourceHandle = GCHandle.Alloc(source, GCHandleType.Pinned)
+        try:
+            sourcePtr = sourceHandle.AddrOfPinnedObject().ToInt64() + r0 * row_bytes
+            destPtr = self.data.__array_interface__['data'][0] + r0 * row_bytes
+            ctypes.memmove(destPtr, sourcePtr, (r1 - r0) * row_bytes)
+        finally:
+            if sourceHandle.IsAllocated: sourceHandle.Free()
+
+    def update(self, source, progress):
+        if isinstance(source, np.ndarray):
+            shape, dtype = source.shape, source.dtype
+        else:
+            shape, dtype = net_array_info(source)
+        rows = min(shape[0], int(progress * shape[0] + 10**(-9)))
+        if self.data is None or self.data.shape != shape or self.data.dtype != dtype or rows < self.rows:
+            #new scan
+            self.reset(shape, dtype)
+        if rows == self.rows:
+            return self.image
+        r0, self.rows = self.rows, rows
+        self.copy_rows(source, r0, rows)
+        new = self.data[r0:rows]
+        if not np.isnan(new).all():
+            self.low = min(self.low, float(np.nanmin(new)))
+            self.high = max(self.high, float(np.nanmax(new)))
+        #preview rows that are complete now and the source rows behind them
+        ph = self.small.shape[0]
+        p0 = self.small_rows
+        p1 = ph if rows == shape[0] else rows * ph // shape[0]
+        if p1 > p0:
+            s0 = p0 * shape[0] // ph
+            s1 = min(rows, -(-p1 * shape[0] // ph))
+            band = cv2.resize(np.asarray(self.data[s0:s1], dtype=np.float32), (self.size[0], s1 - s0), interpolation=cv2.INTER_AREA)
+            self.small[p0:p1] = self.weights[p0:p1, s0:s1] @ band
+            self.small_rows = p1
+        if self.high > self.low:
+            scaled = (self.small - self.low) * (255. / (self.high - self.low))
+            np.clip(np.rint(np.nan_to_num(scaled, copy=False)), 0, 255, out=scaled)
+            self.image = scaled.astype(np.uint8)
+        return self.image
+
 class ScanAbortException(Exception):
     pass
 
+def unique_name(base, ext):
+    #base, or base_2, base_3, ... if base + ext exists already (scans
+    #started within the same minute)
+    name = base
+    n = 1
+    while os.path.exists(name + ext):
+        n += 1
+        name = '{}_{}'.format(base, n)
+    return name
+
 class Scan:
-    def __init__(self, scan_dict):
-        self.OBSERVER_LABEL = ['live_afm', 'bact', 'points', 'progress', 'hide_plot', 'afm', 'live_plot', 'plot']
+    def __init__(self, scan_dict, backend=None):
+        #backend: callable returning a NeaSNOMConnect like object, None for the microscope
+        self.backend = backend
+        self.OBSERVER_LABEL = ['live_afm', 'bact', 'points', 'progress', 'hide_plot', 'afm', 'live_plot', 'plot', 'log']
         self.exit = False
         self.observers = {}
         for label in self.OBSERVER_LABEL:
             self.observers[label] = []
         self.progress = 0
+        #what the progress belongs to: (label, pixels of an AFM scan or 0, start)
+        self.stage = ('', 0, None)
+        self.points_measured = 0
         self.preview_size = (400, 400)
+        #'incremental': only new rows are processed, 'full': the whole frame on every poll
+        self.live_mode = 'incremental'
+        self.live_preview = LivePreview(self.preview_size)
         self.avrg_pointer = 0
         self.hdf5_dict = {}
         self.hdf5_path = os.getcwd()
+        self.writer = None
+        self.journal = None
+        self.overview_path = ''
+        self.exports = []
+        #conversions, previews and file writes run next to the microscope
+        self.pipeline = Pipeline()
+        self.converter = NetArrayConverter()
         self.hdf5_dict['Data'] = {}
         self.hdf5_dict['Info'] = scan_dict['Info']
         self.hdf5_dict['Info']['AFM'] = scan_dict['AFM']
@@ -81,17 +242,49 @@ class Scan:
         self.hdf5_dict['Info']['Channel'] = self.channel
         self.hdf5_dict['Info']['Characteristics'] = scan_dict['Characteristics']
         self.hdf5_dict['Info']['Measurement'] = scan_dict['Measurement']
+        self.csv_export = bool(scan_dict['Measurement'].get('csv_export', 0))
+        self.plan_path = bool(scan_dict['Measurement'].get('plan_path', 1))
+        #seconds from one compressed scan to the next, registrations below
+        #drift_confidence are not used
+        self.drift_interval = float(scan_dict['Measurement'].get('drift_interval', 60))
+        self.drift_confidence = 0.05
+        self.aborted = False
+        #refinement scans only when the predicted drift is more uncertain
+        #than rescan_threshold (um) or the last one is older than rescan_age (s)
+        self.rescan_threshold = float(scan_dict['Measurement'].get('rescan_threshold', 0.1))
+        self.rescan_age = float(scan_dict['Measurement'].get('rescan_age', 600))
+        self.drift_model = DriftModel()
+        #beam current samples of the pv monitor (BeamCurrent.CurrentBuffer)
+        self.current_buffer = None
     
     def __enter__(self):
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not exc_type == 'abort':
+        if exc_type == 'abort':
+            #cancel the measurement before the workers are waited for
+            self.abort()
+        try:
+            self.pipeline.close()
+        except Exception as e:
+            print('Pipeline: {!r}'.format(e))
+        for thread in self.exports:
+            thread.join()
+        self.exports = []
+        if self.writer is not None:
+            #the data is already in the file, also after an abort
+            if not exc_type == 'abort' and not self.writer.closed:
+                self.writer.write('Info', self.hdf5_dict['Info'])
+            self.writer.close()
+            if self.journal is not None:
+                self.journal.close()
+        elif not exc_type == 'abort' and self.hdf5_dict['Data']:
             #try:
             with h5py.File(self.hdf5_path, 'w') as hdf:
                 self.dict_to_hdf5(hdf, self.hdf5_dict)
             #except OSError:
                 #print('OSError')
+        self.print_stats()
         try:
             self.neaConnect.__exit__(exc_type, exc_val, exc_tb)
         except AttributeError:
@@ -113,17 +306,67 @@ class Scan:
     def bind_to(self, name, callback):
         self.observers[name].append(callback)
     
+    def connect(self):
+        if self.backend is None:
+            connection = NeaSNOMConnect('192.168.89.44', os.path.join(os.getcwd(), 'updates/SDK/'), con_needed = True)
+        else:
+            connection = self.backend()
+        #polling of the microscope and update rate of the previews (ms)
+        measurement = self.hdf5_dict['Info']['Measurement']
+        connection.set_polling(float(measurement.get('poll_min', 5)) / 1000, float(measurement.get('poll_max', 100)) / 1000)
+        for name in ['Cur_Data', 'Fourier']:
+            connection.set_publish_interval(name, float(measurement.get('publish_interval', 200)) / 1000)
+        return connection
+
+    def print_stats(self):
+        #latencies of the polling and of the observers, into the log of the scan
+        try:
+            stats = self.neaConnect.get_stats()
+        except AttributeError:
+            return
+        for name, values in stats.items():
+            dropped = ', {} dropped'.format(values['dropped']) if 'dropped' in values else ''
+            print('Latency {}: {} x, mean {:.1f} ms, max {:.1f} ms{}'.format(
+                name, values['count'], values['mean'] * 1000, values['max'] * 1000, dropped))
+    
+    def get_current(self):
+        #the simulator has its own beam current, the neaSNOM connection not
+        if hasattr(self.neaConnect, 'get_current'):
+            return self.neaConnect.get_current()
+        if epics is None:
+            raise RuntimeError('No beam current: pyepics is not installed and there is no current monitor')
+        return epics.caget('CUM1ZK3RP:rdCur')
+    
+    def set_current_buffer(self, buffer):
+        self.current_buffer = buffer
+    
+    def current_window(self, t0, t1):
+        #beam current while a point was measured (t0 to t1), a single reading
+        #if there is no monitor or it has no samples yet
+        try:
+            current = self.current_buffer.stats(t0, t1)
+        except AttributeError:
+            current = None
+        if current is None:
+            value = self.get_current()
+            current = {'Current': value, 'Current_Integral': value * (t1 - t0),
+                       'Current_Series': {'Time': np.array([t0]), 'Value': np.array([value])}}
+        return current
+    
     def dict_to_hdf5(self, group, adict):
-        for key, value in adict.items():
-            if isinstance(value, dict):
-                next_group = group.create_group(key)
-                self.dict_to_hdf5(next_group, value)
-            else:
-                try:
-                    group.create_dataset(key, data=np.atleast_1d(value))
-                except TypeError:
-                    #special type for strings
-                    group.create_dataset(key, data=np.array(value, dtype=h5py.special_dtype(vlen=bytes)))
+        dict_to_hdf5(group, adict)
+
+    def write(self, name, value):
+        #queued on the I/O thread; the dict structure is copied, so entries can
+        #be replaced afterwards, but the arrays are shared and must not be
+        #changed in place; futures (e.g. a conversion) are waited for there
+        return self.pipeline.io(self.writer.write, name, value if hasattr(value, 'result') else snapshot(value))
+
+    def read(self, name):
+        return self.pipeline.io(self.writer.read, name).result()
+
+    def write_point(self, name, point, fourier_data):
+        self.writer.write(name, dict(point, **fourier_data))
                     
     def pause(self):
         try:
@@ -138,6 +381,8 @@ class Scan:
             print('No Measurement running.')
             
     def abort(self):
+        #also from another thread, the journal keeps what is done so far
+        self.aborted = True
         try:
             self.neaConnect.abort()
         except AttributeError:
@@ -167,11 +412,14 @@ class Scan:
         for callback in self.observers['progress']:
             callback(progress)
             
-    def set_live_image(self, data):
+    def set_live_image(self, data, progress=None):
         #np.nan_to_num(x)
-        cur_data = asNumpyArray(data)
-        live_image = cv2.normalize(cur_data, None,0,255,cv2.NORM_MINMAX, cv2.CV_8U)
-        live_image = cv2.resize(live_image, self.preview_size)
+        if self.live_mode == 'incremental':
+            live_image = self.live_preview.update(data, self.progress if progress is None else progress)
+        else:
+            cur_data = self.converter.convert(data, 'live_afm', view=True)
+            live_image = cv2.normalize(cur_data, None,0,255,cv2.NORM_MINMAX, cv2.CV_8U)
+            live_image = cv2.resize(live_image, self.preview_size)
         for callback in self.observers['live_afm']:
             callback('live_afm', live_image)
             
@@ -195,6 +443,20 @@ class Scan:
         for callback in self.observers['plot']:
             callback('plot', data)
     
+    def set_point_spectrum(self, channels):
+        #plot channel of the point just measured, (x, y, pass, sample) as converted
+        try:
+            data = channels[self.neaConnect.plot_channel]
+        except (AttributeError, KeyError):
+            return
+        self.set_plot_image(data)
+    
+    def set_log(self):
+        #the output of the measurement is logged next to its .hdf5 file
+        log_path = os.path.splitext(self.hdf5_path)[0] + '.log'
+        for callback in self.observers['log']:
+            callback(log_path)
+    
     def scan_setup(self, step):
         #self.set_live_image(np.zeros(self.preview_size))
         self.set_bact_image(np.zeros(self.preview_size))
@@ -214,56 +476,186 @@ class Scan:
         ops = '_'.join(all_shorts)
         
         if self.hdf5_dict['Info']['AFM']['dx'] == self.hdf5_dict['Info']['AFM']['dy']:
-            scanarea = str(self.hdf5_dict['Info']['AFM']['dx'])
+            scanarea = '{:g}'.format(self.hdf5_dict['Info']['AFM']['dx'])
         else:
-            scanarea = '{}x{}'.format(self.hdf5_dict['Info']['AFM']['dx'], self.hdf5_dict['Info']['AFM']['dy'])
+            scanarea = '{:g}x{:g}'.format(self.hdf5_dict['Info']['AFM']['dx'], self.hdf5_dict['Info']['AFM']['dy'])
             
         if self.hdf5_dict['Info']['AFM']['px'] == self.hdf5_dict['Info']['AFM']['py']:
-            pixelarea = str(self.hdf5_dict['Info']['AFM']['px'])
+            pixelarea = '{:g}'.format(self.hdf5_dict['Info']['AFM']['px'])
         else:
-            pixelarea = '{}x{}'.format(self.hdf5_dict['Info']['AFM']['px'], self.hdf5_dict['Info']['AFM']['py'])
+            pixelarea = '{:g}x{:g}'.format(self.hdf5_dict['Info']['AFM']['px'], self.hdf5_dict['Info']['AFM']['py'])
 
-        scan_name = '{} {}_{}_{}µm_{}px_{}of{}'.format(now, ops, self.hdf5_dict['Info']['project'], int(scanarea), int(pixelarea), int(step), int(self.hdf5_dict['Info']['Measurement']['iterations']))
-        self.hdf5_path = os.path.join(self.hdf5_dict['Info']['Measurement']['dest_path'], scan_name + '.hdf5')
+        scan_name = '{} {}_{}_{}µm_{}px_{}of{}'.format(now, ops, self.hdf5_dict['Info']['project'], scanarea, pixelarea, int(step), int(self.hdf5_dict['Info']['Measurement']['iterations']))
+        self.hdf5_path = unique_name(os.path.join(self.hdf5_dict['Info']['Measurement']['dest_path'], scan_name), '.hdf5') + '.hdf5'
+        self.set_log()
+        if self.writer is not None:
+            self.pipeline.drain()
+            self.writer.close()
+            self.journal.close()
+        self.writer = HDF5Stream(self.hdf5_path)
+        self.writer.write('Info', self.hdf5_dict['Info'])
+        self.journal = Journal(journal_path(self.hdf5_path))
+        self.journal.write('setup', hdf5=self.hdf5_path, info=self.hdf5_dict['Info'])
             
-    def afm_scan(self):
-        self.neaConnect = NeaSNOMConnect('192.168.89.44', os.path.join(os.getcwd(), 'updates/SDK/'), con_needed = True)
-        self.neaConnect.bind_to('Progress', self.set_progress)
-        self.neaConnect.bind_to('Cur_Data', self.set_live_image)
+    def afm_scan(self, suffix=''):
+        try:
+            self.neaConnect
+        except AttributeError:
+            self.neaConnect = self.connect()
+            self.neaConnect.bind_to('Progress', self.set_progress)
+            self.neaConnect.bind_to('Cur_Data', self.set_live_image)
+            self.neaConnect.bind_to('Fourier', self.set_plot)
         
         self.hdf5_dict['Info']['Version'] = {}
         self.hdf5_dict['Info']['Version']['Client'] = self.neaConnect.client_version()
         self.hdf5_dict['Info']['Version']['Server'] = self.neaConnect.server_version()
+        if self.writer is not None:
+            self.write('Info/Version', self.hdf5_dict['Info']['Version'])
+        self.stage = ('Overview', self.hdf5_dict['Info']['AFM']['px'] * self.hdf5_dict['Info']['AFM']['py'], time.time())
         afm_data = self.neaConnect.scanAFM(**self.hdf5_dict['Info']['AFM'], channel_names = self.channel)
         print('Übersichtsscan ist fertig')
         if not afm_data == {}:
-            data_path = os.path.join(self.hdf5_dict['Info']['Measurement']['dest_path'], self.hdf5_dict['Info']['datetime'] + '_CSV')
-            os.makedirs(data_path, exist_ok = True)
-            for k in afm_data.keys():
-                afm_data[k] = asNumpyArray(afm_data[k])
-                np.savetxt(os.path.join(data_path, k + '.csv'), afm_data[k], delimiter=',')
+            data_path = unique_name(os.path.join(self.hdf5_dict['Info']['Measurement']['dest_path'], self.hdf5_dict['Info']['datetime'] + suffix), '_NPY')
+            afm_data = convert_channels(afm_data)
+            self.overview_path = data_path + '_NPY'
+            #with the settings, Batch.py can reprocess the directory on its own
+            self.pipeline.io(save_overview, self.overview_path, dict(afm_data), snapshot(self.hdf5_dict['Info']))
+            if self.csv_export:
+                self.exports.append(export_csv(data_path + '_CSV', afm_data, snapshot(self.hdf5_dict['Info'])))
         return afm_data
     
-    def compressed_scan(self):
-        self.scan_setup()
-        for x in range(5):
-            afm_data = self.afm_scan()
-            ratio = self.hdf5_dict['Info']['AFM']['dx'] / self.hdf5_dict['Info']['AFM']['px'] #um / px
-            f = FindBacteria(self.hdf5_dict['Info']['Characteristics'], ratio)
-            data = f.full_correction(afm_data['Z'], afm_data['R-Z'], self.hdf5_dict['Info']['AFM']['hlimit'] * 10**(-6))
-            contours = f.find_all_contours(data)
-            new_center = f.get_center(contours)
-            if old_center:
-                drift_x = new_center[0] - old_center[0]
-                drift_y = new_center[1] - old_center[1]
-                print('Drift: ', (drift_x, drift_y))
-                self.hdf5_dict['Info']['AFM']['x0'] += drift_x
-                self.hdf5_dict['Info']['AFM']['y0'] += drift_y
-            old_center = new_center
-            time.sleep(60)
+    def compressed_scan(self, repeats=5):
+        #the same area again and again, the drift from one scan to the next
+        #(phase correlation) moves the following scans along with the sample
+        self.scan_setup(1)
+        afm = self.hdf5_dict['Info']['AFM']
+        ratio = afm['dx'] / afm['px'] #um / px
+        f = FindBacteria(self.hdf5_dict['Info']['Characteristics'], ratio)
+        tracker = DriftTracker(ratio, self.drift_confidence)
+        for x in range(repeats):
+            start = time.time()
+            afm_data = self.afm_scan('_{}'.format(x + 1))
+            if not ('Z' in afm_data.keys() and 'R-Z' in afm_data.keys()):
+                break
+            data = f.full_correction(afm_data['Z'], afm_data['R-Z'], afm['hlimit'] * 10**(-6))
+            drift, confidence = tracker.update(data, start, (afm['x0'], afm['y0']))
+            print('Drift: ({:.3f}, {:.3f}) um, confidence {:.2f}'.format(drift[0], drift[1], confidence))
+            self.pipeline.io(self.set_bact_image, cv2.normalize(data, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U))
+            self.write('Data/Drift/Scan{}'.format(x + 1), {'AFM': afm_data, 'x0': afm['x0'], 'y0': afm['y0'], 'Time': start,
+                                                           'Drift': drift, 'Confidence': confidence})
+            if x == repeats - 1:
+                break
+            while time.time() - start < self.drift_interval and not self.aborted:
+                time.sleep(0.5)
+            if self.aborted:
+                break
+            (afm['x0'], afm['y0']) = (round(v, 3) for v in tracker.next_position(time.time()))
+        self.pipeline.drain()
         
+    def measure_bacterium(self, key, bact, f, ratio, done=()):
+        #refinement scan (if needed) and Fourier scans of the points of one
+        #bacterium, points in done were measured before (resume)
+        img_path = 'Data/Bacteria/{}/Meassurement_Points_IMG'.format(key)
+        (x0, y0) = bact['Points']['Center']['Coord']
+        dxy = bact['dxy']
+        res = bact['pxy']
         
+        try:
+            self.pipeline.io(self.set_cur_image, self.read(img_path))
+        except KeyError:
+            pass
+        
+        overview = {k: p['Coord'] for k, p in bact['Points'].items() if 'Coord' in p}
+        overview_cand = bact.get('Reference_Candidates')
+        done = set(done)
+        if all(k in done for k in overview.keys()):
+            return
+        self.neaConnect.set_meas_completed(False)
+        while not self.neaConnect.get_meas_completed():
+            if self.aborted:
+                raise ScanAbortException()
+            now = time.time()
+            offset, offset_std = self.drift_model.predict(now)
+            rescan = self.drift_model.needs_rescan(now, self.rescan_threshold, self.rescan_age)
+            if rescan:
+                #centred where the bacterium is expected now
+                sx0 = round(x0 + offset[0], 2)
+                sy0 = round(y0 + offset[1], 2)
+                self.stage = ('Refinement {}'.format(key), res * res, time.time())
+                spec_data = self.neaConnect.scanAFM(sx0, sy0, dxy, dxy, res, res, 0, self.hdf5_dict['Info']['AFM']['t_int'], self.hdf5_dict['Info']['AFM']['setpoint'],
+                                            self.hdf5_dict['Info']['AFM']['hlimit'], channel_names = self.channel)
+                if self.aborted:
+                    raise ScanAbortException()
+                
+                spec_data = convert_channels(spec_data)
+                self.write('Data/Bacteria/{}/AFM'.format(key), spec_data)
+                
+                data = f.full_correction(spec_data['Z'], spec_data['R-Z'], self.hdf5_dict['Info']['AFM']['hlimit'] * 10**(-6))
+                bac_still_there = f.find_bacteria(data, self.hdf5_dict['Info']['AFM']['hlimit'] * 10**(-6))
+                small_bact_dict = f.get_dict()
+                
+                if bac_still_there:
+                    for k in small_bact_dict['Bacteria']['Bacteria1']['Points'].keys():
+                        newx = ((small_bact_dict['Bacteria']['Bacteria1']['Points'][k]['Coord'][0] * ratio) - (dxy / 2)) + sx0
+                        newy = ((small_bact_dict['Bacteria']['Bacteria1']['Points'][k]['Coord'][1] * ratio) - (dxy / 2)) + sy0
+                        bact['Points'][k]['Coord'] = (newx, newy)
+                    if 'Reference_Candidates' in small_bact_dict['Bacteria']['Bacteria1']:
+                        cand = small_bact_dict['Bacteria']['Bacteria1']['Reference_Candidates'] * ratio
+                        bact['Reference_Candidates'] = cand + (sx0 - (dxy / 2), sy0 - (dxy / 2))
+                    #the refined centre is a measurement of the drift since the overview
+                    (cx, cy) = bact['Points']['Center']['Coord']
+                    self.drift_model.update(now, (cx - x0, cy - y0))
+            else:
+                #the model knows the drift well enough, no refinement scan
+                bac_still_there = True
+                print('{}: no refinement scan, predicted drift ({:.3f}, {:.3f}) um +- {:.3f} um'.format(key, offset[0], offset[1], offset_std))
+                for k in overview.keys():
+                    bact['Points'][k]['Coord'] = (round(overview[k][0] + offset[0], 2), round(overview[k][1] + offset[1], 2))
+                if overview_cand is not None:
+                    bact['Reference_Candidates'] = np.round(overview_cand + offset, 2)
+            
+            if bac_still_there:
+                bact['Drift'] = {'Offset': offset, 'Std': offset_std, 'Rescan': int(rescan), 'Time': now}
+                if self.plan_path:
+                    bact['Points'] = order_points(bact['Points'], bact['Points']['Center']['Coord'])
+                #points measured before keep their entry in the file
+                self.write('Data/Bacteria/' + key, dict(bact, Points={k: p for k, p in bact['Points'].items() if k not in done}))
+                
+                        
+                for k in bact['Points'].keys():
+                    if k in done:
+                        continue
+                    #x0, y0, dx, dy, x_res, y_res, angle, t_int, offset, distance, averaging, resolution, source, channel_names
+                    print(k)
+                    self.stage = ('Fourier {} {}'.format(key, k), 0, time.time())
                     
+                    start = time.time()
+                    fourier_data = self.neaConnect.scan_fourier(bact['Points'][k]['Coord'][0], bact['Points'][k]['Coord'][1], 0, 0,
+                                                            **self.hdf5_dict['Info']['Fourier'], channel_names = self.channel)
+                    if self.aborted:
+                        raise ScanAbortException()
+                    if self.neaConnect.get_wait_for_injection():
+                        print('Unterbrochen wegen Epics')
+                        break
+                    bact['Points'][k].update(self.current_window(start, time.time()))
+                    
+                    #converted and written while the next point is measured
+                    fourier_data = self.pipeline.compute(convert_channels, fourier_data)
+                    self.pipeline.io(self.write_point, 'Data/Bacteria/{}/Points/{}'.format(key, k),
+                                     dict(bact['Points'][k]), fourier_data)
+                    #journaled once it is in the file
+                    self.pipeline.io(self.journal.write, 'point', bacterium=key, point=k)
+                    self.pipeline.io(self.set_point_spectrum, fourier_data)
+                    done.add(k)
+                    self.points_measured += 1
+                        
+            else:
+                print('Bacteria could not be identified. Drift seems to be too strong')
+                break
+
+            while self.neaConnect.get_wait_for_injection() and not self.aborted:
+                time.sleep(0.5)
+
     def full_scan(self, step, csv_path=''):
         try:
             self.scan_setup(step)
@@ -271,21 +663,24 @@ class Scan:
                 
             if new_meas:
                 afm_data = self.afm_scan()
+                if self.aborted:
+                    raise ScanAbortException()
             else:
-                afm_data = {}
-                for root, dirs, files in os.walk(csv_path):
-                    for f in files:
-                        c = f.split('.')[0]
-                        afm_data[c] = np.loadtxt(os.path.join(root, f), delimiter=',')
+                #_NPY or _CSV overview directory or a previous .hdf5 file
+                afm_data = load_overview(csv_path)
+                self.overview_path = csv_path
+            self.write('Data/AFM', afm_data)
+            #journaled on the I/O thread, after the overview is saved
+            self.pipeline.io(self.journal.write, 'overview', path=self.overview_path)
                 
             if 'Z' in afm_data.keys() and 'R-Z' in afm_data.keys():
-                self.set_afm_image(afm_data['Z'])
+                self.pipeline.io(self.set_afm_image, afm_data['Z'])
                 ratio = self.hdf5_dict['Info']['AFM']['dx'] / self.hdf5_dict['Info']['AFM']['px'] #um / px
                 f = FindBacteria(self.hdf5_dict['Info']['Characteristics'], ratio)
                 data = f.full_correction(afm_data['Z'], afm_data['R-Z'], self.hdf5_dict['Info']['AFM']['hlimit'] * 10**(-6))
                 bac_found = f.find_bacteria(data, self.hdf5_dict['Info']['AFM']['hlimit'] * 10**(-6))
                 bact_dict = f.get_dict()
-                self.set_bact_image(bact_dict['Bacteria_IMG'])
+                self.pipeline.io(self.set_bact_image, bact_dict['Bacteria_IMG'])
                 if bac_found:
                     for key in bact_dict['Bacteria'].keys():
                         #get the absolute coords for the relative points
@@ -295,80 +690,115 @@ class Scan:
                             newx = round(newx, 2)
                             newy = round(newy, 2)
                             bact_dict['Bacteria'][key]['Points'][k]['Coord'] = (newx, newy)
-                            
+                        if 'Reference_Candidates' in bact_dict['Bacteria'][key]:
+                            cand = bact_dict['Bacteria'][key]['Reference_Candidates'] * ratio
+                            cand[:, 0] += self.hdf5_dict['Info']['AFM']['x0'] - (self.hdf5_dict['Info']['AFM']['dx'] / 2)
+                            cand[:, 1] += self.hdf5_dict['Info']['AFM']['y0'] - (self.hdf5_dict['Info']['AFM']['dy'] / 2)
+                            bact_dict['Bacteria'][key]['Reference_Candidates'] = np.round(cand, 2)
+                    if self.plan_path:
+                        #visit the bacteria and their points with the least stage travel
+                        bact_dict['Bacteria'], bact_dict['Path'] = plan_measurement(bact_dict['Bacteria'], (self.hdf5_dict['Info']['AFM']['x0'], self.hdf5_dict['Info']['AFM']['y0']))
+                        print('Path: {} um instead of {} um'.format(bact_dict['Path']['Travel_Planned'], bact_dict['Path']['Travel_Detection']))
+                    
+                #the detection goes to the file now, the previews are read back when needed
+                for k in bact_dict.keys():
+                    self.write('Data/' + k, bact_dict[k])
+                if bac_found:
+                    self.journal_detection(bact_dict['Bacteria'])
+                bact_dict.pop('Contours_IMG', None)
+                bact_dict.pop('Bacteria_IMG', None)
+                if bac_found:
+                    for key in bact_dict['Bacteria'].keys():
+                        bact_dict['Bacteria'][key].pop('Meassurement_Points_IMG', None)
+                        img_path = 'Data/Bacteria/{}/Meassurement_Points_IMG'.format(key)
+                        
                         if new_meas:
-                            (x0, y0) = bact_dict['Bacteria'][key]['Points']['Center']['Coord']
-                            dxy = bact_dict['Bacteria'][key]['dxy']
-                            res = bact_dict['Bacteria'][key]['pxy']
-                            
-                            self.set_cur_image(bact_dict['Bacteria'][key]['Meassurement_Points_IMG'])
-                            
-                            ##hier neu starten
-                            
-                            while not self.neaConnect.get_meas_completed():
-                                spec_data = self.neaConnect.scanAFM(x0, y0, dxy, dxy, res, res, 0, self.hdf5_dict['Info']['AFM']['t_int'], self.hdf5_dict['Info']['AFM']['setpoint'],
-                                                            self.hdf5_dict['Info']['AFM']['hlimit'], channel_names = self.channel)
-                                
-                                bact_dict['Bacteria'][key]['AFM'] = {}
-                                for k in spec_data.keys():
-                                    spec_data[k] = asNumpyArray(spec_data[k])
-                                    bact_dict['Bacteria'][key]['AFM'][k] = spec_data[k]
-                                
-                                data = f.full_correction(spec_data['Z'], spec_data['R-Z'], self.hdf5_dict['Info']['AFM']['hlimit'] * 10**(-6))
-                                bac_still_there = f.find_bacteria(data, self.hdf5_dict['Info']['AFM']['hlimit'] * 10**(-6))
-                                small_bact_dict = f.get_dict()
-                                
-                                if bac_still_there:
-                                    for k in small_bact_dict['Bacteria']['Bacteria1']['Points'].keys():
-                                        newx = ((small_bact_dict['Bacteria']['Bacteria1']['Points'][k]['Coord'][0] * ratio) - (dxy / 2)) + x0
-                                        newy = ((small_bact_dict['Bacteria']['Bacteria1']['Points'][k]['Coord'][1] * ratio) - (dxy / 2)) + y0
-                                        bact_dict['Bacteria'][key]['Points'][k]['Coord'] = (newx, newy)
-                                    
-                                            
-                                    for k in bact_dict['Bacteria'][key]['Points'].keys():
-                                        #x0, y0, dx, dy, x_res, y_res, angle, t_int, offset, distance, averaging, resolution, source, channel_names
-                                        self.neaConnect.bind_to('Fourier', self.set_plot)
-                                        bact_dict['Bacteria'][key]['Points'][k]['Current'] = epics.caget('CUM1ZK3RP:rdCur')
-                                        print(k)
-                                        
-                                        fourier_data = self.neaConnect.scan_fourier(bact_dict['Bacteria'][key]['Points'][k]['Coord'][0], bact_dict['Bacteria'][key]['Points'][k]['Coord'][1], 0, 0,
-                                                                                **self.hdf5_dict['Info']['Fourier'], channel_names = self.channel)
-                                        if self.neaConnect.get_wait_for_injection():
-                                            print('Unterbrochen wegen Epics')
-                                            break
-                                        
-                                        for fk in fourier_data.keys():
-                                            fourier_data[fk] = asNumpyArray(fourier_data[fk])
-                                            bact_dict['Bacteria'][key]['Points'][k][fk] = fourier_data[fk]
-                                            
-                                else:
-                                    print('Bacteria could not be identified. Drift seems to be too strong')
-
-                                while self.neaConnect.get_wait_for_injection():
-                                    time.sleep(0.5)
+                            self.measure_bacterium(key, bact_dict['Bacteria'][key], f, ratio)
                                         
                         else:
-                            self.set_cur_image(bact_dict['Bacteria'][key]['Meassurement_Points_IMG'])
+                            self.pipeline.io(self.set_cur_image, self.read(img_path))
                 
                 self.hdf5_dict['Data'] = bact_dict
             
             else:
                 print('Z and/or R-Z is not in Channel, therefore can not proceed.')
-
-            self.hdf5_dict['Data']['AFM'] = afm_data
+            self.pipeline.drain()
+            if self.aborted:
+                raise ScanAbortException()
+            self.journal.write('done')
         except ScanAbortException:
             return
         
     
+    def journal_detection(self, bacteria):
+        #positions (overview frame) and scan sizes of the bacteria, in measurement order
+        detection = {}
+        for key in bacteria.keys():
+            detection[key] = {'Points': {k: {'Coord': p['Coord']} for k, p in bacteria[key]['Points'].items() if 'Coord' in p}}
+            for k in ['dxy', 'pxy', 'Reference_Candidates']:
+                if k in bacteria[key]:
+                    detection[key][k] = bacteria[key][k]
+        #after the overview entry, which is still queued on the I/O thread
+        self.pipeline.io(self.journal.write, 'detection', bacteria=detection)
+
+    def resume_scan(self, path):
+        '''
+        Continues the measurement of a journal: a new overview at the same
+        position is registered against the stored one, the drift found
+        there goes into the drift model and the bacteria are measured from
+        the first point that is not in the journal on.
+        '''
+        try:
+            state = Journal.load(path)
+            if state['done'] or not state['bacteria']:
+                print('Nothing to resume in', path)
+                return
+            self.hdf5_dict['Info'] = state['info']
+            self.channel = state['info']['Channel']
+            self.hdf5_path = state['hdf5']
+            self.set_log()
+            self.writer = HDF5Stream(self.hdf5_path, mode='a')
+            self.journal = Journal(path, mode='a')
+            self.journal.write('resume')
+            
+            afm = self.hdf5_dict['Info']['AFM']
+            ratio = afm['dx'] / afm['px'] #um / px
+            f = FindBacteria(self.hdf5_dict['Info']['Characteristics'], ratio)
+            stored = load_overview(state['overview'] if state['overview'] else self.hdf5_path)
+            reference = f.full_correction(stored['Z'], stored['R-Z'], afm['hlimit'] * 10**(-6))
+            start = time.time()
+            afm_data = self.afm_scan('_resume')
+            if self.aborted:
+                raise ScanAbortException()
+            if not ('Z' in afm_data.keys() and 'R-Z' in afm_data.keys()):
+                return
+            self.pipeline.io(self.set_afm_image, afm_data['Z'])
+            data = f.full_correction(afm_data['Z'], afm_data['R-Z'], afm['hlimit'] * 10**(-6))
+            (dx, dy), confidence = phase_shift(reference, data)
+            offset = (dx * ratio, dy * ratio)
+            print('Drift since the overview: ({:.3f}, {:.3f}) um, confidence {:.2f}'.format(offset[0], offset[1], confidence))
+            if confidence >= self.drift_confidence:
+                self.drift_model.update(start, offset)
+            self.write('Data/Resume', {'AFM': afm_data, 'Offset': offset, 'Confidence': confidence, 'Time': start})
+            
+            for key, bact in state['bacteria'].items():
+                self.measure_bacterium(key, bact, f, ratio, done=state['points'].get(key, []))
+            self.pipeline.drain()
+            if self.aborted:
+                raise ScanAbortException()
+            self.journal.write('done')
+        except ScanAbortException:
+            return
+    
     def test_fourier(self):
         self.set_bact_image(np.zeros(self.preview_size))
         self.set_cur_image(np.zeros(self.preview_size))
         for callback in self.observers['hide_plot']:
             callback('show_plot')
-        self.neaConnect = NeaSNOMConnect('192.168.89.44', os.path.join(os.getcwd(), 'updates/SDK/'), con_needed = True)
+        self.neaConnect = self.connect()
         self.neaConnect.bind_to('Fourier', self.set_plot)
         while not self.neaConnect.get_meas_completed():
-            while self.neaConnect.get_wait_for_injection():
+            while self.neaConnect.get_wait_for_injection() and not self.aborted:
                 time.sleep(0.5)
             if not self.neaConnect.get_meas_completed():
                 fourier_data = self.neaConnect.scan_fourier(52.002673267326735, 49.87623762376238, 0, 0, 1, 1, 0, 20, 510, 800, 2, 700, 'Synchrotron', ['Z', 'O1A', 'O2A'])
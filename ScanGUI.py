@@ -3,12 +3,7 @@ from tkinter import ttk
 from tkinter import filedialog
 from tkinter import messagebox
 import h5py as hdf5
-from PIL import Image
 from contextlib import redirect_stdout
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.animation as animation
-import io
 import cv2
 import numbers
 import os
@@ -18,24 +13,8 @@ import threading
 import queue
 from Scan import *
 from Epics_Control import Epics_Control
-
-class StdoutRedirector(object):
-    def __init__(self,text_widget, stream):
-        self.text_space = text_widget
-        self.stream = stream
-
-    def write(self, string):
-        self.text_space.insert('end', string)
-        self.text_space.see('end')
-        self.stream.flush()
-        
-    def writelines(self, strings):
-        self.text_space.insert('end', strings)
-        self.text_space.see('end')
-        self.stream.flush()
-    
-    def __getattr__(self, attr):
-        return getattr(self.stream, attr)
+from LogConsole import LogConsole
+from Preview import LivePlot, PlotPreview, ImagePreview, colormap_lut
 
 def read_config(cfg_path):
     keys = ['Info', 'AFM', 'Fourier', 'Channel', 'Characteristics', 'Measurement']
@@ -230,6 +209,12 @@ class start_scan(tk.Tk):
         self.make_entry(self.char_frame, 3, 1, 'Corona')
         self.make_entry(self.char_frame, 3, 3, 'Climit')
         
+        self.make_entry(self.char_frame, 4, 1, 'Plane_order')
+        self.make_entry(self.char_frame, 4, 3, 'Plane_mask')
+        
+        self.make_entry(self.char_frame, 5, 1, 'Stripe_mode')
+        self.make_entry(self.char_frame, 5, 3, 'Line_order')
+        
         
         
         #Start Button and Iteration control
@@ -242,7 +227,7 @@ class start_scan(tk.Tk):
         self.csv_button = tk.Button(self.button_frame, text='Browse', command=self.browse_csv, state='disabled')
         self.csv_button.grid(row = 0, column = 2, sticky=tk.N + tk.S + tk.E + tk.W)
         self.csv_value = tk.IntVar()
-        self.csv_check = tk.Checkbutton(self.button_frame, text='Use CSV', variable=self.csv_value, command=self.csv_change)
+        self.csv_check = tk.Checkbutton(self.button_frame, text='Use Overview', variable=self.csv_value, command=self.csv_change)
         self.csv_check.grid(row = 0, column = 3, sticky=tk.N + tk.S + tk.E + tk.W)
         self.repeat_label = tk.Label(self.button_frame, text = 'Iterations')
         self.repeat_label.grid(row = 1, column = 0, sticky=tk.N + tk.S + tk.E + tk.W)
@@ -255,6 +240,18 @@ class start_scan(tk.Tk):
         self.make_entry(self.button_frame, 2, 0, 'Dest_path')
         self.dest_button = tk.Button(self.button_frame, text='Browse', command=self.browse_destination)
         self.dest_button.grid(row = 2, column = 2, sticky=tk.N + tk.S + tk.E + tk.W)
+        self.make_entry(self.button_frame, 3, 0, 'Csv_export')
+        self.make_entry(self.button_frame, 3, 2, 'Plan_path')
+        self.make_entry(self.button_frame, 4, 0, 'Drift_interval')
+        self.make_entry(self.button_frame, 4, 2, 'Rescan_threshold')
+        self.make_entry(self.button_frame, 5, 0, 'Rescan_age')
+        self.make_entry(self.button_frame, 6, 0, 'Plot_interval')
+        self.make_entry(self.button_frame, 6, 2, 'Colormap')
+        self.make_entry(self.button_frame, 7, 0, 'Poll_min')
+        self.make_entry(self.button_frame, 7, 2, 'Poll_max')
+        self.make_entry(self.button_frame, 8, 0, 'Publish_interval')
+        self.resume_button = tk.Button(self.button_frame, text='Resume', command=self.resume_scan)
+        self.resume_button.grid(row = 5, column = 3, sticky=tk.N + tk.S + tk.E + tk.W)
         
         
         self.fill_form()
@@ -264,8 +261,8 @@ class start_scan(tk.Tk):
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            self.scan.__exit__('abort', exc_val, exc_tb)
-        except (AttributeError, RecursionError):
+            self.abort_scan()
+        except RecursionError:
             pass
         try:
             self.loop_var = False
@@ -277,12 +274,10 @@ class start_scan(tk.Tk):
         while self.message_queue.empty() is False:
             message, data = self.message_queue.get(block=False)
             if message == 'quit_scan':
-                sys.stdout = sys.__stdout__
+                self.restore_stdout()
                 self.start_button.config(state='normal')
-                try:
-                    self.scan.__exit__('abort', None, None)
-                except AttributeError:
-                    pass
+                self.abort_scan()
+                self.stop_epics()
                 self.scan_window.destroy()
             if message == 'pause_scan':
                 self.pause_meas()
@@ -464,8 +459,14 @@ class start_scan(tk.Tk):
                              'R-M3A': 1, 'R-M3P': 1, 'R-O3A': 1, 'R-O3P': 1, 'R-M4A': 1, 'R-M4P': 1,
                              'R-O4A': 1, 'R-O4P': 1, 'R-M5A': 1, 'R-M5P': 1, 'R-O5A': 1, 'R-O5P': 1}
         config['Characteristics'] = {'Length': '1.8; 5', 'Width': '0.5; 1.3',
-                                     'Height': '0.3; 0.6', 'Corona': 0.5, 'CLimit': 0.2}
-        config['Measurement'] = {'Iterations': 1, 'dest_path': os.getcwd(), 'csv_path': ''}
+                                     'Height': '0.3; 0.6', 'Corona': 0.5, 'CLimit': 0.2,
+                                     'Plane_order': 1, 'Plane_mask': 0,
+                                     'Stripe_mode': 'diff', 'Line_order': 1}
+        config['Measurement'] = {'Iterations': 1, 'dest_path': os.getcwd(), 'csv_path': '',
+                                 'csv_export': 0, 'plan_path': 1,
+                                 'drift_interval': 60, 'rescan_threshold': 0.1, 'rescan_age': 600,
+                                 'plot_interval': 100, 'colormap': 'gray',
+                                 'poll_min': 5, 'poll_max': 100, 'publish_interval': 200}
         with open(self.scan_path, 'w') as file:
             config.write(file)
             
@@ -478,7 +479,7 @@ class start_scan(tk.Tk):
             self.entries['Dest_path'].insert(0, dirname)
             
     def browse_csv(self):
-        dirname = filedialog.askdirectory(initialdir=os.getcwd(),title='Please select a directory in which there are the CSV Files')
+        dirname = filedialog.askdirectory(initialdir=os.getcwd(),title='Please select an overview directory (_NPY or _CSV)')
         if not dirname:
             return
         else:
@@ -507,12 +508,28 @@ class start_scan(tk.Tk):
             self.meas_paused = True
             self.scan.pause()
     
-    def close_scan_window(self):
-        self.scan_aborted = True
+    def restore_stdout(self):
         sys.stdout = sys.__stdout__
+        try:
+            self.console.close()
+        except AttributeError:
+            pass
+    
+    def abort_scan(self):
+        #The scan thread closes the scan: Scan.__exit__ waits for the worker
+        #threads, which may still hand data to the Tk thread.
+        self.scan_aborted = True
+        try:
+            self.scan.abort()
+        except AttributeError:
+            pass
+    
+    def close_scan_window(self):
+        self.restore_stdout()
         self.loop_var = False
         self.start_button.config(state='normal')
-        self.scan.__exit__('abort', None, None)
+        self.abort_scan()
+        self.stop_epics()
         self.scan_completed = True
         self.scan_window.destroy()
     
@@ -551,6 +568,7 @@ class start_scan(tk.Tk):
         self.create_scan_window()
         self.scan_thread = threading.Thread(target=self.start_compressed)
         self.scan_completed = False
+        self.scan_aborted = False
         self.scan_thread.start()
         
     def complete_scan(self):
@@ -569,18 +587,38 @@ class start_scan(tk.Tk):
         self.scan_thread = threading.Thread(target=self.start_scan, args=(self.entries['Csv_path'].get(), repeats))
         #self.scan_thread = threading.Thread(target=self.test_fourier)
         self.scan_completed = False
+        self.scan_aborted = False
         self.scan_thread.start()
         self.check_epics = True
         if self.check_epics:
             self.epics_thread = threading.Thread(target=self.check_for_epics)
             self.epics_thread.start()
         
+    def resume_scan(self):
+        path = filedialog.askopenfilename(initialdir=self.entries['Dest_path'].get() or os.getcwd(), title='Please select the journal of the interrupted scan',
+                                          filetypes=[('Journal', '*.journal')])
+        if not path:
+            return
+        self.update_dict()
+        self.start_button.config(state='disabled')
+        self.images = {}
+        for label in self.IMAGE_LABEL:
+            self.images[label] = tk.PhotoImage(master=self.window)
+        self.create_scan_window()
+        self.scan_thread = threading.Thread(target=self.start_resume, args=(path,))
+        self.scan_completed = False
+        self.scan_aborted = False
+        self.scan_thread.start()
+        self.epics_thread = threading.Thread(target=self.check_for_epics)
+        self.epics_thread.start()
+        
     def create_scan_window(self):
         self.scan_window = tk.Toplevel(self.window)
         self.scan_window.protocol("WM_DELETE_WINDOW", self.close_scan_window)
         self.window_text = tk.Text(self.scan_window, wrap='word', height = 11, width=50)
         self.window_text.grid(column=0, row=3, columnspan = 2, sticky='NSWE')
-        sys.stdout = StdoutRedirector(self.window_text, sys.stdout)
+        self.console = LogConsole(self.window_text, sys.stdout)
+        sys.stdout = self.console
         self.meas_paused = False
         self.window_pause_txt = tk.StringVar()
         self.window_pause = tk.Button(self.scan_window, textvariable=self.window_pause_txt, command=self.pause_meas)
@@ -595,19 +633,16 @@ class start_scan(tk.Tk):
         self.window_percent.set('0 / {}'.format(int(self.num_of_px)))
         self.window_percent_label = tk.Label(self.scan_window, textvariable=self.window_percent)
         self.window_percent_label.grid(column=1, row=5, columnspan=2, sticky='NSWE')
+        self.progress_value = 0
+        self.scan_window.after(100, self.show_progress)
         #GUI for Previews
         self.live_plot = tk.Label(self.scan_window, relief='sunken')
         self.live_plot.grid(column=0, row=1, columnspan=3, sticky='NSWE')
-        self.fig = plt.figure(figsize=(10, 4), dpi=100)
-        self.ax = self.fig.add_subplot(1,1,1)
-        self.ax.yaxis.set_visible(False)
-        self.ax.xaxis.set_visible(False)
-        self.fig.tight_layout()
-        self.canvas = FigureCanvasTkAgg(self.fig, master = self.live_plot)
-        self.canvas._tkcanvas.pack(side = tk.TOP, fill = tk.BOTH, expand = 1)
-        self.avrg_pointer = 0
-        self.plot_data = np.zeros((1, 100))
-        self.ani = animation.FuncAnimation(self.fig, self.animate_plot, interval=100)
+        self.plot_view = LivePlot(self.live_plot, int(self.scan_dict['Measurement'].get('plot_interval', 100)))
+        if 'plot' in self.images:
+            self.plot_preview = PlotPreview(self.images['plot'], self.scan_window)
+        lut = colormap_lut(self.scan_dict['Measurement'].get('colormap', 'gray'))
+        self.previews = {name: ImagePreview(image, self.scan_window, lut) for name, image in self.images.items() if name != 'plot'}
         self.plot_select = ttk.Combobox(self.scan_window, values=[x.upper() for x in self.scan_dict['Channel'].keys() if self.scan_dict['Channel'][x] == 1], state='readonly')
         self.plot_select.grid(column=2, row=0, sticky='NSW')
         self.plot_select.set('O2A')
@@ -635,87 +670,96 @@ class start_scan(tk.Tk):
         self.right_select.bind("<<ComboboxSelected>>", self.set_view_Right)
     
     def start_scan(self, path, count):
-        self.scan_aborted = False
         for x in range(count):
             if not self.scan_completed:
                 self.scan = Scan(copy.deepcopy(self.scan_dict))
+                self.bind_current()
                 for label in self.IMAGE_LABEL:
                     self.scan.bind_to(label, self.update_image)
                 self.scan.bind_to('progress', self.update_progress)
                 self.scan.bind_to('live_plot', self.update_plot)
+                self.scan.bind_to('log', self.console.set_log_file)
                 self.scan.full_scan(x+1, path)
-                self.scan.__exit__(None, None, None)
+                self.scan.__exit__('abort' if self.scan_aborted else None, None, None)
         if not self.scan_aborted:
             print('Alles Fertig')
         self.scan_completed = True
         
+    def start_resume(self, path):
+        self.scan = Scan(copy.deepcopy(self.scan_dict))
+        self.bind_current()
+        for label in self.IMAGE_LABEL:
+            self.scan.bind_to(label, self.update_image)
+        self.scan.bind_to('progress', self.update_progress)
+        self.scan.bind_to('live_plot', self.update_plot)
+        self.scan.bind_to('log', self.console.set_log_file)
+        self.scan.resume_scan(path)
+        self.scan.__exit__('abort' if self.scan_aborted else None, None, None)
+        self.scan_completed = True
+        
     def test_fourier(self):
         self.scan = Scan(copy.deepcopy(self.scan_dict))
         self.scan.bind_to('live_plot', self.update_plot)
         self.scan.bind_to('bact', self.update_image)
         self.scan.bind_to('points', self.update_image)
-        self.fig = plt.figure(figsize=(10,4), dpi=100)
-        self.ax = self.fig.add_subplot(1,1,1)
-        self.ax.yaxis.set_visible(False)
-        self.ax.xaxis.set_visible(False)
-        self.fig.tight_layout()
-        self.canvas = FigureCanvasTkAgg(self.fig, master = self.live_plot)
-        self.canvas._tkcanvas.pack(side = tk.TOP, fill = tk.BOTH, expand = 1)
-        self.avrg_pointer = 0
-        self.plot_data = np.zeros((1, 100))
-        self.ani = animation.FuncAnimation(self.fig, self.animate_plot, interval=100)
+        self.plot_view = LivePlot(self.live_plot, int(self.scan_dict['Measurement'].get('plot_interval', 100)))
         self.scan.test_fourier()
         self.scan.__exit__('abort', None, None)
     
     def start_compressed(self):
         self.scan = Scan(copy.deepcopy(self.scan_dict))
-        self.scan.bind_to('Progress', self.update_progress)
-        self.scan.bind_to('Live', self.update_image)
-        self.scan.bind_to('Bact', self.update_image)
-        self.scan.bind_to('Cur_Bact', self.update_image)
-        self.scan.compressed_scan()
+        self.scan.bind_to('progress', self.update_progress)
+        self.scan.bind_to('live_afm', self.update_image)
+        self.scan.bind_to('bact', self.update_image)
+        self.scan.bind_to('log', self.console.set_log_file)
+        self.scan.compressed_scan(int(self.scan_dict['Measurement']['iterations']))
+        self.scan.__exit__('abort' if self.scan_aborted else None, None, None)
         self.scan_completed = True
     
     def update_progress(self, progress):
-        self.progress.set(progress)
-        self.window_percent.set('{} / {}'.format(int(progress * self.num_of_px), int(self.num_of_px)))
+        #publisher thread, show_progress puts it into the window
+        self.progress_value = progress
+    
+    def show_progress(self):
+        if not self.scan_window.winfo_exists():
+            return
+        self.progress.set(self.progress_value)
+        self.window_percent.set('{} / {}'.format(int(self.progress_value * self.num_of_px), int(self.num_of_px)))
+        self.scan_window.after(100, self.show_progress)
     
     def update_image(self, name, image):
         if name == 'plot':
-            with io.BytesIO() as output:
-                data = image[0, 0]
-                fig = plt.figure(figsize=(4,4), dpi=100)
-                ax = fig.add_subplot(1,1,1)
-                ax.xaxis.set_visible(False)
-                ax.yaxis.set_visible(False)
-                ax.plot(data[-1])
-                fig.tight_layout()
-                plt.savefig(output, format='png')
-                plt.clf()
-                self.images['plot'].put(output.getvalue())
+            self.plot_preview.post(np.array(image[0, 0][-1]))
         else:
-            with io.BytesIO() as output:
-                Image.fromarray(image).save(output, format='GIF')
-                self.images[name].put(output.getvalue())
+            self.previews[name].show(image)
     
     def update_plot(self, raw):
-        self.plot_data = asNumpyArray(raw)[0, 0]
-    
-    def animate_plot(self, i):
-        self.ax.clear()
-        for x in range(len(self.plot_data)-1, 0, -1):
-            if not all(np.isnan(self.plot_data[x])):
-                self.avrg_pointer = x
-                break
-        if self.avrg_pointer > 0:
-            self.ax.plot(self.plot_data[self.avrg_pointer-1], 'b', linewidth=0.5, alpha=0.2)
-        self.ax.plot(self.plot_data[self.avrg_pointer], 'r', linewidth=0.5)
+        #the view is only valid in this thread, set_data copies the trace
+        self.plot_view.set_data(self.scan.converter.convert(raw, 'live_plot', view=True)[0, 0])
         
     def check_for_epics(self):
-        epics_ctrl = Epics_Control()
-        epics_ctrl.bind_to(self.send_message_to_ui)
+        #one monitor at a time, the one of the last scan may still run
+        self.stop_epics()
+        self.epics_ctrl = Epics_Control()
+        self.epics_ctrl.bind_to(self.send_message_to_ui)
+        self.bind_current()
+    
+    def stop_epics(self):
+        try:
+            self.epics_ctrl.stop()
+            del self.epics_ctrl
+        except AttributeError:
+            pass
+    
+    def bind_current(self):
+        #the Fourier points take the beam current from the pv monitor
+        try:
+            self.scan.set_current_buffer(self.epics_ctrl.current)
+        except AttributeError:
+            pass
         
         
 
-with start_scan() as scan:
-    scan.window.mainloop()
+if __name__ == '__main__':
+    with start_scan() as scan:
+        scan.window.mainloop()
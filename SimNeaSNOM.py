@@ -0,0 +1,356 @@
+import time
+import numpy as np
+from NeaSNOMConnect import NeaSNOMConnect
+
+#Simulated neaSNOM. The classes below mimic the parts of the neaSDK objects
+#that NeaSNOMConnect uses (Connection, Microscope, AfmScan/FourierScan, Image,
+#Channel), so the normal scanAFM/scan_fourier polling loops run unchanged.
+#All times are simulated times, divided by `speed` to get the wall clock.
+
+class SimSample:
+    def __init__(self, size=100., center=(50., 50.), bacteria=400, length=(1.8, 5.), width=(0.5, 1.3),
+                 height=(0.3, 0.6), drift=(0.002, -0.001), tilt=(2e-9, -1e-9), stripes=5e-9,
+                 noise=2e-9, lifetime=6*3600., seed=None):
+        #lengths in um, heights and noise in m, drift in um per simulated second,
+        #tilt in m per um
+        self.rng = np.random.default_rng(seed)
+        self.size = size
+        self.center = center
+        n = int(bacteria)
+        self.pos = np.column_stack((self.rng.uniform(center[0] - size / 2, center[0] + size / 2, n),
+                                    self.rng.uniform(center[1] - size / 2, center[1] + size / 2, n)))
+        self.length = self.rng.uniform(length[0], length[1], n)
+        self.width = self.rng.uniform(width[0], width[1], n)
+        self.height = self.rng.uniform(height[0], height[1], n) * 10**(-6)
+        self.angle = self.rng.uniform(0, np.pi, n)
+        self.drift = np.asarray(drift, float)
+        self.tilt = tilt
+        self.stripes = stripes
+        self.noise = noise
+        self.lifetime = lifetime
+        self.speed = 1.
+        self._t0 = time.time()
+
+    def set_speed(self, speed):
+        #keep the simulated time continuous when the speed changes
+        now = self.sim_time()
+        self.speed = speed
+        self._t0 = time.time() - now / speed
+
+    def sim_time(self):
+        return (time.time() - self._t0) * self.speed
+
+    def offset(self):
+        return self.drift * self.sim_time()
+
+    def current(self):
+        return 200. * np.exp(-self.sim_time() / self.lifetime)
+
+    def topography(self, X, Y):
+        #X, Y are stage coordinates in um, returns the height in m
+        off = self.offset()
+        sx = X - off[0]
+        sy = Y - off[1]
+        z = self.tilt[0] * (sx - self.center[0]) + self.tilt[1] * (sy - self.center[1])
+        reach = self.length.max() / 2
+        near = ((self.pos[:, 0] > sx.min() - reach) & (self.pos[:, 0] < sx.max() + reach) &
+                (self.pos[:, 1] > sy.min() - reach) & (self.pos[:, 1] < sy.max() + reach))
+        bact = np.zeros(X.shape)
+        grid = X.ndim == 2 and X.shape[0] > 1 and X.shape[1] > 1
+        if grid:
+            #regular (maybe rotated) grid: invert pixel -> stage to only
+            #evaluate a window around every bacterium
+            A = np.array([[sx[0, 1] - sx[0, 0], sx[1, 0] - sx[0, 0]],
+                          [sy[0, 1] - sy[0, 0], sy[1, 0] - sy[0, 0]]])
+            inv = np.linalg.inv(A)
+            half = np.ceil(reach * np.abs(inv).sum(axis=1)).astype(int) + 1
+        for i in np.flatnonzero(near):
+            if grid:
+                jc, ic = inv @ (self.pos[i] - (sx[0, 0], sy[0, 0]))
+                rows = slice(max(0, int(ic) - half[1]), max(0, int(ic) + half[1] + 1))
+                cols = slice(max(0, int(jc) - half[0]), max(0, int(jc) + half[0] + 1))
+            else:
+                rows = cols = slice(None)
+            wx = sx[rows, cols]
+            wy = sy[rows, cols]
+            c, s = np.cos(self.angle[i]), np.sin(self.angle[i])
+            u = (wx - self.pos[i, 0]) * c + (wy - self.pos[i, 1]) * s
+            v = -(wx - self.pos[i, 0]) * s + (wy - self.pos[i, 1]) * c
+            r = (2 * u / self.length[i])**2 + (2 * v / self.width[i])**2
+            inside = r < 1
+            if inside.any():
+                window = bact[rows, cols]
+                window[inside] = np.maximum(window[inside], self.height[i] * np.sqrt(1 - r[inside]**3))
+        return z + bact
+
+    def afm_image(self, x0, y0, dx, dy, px, py, angle):
+        #pixel (row i, col j) sits at x0 - dx/2 + j*dx/px, y0 - dy/2 + i*dy/py
+        #like the conversion in Scan.full_scan
+        j = np.arange(px) * dx / px - dx / 2
+        i = np.arange(py) * dy / py - dy / 2
+        J, I = np.meshgrid(j, i)
+        a = np.deg2rad(angle)
+        X = x0 + J * np.cos(a) - I * np.sin(a)
+        Y = y0 + J * np.sin(a) + I * np.cos(a)
+        z = self.topography(X, Y)
+        z += np.cumsum(self.rng.normal(0, self.stripes, (py, 1)), axis=0)
+        forward = self.tails(z, 1) + self.rng.normal(0, self.noise, z.shape)
+        backward = self.tails(z, -1) + self.rng.normal(0, self.noise, z.shape)
+        return forward, backward
+
+    def tails(self, z, direction, decay=0.6):
+        #the feedback lags behind on falling edges in scan direction
+        out = z.copy()
+        cols = range(1, z.shape[1]) if direction > 0 else range(z.shape[1] - 2, -1, -1)
+        for c in cols:
+            prev = out[:, c - direction]
+            base = z[:, c]
+            out[:, c] = np.maximum(base, base + (prev - base) * decay)
+        return out
+
+    def interferogram(self, x, y, offset, distance, resolution):
+        #broadband source with an amide I/II and a carbohydrate band on bacteria
+        height = self.topography(np.array([[x]]), np.array([[y]]))[0, 0] - self.tilt[0] * (x - self.center[0]) - self.tilt[1] * (y - self.center[1])
+        on_bact = min(1., max(0., height / 10**(-7)))
+        pos = np.linspace(offset - distance / 2, offset + distance / 2, int(resolution))
+        opd = 2 * (pos - offset) * 10**(-4)#cm
+        signal = np.exp(-(opd / 0.002)**2) * np.cos(2 * np.pi * 1400 * opd)
+        for nu, amp in ((1650, 0.25), (1540, 0.15), (1080, 0.1)):
+            signal -= on_bact * amp * np.exp(-abs(opd) / 0.05) * np.exp(-(opd / 0.02)**2) * np.cos(2 * np.pi * nu * opd)
+        return signal
+
+
+class SimChannel:
+    def __init__(self, scan, data):
+        self._scan = scan
+        self._data = data
+
+    def GetData(self):
+        #like the SDK, unfinished values are NaN
+        done = self._scan.samples_done()
+        out = np.full(self._data.shape, np.nan, self._data.dtype)
+        out.reshape(-1)[:done] = self._data.reshape(-1)[:done]
+        return out
+
+
+class SimImage:
+    def __init__(self, scan, channels):
+        self._scan = scan
+        self._channels = channels
+
+    def GetChannel(self, name):
+        return SimChannel(self._scan, self._channels[name])
+
+
+class SimScan:
+    def __init__(self, mic):
+        self._mic = mic
+        self.CenterX = 0.
+        self.CenterY = 0.
+        self.ScanAreaWidth = 0.
+        self.ScanAreaHeight = 0.
+        self.ResolutionColumns = 1
+        self.ResolutionRows = 1
+        self.ScanAngle = 0.
+        self.SamplingTime = 10.
+        self._started = None
+        self._suspended = None
+        self._paused = 0.
+        self._cancelled = False
+        self._samples = 1
+
+    def set_CenterX(self, v): self.CenterX = v
+    def set_CenterY(self, v): self.CenterY = v
+    def set_ScanAreaWidth(self, v): self.ScanAreaWidth = v
+    def set_ScanAreaHeight(self, v): self.ScanAreaHeight = v
+    def set_ResolutionColumns(self, v): self.ResolutionColumns = int(v)
+    def set_ResolutionRows(self, v): self.ResolutionRows = int(v)
+    def set_ScanAngle(self, v): self.ScanAngle = v
+    def set_SamplingTime(self, v): self.SamplingTime = v
+
+    def duration(self):
+        #simulated seconds for the whole scan
+        return self._samples * self.sample_time()
+
+    def sample_time(self):
+        return self.SamplingTime / 1000
+
+    def elapsed(self):
+        if self._started is None:
+            return 0.
+        now = self._suspended if self._suspended is not None else time.time()
+        return (now - self._started - self._paused) * self._mic.sample.speed
+
+    def samples_done(self):
+        if self.IsCompleted:
+            return self._samples
+        return min(self._samples, int(self.elapsed() / self.sample_time()))
+
+    @property
+    def Progress(self):
+        return min(1., self.elapsed() / self.duration()) if self._started is not None else 0.
+
+    @property
+    def IsStarted(self):
+        return self._started is not None
+
+    @property
+    def IsCompleted(self):
+        return self._cancelled or (self._started is not None and self.elapsed() >= self.duration())
+
+    @property
+    def IsSuspended(self):
+        return self._suspended is not None
+
+    def Suspend(self):
+        if self._suspended is None:
+            self._suspended = time.time()
+
+    def Resume(self):
+        if self._suspended is not None:
+            self._paused += time.time() - self._suspended
+            self._suspended = None
+
+    def Cancel(self):
+        self._cancelled = True
+
+    def Start(self):
+        self._started = time.time()
+        self._mic.current_scan = self
+        return SimImage(self, self.render())
+
+
+class SimAfmScan(SimScan):
+    def duration(self):
+        #trace and retrace for every pixel
+        return 2 * self.ResolutionRows * self.ResolutionColumns * self.sample_time()
+
+    def samples_done(self):
+        #whole rows finish at once, sample = one pixel
+        if self.IsCompleted:
+            return self.ResolutionRows * self.ResolutionColumns
+        rows = int(self.elapsed() / (2 * self.ResolutionColumns * self.sample_time()))
+        return min(self.ResolutionRows, rows) * self.ResolutionColumns
+
+    def render(self):
+        sample = self._mic.sample
+        forward, backward = sample.afm_image(self.CenterX, self.CenterY, self.ScanAreaWidth, self.ScanAreaHeight,
+                                             self.ResolutionColumns, self.ResolutionRows, self.ScanAngle)
+        self._samples = forward.size
+        channels = {'Z': forward.astype(np.float32), 'R-Z': backward.astype(np.float32)}
+        return SimChannels(channels, forward, backward, sample.rng)
+
+
+class SimFourierScan(SimScan):
+    def __init__(self, mic):
+        SimScan.__init__(self, mic)
+        self.InterferometerOffset = 0.
+        self.InterferometerDistance = 100.
+        self.Averaging = 1
+        self.InterferogramResolution = 512
+
+    def set_InterferometerOffset(self, v): self.InterferometerOffset = v
+    def set_InterferometerDistance(self, v): self.InterferometerDistance = v
+    def set_Averaging(self, v): self.Averaging = int(v)
+    def set_InterferogramResolution(self, v): self.InterferogramResolution = int(v)
+
+    def render(self):
+        sample = self._mic.sample
+        shape = (self.ResolutionRows, self.ResolutionColumns, self.Averaging, self.InterferogramResolution)
+        self._samples = int(np.prod(shape))
+        ifg = np.zeros(shape)
+        height = np.zeros(shape)
+        for r in range(shape[0]):
+            for c in range(shape[1]):
+                x = self.CenterX - self.ScanAreaWidth / 2 + (c * self.ScanAreaWidth / shape[1] if shape[1] > 1 else self.ScanAreaWidth / 2)
+                y = self.CenterY - self.ScanAreaHeight / 2 + (r * self.ScanAreaHeight / shape[0] if shape[0] > 1 else self.ScanAreaHeight / 2)
+                ifg[r, c] = sample.interferogram(x, y, self.InterferometerOffset, self.InterferometerDistance, shape[3])
+                height[r, c] = sample.topography(np.array([[x]]), np.array([[y]]))[0, 0]
+        return SimChannels({'Z': height.astype(np.float32)}, ifg, ifg, sample.rng, noise=0.01)
+
+
+class SimChannels(dict):
+    #channel data on demand: Z/R-Z are given, the optical and mechanical
+    #channels are derived from the forward/backward signal plus noise
+    def __init__(self, channels, forward, backward, rng, noise=None):
+        dict.__init__(self, channels)
+        self._forward = forward
+        self._backward = backward
+        self._rng = rng
+        self._noise = noise
+
+    def __missing__(self, name):
+        reverse = name.startswith('R-')
+        base = self._backward if reverse else self._forward
+        key = name[2:] if reverse else name
+        order = int(key[1]) if len(key) > 1 and key[1].isdigit() else 0
+        if key.endswith('P'):
+            data = self._rng.normal(0, 0.1, base.shape)
+        else:
+            scale = 1. / (order + 1)
+            if self._noise is None:
+                data = scale * (1 + base / 10**(-6)) + self._rng.normal(0, 0.01 * scale, base.shape)
+            else:
+                data = scale * base + self._rng.normal(0, self._noise * scale, base.shape)
+        self[name] = data.astype(np.float32)
+        return self[name]
+
+
+class SimMicroscope:
+    def __init__(self, sample):
+        self.sample = sample
+        self.current_scan = None
+        self.IsInContact = False
+        self.ClientVersion = 'Simulation'
+        self.ServerVersion = 'Simulation'
+
+    def AutoApproach(self, setpoint):
+        self.IsInContact = True
+
+    def RegulatorOff(self):
+        self.IsInContact = False
+
+    def CancelCurrentProcedure(self):
+        if self.current_scan is not None:
+            self.current_scan.Cancel()
+
+    def PrepareAfmScan(self):
+        return SimAfmScan(self)
+
+    def PrepareFourierScan(self):
+        return SimFourierScan(self)
+
+    def Dispose(self):
+        pass
+
+
+class SimClient:
+    def __init__(self, sample):
+        self._sample = sample
+
+    def Connect(self):
+        return SimMicroscope(self._sample)
+
+    def Disconnect(self):
+        pass
+
+
+class SimNeaSNOMConnect(NeaSNOMConnect):
+    '''
+    Drop-in replacement for NeaSNOMConnect without hardware. Pass the same
+    `sample` to every connection of a run so drift keeps accumulating, e.g.
+    Scan(scan_dict, backend=functools.partial(SimNeaSNOMConnect, sample=SimSample(seed=1), speed=100)).
+    '''
+    def __init__(self, ip='simulation', path='', con_needed = True, sample=None, speed=100.):
+        NeaSNOMConnect.__init__(self, ip, path, con_needed = False)
+        if con_needed:
+            self._sample = sample if sample is not None else SimSample()
+            self._sample.set_speed(speed)
+            self._neaClient = SimClient(self._sample)
+            self._neaMic = self._neaClient.Connect()
+            self._neaMic.CancelCurrentProcedure()
+            self._neaMic.RegulatorOff()
+            self._connected = True
+
+    def get_current(self):
+        return self._sample.current()
@@ -0,0 +1,63 @@
+import json
+import os
+import numpy as np
+import pytest
+h5py = pytest.importorskip('h5py')
+from Batch import find_sources, load_source, run_batch
+from OverviewStore import save_overview
+from SimNeaSNOM import SimSample
+from test_journal import sim_config
+
+def overview(seed=2):
+    #the simulated overview of sim_config
+    afm = sim_config('')['AFM']
+    (forward, backward) = SimSample(seed=seed).afm_image(afm['x0'], afm['y0'], afm['dx'], afm['dy'],
+                                                         int(afm['px']), int(afm['py']), afm['angle'])
+    return {'Z': forward, 'R-Z': backward}
+
+def write_hdf5(path, channels, afm):
+    with h5py.File(path, 'w') as hdf:
+        for k, v in channels.items():
+            hdf['Data/AFM/' + k] = v
+        for k, v in afm.items():
+            hdf['Info/AFM/' + k] = v
+
+def test_find_sources(tmp_path):
+    save_overview(str(tmp_path / 'a'), {'Z': np.zeros(2), 'R-Z': np.zeros(2)})
+    #only one of the two channels
+    save_overview(str(tmp_path / 'b'), {'Z': np.zeros(2)})
+    (tmp_path / 'b' / 'scan.hdf5').write_bytes(b'')
+    (tmp_path / 'b' / 'notes.txt').write_text('')
+    single = tmp_path / 'single.h5'
+    single.write_bytes(b'')
+    sources = find_sources([str(tmp_path / 'a'), str(tmp_path / 'b'), str(single)])
+    assert sources == [str(tmp_path / 'a'), str(tmp_path / 'b' / 'scan.hdf5'), str(single)]
+
+def test_config_goes_over_the_stored_settings(tmp_path):
+    config = sim_config('')
+    path = str(tmp_path / 'scan.hdf5')
+    write_hdf5(path, {'Z': np.zeros((2, 2)), 'R-Z': np.zeros((2, 2))}, dict(config['AFM'], hlimit=0.1, dx=30.))
+    (forward, backward, afm, characteristics) = load_source(path, None)
+    assert afm['hlimit'] == 0.1 and characteristics == {}
+    config['AFM'] = {'hlimit': 0.4}
+    (forward, backward, afm, characteristics) = load_source(path, config)
+    #from the config, the rest from the file
+    assert afm['hlimit'] == 0.4 and afm['dx'] == 30.
+    assert characteristics == config['Characteristics']
+
+def test_status_per_file_and_a_failing_file(tmp_path):
+    config = sim_config('')
+    data = tmp_path / 'data'
+    save_overview(str(data / 'overview'), overview(), config)
+    write_hdf5(str(data / 'flat.hdf5'), {'Z': np.zeros((151, 151)), 'R-Z': np.zeros((151, 151))}, config['AFM'])
+    (data / 'broken.hdf5').write_bytes(b'not an hdf5 file')
+    output = str(tmp_path / 'results.jsonl')
+    counts = run_batch([str(data)], output, config, workers=2, progress=lambda text: None)
+    assert counts == {'ok': 1, 'no_bacteria': 1, 'error': 1}
+    with open(output) as file:
+        records = {os.path.basename(r['source']): r for r in map(json.loads, file)}
+    assert records['overview']['status'] == 'ok' and records['overview']['bacteria']
+    assert records['flat.hdf5']['status'] == 'no_bacteria'
+    assert records['broken.hdf5']['status'] == 'error' and 'OSError' in records['broken.hdf5']['error']
+    #nothing left for a resumed run
+    assert run_batch([str(data)], output, config, resume=True, progress=lambda text: None) == {'ok': 0, 'no_bacteria': 0, 'error': 0}
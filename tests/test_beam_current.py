@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from BeamCurrent import CurrentBuffer
+
+def buffer(samples, size=2**16):
+    current = CurrentBuffer(size)
+    for (t, value) in samples:
+        current.add(t, value)
+    return current
+
+def test_integral_of_a_step():
+    current = buffer([(0., 100.), (10., 200.), (20., 50.)])
+    stats = current.stats(5., 15.)
+    #100 until 10, 200 after it
+    assert stats['Current_Integral'] == pytest.approx(5 * 100. + 5 * 200.)
+    assert stats['Current'] == pytest.approx(150.)
+    assert stats['Current_Partial'] == 0
+    np.testing.assert_array_equal(stats['Current_Series']['Time'], [5., 10.])
+    np.testing.assert_array_equal(stats['Current_Series']['Value'], [100., 200.])
+
+def test_constant_after_the_last_sample():
+    stats = buffer([(0., 100.)]).stats(30., 40.)
+    assert stats['Current_Integral'] == pytest.approx(1000.)
+    assert stats['Current'] == pytest.approx(100.)
+
+def test_window_before_the_first_sample_is_partial():
+    current = buffer([(10., 100.), (20., 300.)])
+    stats = current.stats(0., 30.)
+    assert stats['Current_Partial'] == 1
+    #only the part covered by samples
+    assert stats['Current_Integral'] == pytest.approx(10 * 100. + 10 * 300.)
+    assert current.stats(0., 5.) is None
+
+def test_ring_buffer_keeps_the_newest():
+    current = buffer([(float(t), float(t)) for t in range(10)], size=4)
+    (times, values) = current.samples()
+    np.testing.assert_array_equal(times, [6., 7., 8., 9.])
+    assert current.stats(7.5, 8.5)['Current_Integral'] == pytest.approx(0.5 * 7 + 0.5 * 8)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import Scan
+from Scan import NetArrayConverter
+
+class FakeNetArray:
+    #stands in for a CLR System.Array
+    def __init__(self, values):
+        self.values = np.asarray(values)
+
+@pytest.fixture
+def converter(monkeypatch):
+    monkeypatch.setattr(Scan, 'net_array_info', lambda net: (net.values.shape, net.values.dtype))
+    monkeypatch.setattr(Scan, 'net_array_copy', lambda net, out: np.copyto(out, net.values) or out)
+    return NetArrayConverter()
+
+def test_buffer_per_key_shape_and_dtype(converter):
+    first = converter.convert(FakeNetArray(np.ones((2, 3))), 'image', view=True)
+    buf = converter.buffer('image', (2, 3), np.float64)
+    assert np.shares_memory(first, buf)
+    second = converter.convert(FakeNetArray(np.full((2, 3), 2.)), 'image', view=True)
+    assert np.shares_memory(second, buf)
+    #the old view shows the new data
+    assert first[0, 0] == 2.
+    assert not np.shares_memory(converter.convert(FakeNetArray(np.ones((2, 3))), 'plot', view=True), buf)
+    assert not np.shares_memory(converter.convert(FakeNetArray(np.ones((3, 2))), 'image', view=True), buf)
+    converter.convert(FakeNetArray(np.ones((3, 2), np.float32)), 'image', view=True)
+    assert converter.buffer('image', (3, 2), np.float32).dtype == np.float32
+    converter.clear()
+    assert converter.buffer('image', (3, 2), np.float32) is not buf
+
+def test_views_are_read_only(converter):
+    view = converter.convert(FakeNetArray(np.ones(4)), 'plot', view=True)
+    assert not view.flags.writeable
+    with pytest.raises(ValueError):
+        view[0] = 2.
+    #the buffer itself stays writable for the next convert
+    converter.convert(FakeNetArray(np.zeros(4)), 'plot', view=True)
+    assert view[0] == 0.
+
+def test_copies_are_owned_by_the_caller(converter):
+    net = FakeNetArray(np.ones(4))
+    copy = converter.convert(net, 'plot')
+    assert copy.flags.writeable and not np.shares_memory(copy, net.values)
+    assert converter.convert(net, 'plot') is not copy
+    #numpy arrays of the simulated backend
+    data = np.arange(4.)
+    view = converter.convert(data, 'plot', view=True)
+    assert np.shares_memory(view, data) and not view.flags.writeable and data.flags.writeable
+    copy = converter.convert(data, 'plot')
+    assert not np.shares_memory(copy, data)
@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+from Drift import DriftModel, phase_shift
+
+def surface(shape=(128, 128), seed=0):
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur(rng.normal(size=shape), (0, 0), 1) * 10**(-7)
+
+def test_phase_shift_of_a_rolled_image():
+    reference = surface()
+    #features move 5 px to the left (x) and 3 px down (y)
+    image = np.roll(reference, (3, -5), axis=(0, 1))
+    (dx, dy), confidence = phase_shift(reference, image)
+    assert abs(dx - (-5)) < 0.2 and abs(dy - 3) < 0.2
+    assert confidence > 0.5
+    (dx, dy), confidence = phase_shift(image, reference)
+    assert abs(dx - 5) < 0.2 and abs(dy - (-3)) < 0.2
+    #rows are y as in the scans: a sample moved by +y is found by +dy
+    (dx, dy), confidence = phase_shift(reference[10:110, 10:110], reference[8:108, 10:110])
+    assert abs(dx) < 0.2 and abs(dy - 2) < 0.2
+
+def test_phase_shift_of_unrelated_images():
+    (dx, dy), confidence = phase_shift(surface(seed=0), surface(seed=1))
+    assert confidence < 0.2
+
+def rescan_after(model, t, threshold=0.1, max_age=600., step=0.1):
+    #time of the next rescan after t
+    while not model.needs_rescan(t, threshold, max_age):
+        t += step
+    return t
+
+def test_drift_model_rescan_decision():
+    model = DriftModel()
+    #nothing measured yet
+    assert model.needs_rescan(0., 0.1, 600.)
+    model.update(0., (0., 0.))
+    assert not model.needs_rescan(8., 0.1, 600.)
+    assert model.needs_rescan(9.5, 0.1, 600.)
+    #never longer than max_age
+    assert model.needs_rescan(5., 0.1, 4.)
+
+def test_drift_model_learns_the_speed():
+    model = DriftModel()
+    speed = np.array([0.002, -0.001])
+    (t, intervals) = (0., [])
+    model.update(t, (0., 0.))
+    for i in range(4):
+        t_next = rescan_after(model, t)
+        intervals.append(t_next - t)
+        t = t_next
+        model.update(t, speed * t)
+    #the rescans get rarer as the speed is known better
+    assert 8. < intervals[0] < 10.
+    assert all(b > a for a, b in zip(intervals, intervals[1:]))
+    (offset, offset_std) = model.predict(t + 30.)
+    np.testing.assert_allclose(offset, speed * (t + 30.), atol=0.05)
+    assert offset_std < 0.2
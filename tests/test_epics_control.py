@@ -0,0 +1,125 @@
+import importlib
+import sys
+import threading
+import time
+import types
+import pytest
+
+STATE_PV = 'MLSOPCCP:curState'
+CURRENT_PV = 'CUM1ZK3RP:rdCur'
+
+class FakePV:
+    def __init__(self, name):
+        self.name = name
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def clear_callbacks(self):
+        self.callbacks = []
+
+@pytest.fixture
+def monitor(monkeypatch):
+    #Epics_Control with caget giving the start values, stopped after the test
+    values = {}
+    fake = types.SimpleNamespace(caget=values.get, PV=FakePV)
+    monkeypatch.setitem(sys.modules, 'epics', fake)
+    module = importlib.import_module('Epics_Control')
+    monkeypatch.setattr(module, 'epics', fake)
+    controls = []
+    def make(state='IDLE', current=100., **kwargs):
+        values.update({STATE_PV: state, CURRENT_PV: current})
+        control = module.Epics_Control(**kwargs)
+        control.messages = []
+        control.bind_to(lambda message, data: control.messages.append((message, data)))
+        controls.append(control)
+        return control
+    yield make
+    for control in controls:
+        control.stop()
+
+def feed(control, events):
+    #(pv, value, t) through the queue of the state machine thread; once the
+    #second of two empty events is taken, everything before is handled
+    for event in events + [(None, None, 0.), (None, None, 0.)]:
+        control.events.put(event)
+        if event[0] is None:
+            while not control.events.empty():
+                time.sleep(0.001)
+
+def current(values, t0=0., step=0.5):
+    return [(CURRENT_PV, v, t0 + i * step) for i, v in enumerate(values)]
+
+def test_debounce(monitor):
+    control = monitor(debounce=1.)
+    assert control.state == 'RUNNING' and not control.paused
+    #a single outlier does not stop the measurement
+    feed(control, current([50., 99.]))
+    assert control.state == 'RUNNING' and control.messages == []
+    #one second out of the band does
+    feed(control, current([50., 50.], t0=1.))
+    assert control.state == 'RUNNING'
+    feed(control, current([50.], t0=2.))
+    assert control.state == 'BEAM_ERROR' and control.paused
+    assert control.messages == [('epics_error', (99., 50.))]
+
+def test_hysteresis(monitor):
+    control = monitor(limit=0.2, hysteresis=0.5, debounce=1.)
+    feed(control, current([50., 50., 50.]))
+    assert control.state == 'BEAM_ERROR'
+    #back within the limit, but not within limit * hysteresis
+    feed(control, current([85., 85., 85., 85.], t0=2.))
+    assert control.state == 'BEAM_ERROR'
+    #a value out of the band starts the debounce again
+    feed(control, current([95., 95., 50., 95., 95.], t0=5.))
+    assert control.state == 'BEAM_ERROR'
+    feed(control, current([95.], t0=7.5))
+    assert control.state == 'RUNNING' and not control.paused
+    assert control.messages == [('epics_error', (100., 50.)), ('epics_restart', None)]
+    assert control.cur_value == 95.
+
+def test_settle_after_the_injection(monitor):
+    control = monitor(settle=0.3)
+    restarted = threading.Event()
+    control.bind_to(lambda message, data: message == 'epics_restart' and restarted.set())
+    feed(control, [(STATE_PV, 'INJECTION', time.monotonic())])
+    assert control.state == 'INJECTION' and control.paused
+    assert control.messages == [('epics_stop', None)]
+    #the current after the injection is the new reference, no error
+    feed(control, current([200.], t0=time.monotonic()))
+    assert control.cur_value == 200. and control.state == 'INJECTION'
+    start = time.monotonic()
+    feed(control, [(STATE_PV, 'IDLE', start)])
+    assert control.state == 'SETTLING' and control.paused
+    assert restarted.wait(5)
+    assert time.monotonic() - start >= 0.3
+    assert control.state == 'RUNNING'
+    assert control.messages == [('epics_stop', None), ('epics_restart', None)]
+
+def test_injection_while_settling(monitor):
+    control = monitor(settle=0.3)
+    feed(control, [(STATE_PV, 'INJECTION', time.monotonic()), (STATE_PV, 'IDLE', time.monotonic())])
+    feed(control, [(STATE_PV, 'INJECTION', time.monotonic())])
+    time.sleep(0.5)
+    #the settle timer was dropped with the new injection
+    assert control.state == 'INJECTION'
+    assert control.messages == [('epics_stop', None)]
+
+def test_unreachable_state_at_startup(monitor):
+    from JobQueue import JobQueue, Scheduler
+    control = monitor(state=None, current=None, settle=0.1)
+    #counts as an injection until the PV reports IDLE
+    assert control.state == 'INJECTION' and control.paused
+    scheduler = Scheduler(JobQueue.__new__(JobQueue), 0.5, epics=False)
+    scheduler.epics_ctrl = control
+    scheduler.start = time.time()
+    assert not scheduler.wait_for_beam()
+    feed(control, [(STATE_PV, 'IDLE', time.monotonic())])
+    deadline = time.monotonic() + 5
+    while control.paused and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert control.state == 'RUNNING'
+    assert control.messages == [('epics_restart', None)]
+    scheduler.start = time.time()
+    assert scheduler.wait_for_beam()
@@ -0,0 +1,110 @@
+import cv2
+import numpy as np
+import pytest
+from Find_Bact import FindBacteria
+
+PARAMS = {'length': [1.8, 5], 'width': [0.5, 1.3], 'height': [0.3, 0.6], 'corona': 0.5, 'climit': 0.2}
+
+def baseline_references(data_sqr, contour, x1, y1, limit, top, corona):
+    #the disk test per pixel as it was in find_bacteria, ranked by pointPolygonTest
+    ref_mask = np.zeros(data_sqr.shape)
+    references = []
+    (mask_x, mask_y) = np.where(data_sqr < limit * top)
+    ref_mask[(mask_x, mask_y)] = 1
+    for x, y in zip(mask_x, mask_y):
+        YY, XX = np.ogrid[-x : data_sqr.shape[0]-x, -y : data_sqr.shape[1]-y]
+        mask = XX * XX + YY * YY <= corona * corona
+        if all(ref_mask[mask]):
+            references.append((y + x1, x + y1))
+    references.sort(key=lambda p: cv2.pointPolygonTest(contour, (float(p[0]), float(p[1])), True), reverse=True)
+    return references
+
+@pytest.mark.parametrize('seed', range(5))
+def test_polygon_distance_matches_point_polygon_test(seed):
+    rng = np.random.default_rng(seed)
+    contour = cv2.convexHull((rng.random((12, 2)) * 50).astype(np.int32))
+    if seed % 2:
+        #not convex, with a notch
+        contour = np.array([[[0, 0]], [[40, 0]], [[40, 40]], [[20, 10]], [[0, 40]]], np.int32)
+    points = rng.integers(-10, 60, size=(300, 2))
+    expected = [cv2.pointPolygonTest(contour, (float(x), float(y)), True) for (x, y) in points]
+    f = FindBacteria(PARAMS, 0.1)
+    np.testing.assert_allclose(f.polygon_distance(contour, points), expected, atol=1e-6)
+
+@pytest.mark.parametrize('seed', range(6))
+def test_find_references_matches_disk_search(seed):
+    rng = np.random.default_rng(seed)
+    data = cv2.GaussianBlur(rng.random((60, 70)), (9, 9), 3)
+    contour = np.array([[[30, 30]], [[40, 30]], [[40, 40]], [[30, 40]]], np.int32)
+    f = FindBacteria(PARAMS, [0.05, 0.1, 0.2][seed % 3], ref_candidates=5)
+    top = np.quantile(data, 0.6) / 0.2
+    expected = baseline_references(data, contour, 3, 4, 0.2, top, f._corona)
+    found = f.find_references(data, contour, (3, 4), top)
+    assert [tuple(int(v) for v in p) for p in found] == expected[:5]
+
+def test_find_references_without_valid_pixel():
+    f = FindBacteria(PARAMS, 0.1)
+    contour = np.array([[[3, 3]], [[6, 3]], [[6, 6]]], np.int32)
+    assert len(f.find_references(np.ones((10, 10)), contour, (0, 0), 1.)) == 0
+
+def test_candidate_features_match_per_contour_masks():
+    #overlapping hulls, NaN pixels: every candidate keeps all pixels of its hull
+    rng = np.random.default_rng(7)
+    data = rng.normal(size=(120, 120))
+    data[rng.random(data.shape) < 0.02] = np.nan
+    contours = [cv2.convexHull((rng.random((6, 2)) * 40 + rng.random(2) * 80).astype(np.int32)) for _ in range(12)]
+    f = FindBacteria(PARAMS, 0.1)
+    features = f.candidate_features(contours, data)
+    for i, c in enumerate(contours):
+        mask = np.zeros(data.shape, np.uint8)
+        cv2.drawContours(mask, [c], 0, 1, -1)
+        values = data[mask == 1]
+        (_, _), size, _ = cv2.minAreaRect(c)
+        assert features['h_max'][i] == pytest.approx(np.nanmax(values))
+        assert features['h_mean'][i] == pytest.approx(np.nanmean(values))
+        assert features['area'][i] == pytest.approx(mask.sum() * 0.01)
+        assert features['length'][i] == pytest.approx(max(size) * 0.1)
+        assert features['width'][i] == pytest.approx(min(size) * 0.1)
+
+def test_candidate_features_empty():
+    f = FindBacteria(PARAMS, 0.1)
+    assert len(f.candidate_features([], np.zeros((5, 5)))) == 0
+
+def synthetic_overview(n=256, count=40, seed=3):
+    rng = np.random.default_rng(seed)
+    ratio = 50 / n
+    (Y, X) = np.mgrid[:n, :n]
+    img = np.zeros((n, n))
+    for _ in range(count):
+        (cx, cy) = rng.uniform(20, n - 20, 2)
+        (L, W) = (rng.uniform(1, 6) / ratio, rng.uniform(0.4, 1.5) / ratio)
+        a = rng.uniform(0, np.pi)
+        u = (X - cx) * np.cos(a) + (Y - cy) * np.sin(a)
+        v = -(X - cx) * np.sin(a) + (Y - cy) * np.cos(a)
+        r = (2 * u / L)**2 + (2 * v / W)**2
+        img = np.maximum(img, np.where(r < 1, rng.uniform(0.2, 0.8) * 1e-6 * np.sqrt(np.clip(1 - r, 0, 1)), 0))
+    img += rng.normal(0, 5e-9, img.shape)
+    return np.clip(img, 0, 0.6e-6), ratio
+
+def test_find_bacteria_filter_matches_contour_loop():
+    data, ratio = synthetic_overview()
+    f = FindBacteria(PARAMS, ratio)
+    f.find_bacteria(data.copy(), 0.6e-6)
+    contours = f.find_all_contours(data.copy())
+    expected = []
+    for c in contours:
+        #size and height test as it was done per contour
+        (_, _), size, _ = cv2.minAreaRect(c)
+        (width, length) = (min(size) * ratio, max(size) * ratio)
+        if PARAMS['width'][0] <= width <= PARAMS['width'][1] and PARAMS['length'][0] <= length <= PARAMS['length'][1]:
+            mask = np.zeros(data.shape, np.uint8)
+            cv2.drawContours(mask, [c], 0, 1, -1)
+            h_upper = np.nanmax(data[np.where(mask == 1)])
+            if PARAMS['height'][0] * 10**(-6) <= h_upper <= PARAMS['height'][1] * 10**(-6):
+                expected.append(c)
+    result = f.get_dict()
+    assert len(expected) > 0
+    assert len(result['Bacteria']) == len(expected)
+    for name, c in zip(result['Bacteria'], expected):
+        M = cv2.moments(c)
+        assert result['Bacteria'][name]['Points']['Center']['Coord'] == (int(M['m10']/M['m00']), int(M['m01']/M['m00']))
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+h5py = pytest.importorskip('h5py')
+from Batch import hdf5_to_dict
+from HDF5Stream import HDF5Stream
+
+def test_write_and_reopen(tmp_path):
+    path = str(tmp_path / 'scan.hdf5')
+    z = np.arange(12.).reshape(3, 4)
+    with HDF5Stream(path) as writer:
+        writer.write('Info', {'project': 'Sim', 'AFM': {'px': 151., 'angle': 0.}, 'operators': ['A', 'B']})
+        writer.write('Data/AFM', {'Z': z, 'R-Z': -z})
+        writer.write('Data/Bacteria/Bacteria1/Points/Center', {'Coord': (1.5, 2.5)}, flush=False)
+        #written again: merged into the group, the dataset replaced
+        writer.write('Data/AFM', {'Z': z + 1})
+        assert 'Data/AFM/Z' in writer and 'Data/AFM/O2A' not in writer
+        np.testing.assert_array_equal(writer.read('Data/AFM/Z'), z + 1)
+    assert writer.closed
+
+    with h5py.File(path, 'r') as hdf:
+        np.testing.assert_array_equal(hdf['Data/AFM/Z'][()], z + 1)
+        np.testing.assert_array_equal(hdf['Data/AFM/R-Z'][()], -z)
+        np.testing.assert_array_equal(hdf['Data/Bacteria/Bacteria1/Points/Center/Coord'][()], [1.5, 2.5])
+        #read back as Batch does it
+        assert hdf5_to_dict(hdf['Info']) == {'project': 'Sim', 'AFM': {'px': 151., 'angle': 0.}, 'operators': ['A', 'B']}
+
+    #continued in append mode, as resume_scan does it
+    with HDF5Stream(path, mode='a') as writer:
+        writer.write('Data/Resume', {'Offset': (0.1, -0.2)})
+        np.testing.assert_array_equal(writer.read('Data/AFM/R-Z'), -z)
+    with h5py.File(path, 'r') as hdf:
+        assert set(hdf['Data'].keys()) == {'AFM', 'Bacteria', 'Resume'}
+
+def test_close_twice(tmp_path):
+    writer = HDF5Stream(str(tmp_path / 'scan.hdf5'))
+    writer.close()
+    writer.close()
+    writer.flush()
+    assert writer.closed
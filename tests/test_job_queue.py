@@ -0,0 +1,68 @@
+import functools
+import pytest
+from JobQueue import JobQueue, Scheduler, default_estimate
+from Journal import Journal
+from test_journal import events, sim_config
+
+def sim_backend(speed=5000):
+    from SimNeaSNOM import SimNeaSNOMConnect, SimSample
+    return functools.partial(SimNeaSNOMConnect, sample=SimSample(seed=2, drift=(0., 0.)), speed=speed)
+
+def test_estimate_from_jobs_of_the_same_shape(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.json'))
+    config = sim_config(str(tmp_path))
+    small = queue.add(config)
+    assert queue.estimate(small) == default_estimate(small['config'])
+    #a long job with a larger scan does not change the estimate of the small ones
+    large = queue.add(config, {'px': 301., 'py': 301.})
+    queue.update(large, status='done', started=0., finished=5000.)
+    assert queue.estimate(small) == default_estimate(small['config'])
+    done = queue.add(config, {'x0': 20.})
+    queue.update(done, status='done', started=0., finished=300.)
+    #the scan region is not part of the shape
+    assert queue.estimate(small) == 300.
+    assert queue.estimate(queue.add(config, estimate=60.)) == 60.
+
+def test_order(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.json'))
+    config = sim_config(str(tmp_path))
+    low = queue.add(config, priority=0, estimate=1.)
+    high = queue.add(config, priority=2, estimate=1.)
+    mid = queue.add(config, priority=1, estimate=1.)
+    assert [j['id'] for j in queue.pending()] == [high['id'], mid['id'], low['id']]
+    #an interrupted job goes before everything else
+    queue.update(low, status='interrupted')
+    assert [j['id'] for j in queue.pending()] == [low['id'], high['id'], mid['id']]
+
+def test_budget(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.json'))
+    config = sim_config(str(tmp_path))
+    big = queue.add(config, priority=1, estimate=100.)
+    small = queue.add(config, estimate=10.)
+    assert queue.next_job(50.) is small
+    assert queue.next_job(5.) is None
+    #a job that can not be done in the budget at all is not started but skipped
+    queue.update(small, status='done')
+    left = Scheduler(queue, 50., backend=sim_backend()).run()
+    assert left == []
+    assert big['status'] == 'skipped' and big['started'] is None
+
+def test_stop_at_the_end_of_the_budget_and_continue(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    path = str(tmp_path / 'jobs.json')
+    queue = JobQueue(path)
+    job = queue.add(sim_config(str(tmp_path)), name='Sim', estimate=1.)
+    left = Scheduler(queue, 3., backend=sim_backend(speed=500)).run()
+    assert [j['id'] for j in left] == [job['id']]
+    assert job['status'] == 'interrupted' and job['journal']
+    assert not Journal.load(job['journal'])['done']
+
+    #a restart reads the queue from the file and finishes the job
+    queue = JobQueue(path)
+    job = queue.get(job['id'])
+    assert job['status'] == 'interrupted'
+    assert Scheduler(queue, 600., backend=sim_backend()).run() == []
+    assert JobQueue(path).get(job['id'])['status'] == 'done'
+    assert events(job['journal'])[-1]['event'] == 'done'
+    with h5py.File(job['hdf5'], 'r') as hdf:
+        assert 'Bacteria' in hdf['Data']
@@ -0,0 +1,125 @@
+import copy
+import functools
+import json
+import os
+import numpy as np
+import pytest
+from Journal import Journal, journal_path
+
+def test_journal_path():
+    assert journal_path(os.path.join('a', 'scan 1.hdf5')) == os.path.join('a', 'scan 1.journal')
+
+def test_load_state(tmp_path):
+    path = str(tmp_path / 'scan.journal')
+    journal = Journal(path)
+    journal.write('setup', hdf5='scan.hdf5', info={'AFM': {'px': 10}})
+    journal.write('overview', path='scan_NPY')
+    journal.write('detection', bacteria={'Bacteria1': {'Points': {'Center': {'Coord': (1.5, 2.5)}, 'Top': {'Coord': (1., 2.)}},
+                                                       'Reference_Candidates': np.array([[1., 2.], [3., 4.]])}})
+    journal.write('point', bacterium='Bacteria1', point='Center')
+    journal.write('point', bacterium='Bacteria1', point='Center')
+    journal.close()
+    #a line cut off by a crash
+    with open(path, 'a') as file:
+        file.write('{"event": "point", "bacter')
+    state = Journal.load(path)
+    assert state['info'] == {'AFM': {'px': 10}}
+    assert state['hdf5'] == 'scan.hdf5'
+    assert state['overview'] == 'scan_NPY'
+    assert state['points'] == {'Bacteria1': ['Center']}
+    assert not state['done']
+    bact = state['bacteria']['Bacteria1']
+    assert bact['Points']['Center']['Coord'] == (1.5, 2.5)
+    np.testing.assert_array_equal(bact['Reference_Candidates'], [[1., 2.], [3., 4.]])
+
+def test_write_after_close_is_ignored(tmp_path):
+    path = str(tmp_path / 'scan.journal')
+    journal = Journal(path)
+    journal.close()
+    journal.write('done')
+    assert Journal.load(path)['done'] is False
+
+def sim_config(dest):
+    return {'Info': {'project': 'Sim', 'description': 'test', 'operators': 'Test User'},
+            'AFM': {'x0': 50., 'y0': 50., 'dx': 15., 'dy': 15., 'px': 151., 'py': 151., 'angle': 0., 't_int': 11.9,
+                    'setpoint': 0.8, 'hlimit': 0.6},
+            'Fourier': {'x_res': 1., 'y_res': 1., 'angle_f': 0., 't_int_f': 11.9, 'offset': 730., 'distance': 100.,
+                        'averaging': 2., 'resolution': 512., 'source': 'Synchrotron'},
+            'Channel': {'z': 1, 'r-z': 1, 'o2a': 1, 'r-o2a': 1},
+            'Characteristics': {'length': [1.8, 5.], 'width': [0.5, 1.3], 'height': [0.3, 0.6], 'corona': 0.5, 'climit': 0.2},
+            'Measurement': {'iterations': 1., 'dest_path': dest, 'csv_path': '', 'csv_export': 0.}}
+
+def events(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+def test_scan_journal_and_resume(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    from Scan import Scan
+    from SimNeaSNOM import SimNeaSNOMConnect, SimSample
+    config = sim_config(str(tmp_path))
+    #without drift the bacteria are found again in the refinement scans
+    sample = SimSample(seed=2, drift=(0., 0.))
+    backend = functools.partial(SimNeaSNOMConnect, sample=sample, speed=5000)
+    with Scan(copy.deepcopy(config), backend=backend) as scan:
+        scan.full_scan(1)
+    path = journal_path(scan.hdf5_path)
+    records = events(path)
+    names = [r['event'] for r in records]
+    assert names[:3] == ['setup', 'overview', 'detection']
+    #the overview is on disk before its entry
+    assert os.path.exists(os.path.join(records[1]['path'], 'Z.npy'))
+    points = [(r['bacterium'], r['point']) for r in records if r['event'] == 'point']
+    assert points
+
+    #interrupted after the first point, the sample moved before the resume
+    with open(path, 'w') as file:
+        for record in records[:names.index('point') + 1]:
+            file.write(json.dumps(record) + '\n')
+    shift = np.array([0.8, -0.5])
+    sample.pos += shift
+    with Scan(copy.deepcopy(config), backend=backend) as scan:
+        scan.resume_scan(path)
+    records = events(path)
+    names = [r['event'] for r in records]
+    assert 'resume' in names and names[-1] == 'done'
+    again = [(r['bacterium'], r['point']) for r in records[names.index('resume'):] if r['event'] == 'point']
+    #measuring goes on at the first point that was not measured
+    assert again[0] == points[1]
+    assert points[0] not in again
+    assert len(again) == len(set(again))
+    with h5py.File(scan.hdf5_path, 'r') as hdf:
+        (bact, point) = points[0]
+        assert point in hdf['Data/Bacteria/{}/Points'.format(bact)]
+        #the registration of the new overview finds the shift
+        np.testing.assert_allclose(hdf['Data/Resume/Offset'][()], shift, atol=0.1)
+        assert hdf['Data/Resume/Confidence'][()] > 0.5
+
+def test_nothing_to_resume(tmp_path, capsys):
+    from Scan import Scan
+    path = str(tmp_path / 'scan.journal')
+    journal = Journal(path)
+    journal.write('setup', hdf5='scan.hdf5', info={})
+    journal.close()
+    with Scan(sim_config(str(tmp_path))) as scan:
+        scan.resume_scan(path)
+    assert 'Nothing to resume' in capsys.readouterr().out
+
+def test_abort_from_another_thread(tmp_path):
+    import threading
+    from Scan import Scan
+    from SimNeaSNOM import SimNeaSNOMConnect, SimSample
+    backend = functools.partial(SimNeaSNOMConnect, sample=SimSample(seed=2, drift=(0., 0.)), speed=500)
+    scan = Scan(sim_config(str(tmp_path)), backend=backend)
+    thread = threading.Thread(target=scan.full_scan, args=(1,))
+    thread.start()
+    while scan.journal is None:
+        thread.join(0.05)
+    thread.join(0.5)
+    #as the GUI does it: only abort() from the other thread, the scan thread closes the scan
+    scan.abort()
+    thread.join(30)
+    assert not thread.is_alive()
+    scan.__exit__('abort', None, None)
+    assert scan.aborted
+    assert 'done' not in [r['event'] for r in events(journal_path(scan.hdf5_path))]
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from Leveling import fit_background, level_plane, level_lines
+from Find_Bact import FindBacteria
+
+PARAMS = {'length': [1.8, 5], 'width': [0.5, 1.3], 'height': [0.3, 0.6], 'corona': 0.5, 'climit': 0.2}
+
+def readme_plane_correction(raw):
+    #reference implementation from the README (full design matrix)
+    null_val = np.nanmean(raw)
+    raw[np.isnan(raw)] = null_val
+    m = raw.shape
+    X1, X2 = np.mgrid[:m[0], :m[1]]
+    X = np.hstack((np.reshape(X1, (m[0]*m[1], 1)), np.reshape(X2, (m[0]*m[1], 1))))
+    X = np.hstack((np.ones((m[0]*m[1], 1)), X))
+    YY = np.reshape(raw, (m[0]*m[1], 1))
+    theta = np.dot(np.dot(np.linalg.pinv(np.dot(X.transpose(), X)), X.transpose()), YY)
+    plane = np.reshape(np.dot(X, theta), m)
+    return (raw - plane)
+
+def surface(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    (y, x) = np.mgrid[:shape[0], :shape[1]]
+    return 1e-7 * (3 + 0.02 * x - 0.05 * y) + 1e-8 * rng.normal(size=shape)
+
+@pytest.mark.parametrize('shape', [(64, 64), (50, 81), (1, 30), (30, 1)])
+def test_plane_correction_matches_readme(shape):
+    data = surface(shape)
+    data[min(3, shape[0] - 1), min(4, shape[1] - 1)] = np.nan
+    f = FindBacteria(PARAMS, 0.1)
+    np.testing.assert_allclose(f.plane_correction(data.copy()), readme_plane_correction(data.copy()), rtol=0, atol=1e-15)
+
+def test_higher_order_removes_polynomial():
+    (y, x) = np.mgrid[:40, :60]
+    data = 1 + 0.1 * x - 0.2 * y + 0.003 * x * y - 0.001 * x**2 + 0.002 * y**2
+    np.testing.assert_allclose(level_plane(data, order=2), 0, atol=1e-9)
+
+def test_mask_and_nan_are_left_out_of_the_fit():
+    (y, x) = np.mgrid[:40, :60]
+    plane = 2 + 0.5 * x - 0.25 * y
+    data = plane.copy()
+    mask = np.zeros(data.shape, bool)
+    mask[10:20, 15:30] = True
+    data[mask] += 100
+    data[5, 5] = np.nan
+    np.testing.assert_allclose(fit_background(data, 1, mask), plane, atol=1e-9)
+
+def readme_stripe_correction(data):
+    #reference implementation from the README, row 0 is compared with the last row
+    data = data.copy()
+    for x in range(len(data)):
+        data[x] = data[x] - np.median(data[x] - data[x-1])
+    return data
+
+def striped(shape, seed=1):
+    rng = np.random.default_rng(seed)
+    return surface(shape, seed) + 1e-7 * rng.normal(size=(shape[0], 1))
+
+@pytest.mark.parametrize('shape', [(64, 64), (33, 80), (2, 10)])
+def test_stripe_correction_matches_readme(shape):
+    data = striped(shape)
+    np.testing.assert_allclose(level_lines(data, 'diff'), readme_stripe_correction(data), rtol=0, atol=1e-15)
+
+def test_stripe_correction_default_mode():
+    data = striped((40, 50))
+    f = FindBacteria(PARAMS, 0.1)
+    np.testing.assert_allclose(f.stripe_correction(data), readme_stripe_correction(data), rtol=0, atol=1e-15)
+
+def test_poly_mode_matches_row_polyfit():
+    rng = np.random.default_rng(2)
+    data = rng.normal(size=(20, 40))
+    mask = np.zeros(data.shape, bool)
+    mask[5:9, 10:20] = True
+    t = np.linspace(-1, 1, data.shape[1])
+    expected = data.copy()
+    for r in range(len(data)):
+        keep = ~mask[r]
+        expected[r] -= np.polyval(np.polyfit(t[keep], data[r, keep], 2), t)
+    np.testing.assert_allclose(level_lines(data, 'poly', order=2, mask=mask), expected, atol=1e-10)
+
+def test_median_mode_ignores_masked_pixels():
+    data = np.tile(np.arange(10.)[:, None], (1, 9))
+    mask = np.zeros(data.shape, bool)
+    mask[:, :4] = True
+    data[mask] = 1000
+    leveled = level_lines(data, 'median', mask=mask)
+    np.testing.assert_allclose(leveled[~mask], 0)
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        level_lines(np.zeros((3, 3)), 'spline')
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+from OverviewStore import export_csv, load_info, load_overview, save_overview
+
+def channels():
+    z = np.random.default_rng(0).normal(size=(5, 7))
+    return {'Z': z, 'R-Z': z[::-1].copy()}
+
+def test_npy_round_trip(tmp_path):
+    path = str(tmp_path / 'scan_NPY')
+    data = channels()
+    info = {'AFM': {'dx': 15., 'px': 151.}, 'Characteristics': {'length': [1.8, 5.]}}
+    save_overview(path, data, info)
+    loaded = load_overview(path)
+    assert set(loaded) == {'Z', 'R-Z'}
+    for k in data:
+        assert isinstance(loaded[k], np.memmap)
+        np.testing.assert_array_equal(loaded[k], data[k])
+    assert load_info(path) == info
+    #copy-on-write: changes stay in memory
+    loaded['Z'][:] = 0
+    np.testing.assert_array_equal(np.load(os.path.join(path, 'Z.npy')), data['Z'])
+
+def test_csv_and_npy(tmp_path):
+    path = str(tmp_path / 'scan_CSV')
+    data = channels()
+    export_csv(path, data).join()
+    loaded = load_overview(path)
+    np.testing.assert_allclose(loaded['Z'], data['Z'])
+    assert not isinstance(loaded['Z'], np.memmap)
+    assert load_info(path) == {}
+    #the .npy file is taken where there are both
+    save_overview(path, {'Z': data['Z'] + 1})
+    loaded = load_overview(path)
+    assert isinstance(loaded['Z'], np.memmap)
+    np.testing.assert_array_equal(loaded['Z'], data['Z'] + 1)
+    np.testing.assert_allclose(loaded['R-Z'], data['R-Z'])
+
+def test_from_hdf5(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    path = str(tmp_path / 'scan.hdf5')
+    data = channels()
+    with h5py.File(path, 'w') as hdf:
+        for k, v in data.items():
+            hdf['Data/AFM/' + k] = v
+    loaded = load_overview(path)
+    np.testing.assert_array_equal(loaded['R-Z'], data['R-Z'])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from PathPlanner import distance_matrix, nearest_neighbour, path_length, plan_measurement, plan_order, two_opt
+
+def test_points_on_a_line_are_visited_in_order():
+    rng = np.random.default_rng(0)
+    x = rng.permutation(10).astype(float)
+    points = np.column_stack((x, np.zeros(10)))
+    order = plan_order(points, start=(-1., 0.))
+    assert list(x[order]) == list(range(10))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_two_opt_is_a_permutation_and_not_longer(seed):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 100, (25, 2))
+    dist = distance_matrix(points, (50., 50.))
+    start = nearest_neighbour(dist)
+    path = two_opt(dist, start)
+    assert path[0] == 0 and path[-1] == len(dist) - 1
+    assert sorted(path[1:-1]) == list(range(1, len(points) + 1))
+    assert dist[path[:-1], path[1:]].sum() <= dist[start[:-1], start[1:]].sum() + 1e-9
+    order = plan_order(points, (50., 50.))
+    assert path_length(points, order, (50., 50.)) == pytest.approx(dist[path[:-1], path[1:]].sum())
+
+def test_small_inputs():
+    assert plan_order([]) == []
+    assert plan_order([(1., 2.)]) == [0]
+
+def test_plan_measurement_keeps_the_detection_names():
+    rng = np.random.default_rng(3)
+    bacteria = {}
+    for i in range(8):
+        center = rng.uniform(0, 100, 2)
+        bacteria['Bacteria{}'.format(i + 1)] = {'Points': {
+            'Center': {'Coord': tuple(center)}, 'Top': {'Coord': tuple(center + 1)},
+            'Bot': {'Coord': tuple(center - 1)}, 'Reference': {'Coord': tuple(center + (3, 0))}}}
+    ordered, travel = plan_measurement(bacteria, (0., 0.))
+    assert sorted(ordered) == sorted('Bacteria{}'.format(i + 1) for i in range(8))
+    assert list(ordered) == travel['Order']
+    assert [ordered[k]['Visit'] for k in ordered] == list(range(8))
+    for bact in ordered.values():
+        assert sorted(bact['Points']) == ['Bot', 'Center', 'Reference', 'Top']
+        assert sorted(p['Visit'] for p in bact['Points'].values()) == [0, 1, 2, 3]
+    assert travel['Travel_Saved'] == pytest.approx(travel['Travel_Detection'] - travel['Travel_Planned'], abs=0.02)
+    assert travel['Travel_Planned'] <= travel['Travel_Detection']
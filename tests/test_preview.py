@@ -0,0 +1,137 @@
+import threading
+import numpy as np
+import pytest
+from Preview import ImagePreview, PlotPreview, TraceBuffer, colormap_lut, decimate, pgm, ppm
+
+class FakeImage:
+    def __init__(self):
+        self.puts = []
+
+    def put(self, data):
+        self.puts.append(data)
+
+class FakeMaster:
+    #collects the after() calls, run() plays the Tk thread
+    def __init__(self):
+        self.calls = []
+        self.exists = True
+
+    def winfo_exists(self):
+        return self.exists
+
+    def after(self, ms, func, *args):
+        self.calls.append((func, args))
+
+    def run(self):
+        (calls, self.calls) = (self.calls, [])
+        for func, args in calls:
+            func(*args)
+
+def test_pgm():
+    gray = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    assert pgm(gray) == b'P5 3 2 255\n' + bytes(range(6))
+
+def test_ppm():
+    rgb = np.arange(2 * 3 * 3, dtype=np.uint8).reshape(2, 3, 3)
+    assert ppm(rgb) == b'P6 3 2 255\n' + bytes(range(18))
+    #not contiguous and not uint8
+    view = np.arange(2 * 6 * 3).reshape(2, 6, 3)[:, ::2]
+    assert ppm(view) == b'P6 3 2 255\n' + view.astype(np.uint8).tobytes()
+
+def test_colormap_lut():
+    assert colormap_lut('gray') is None
+    assert colormap_lut('') is None
+    assert colormap_lut('no_such_map') is None
+    lut = colormap_lut('viridis')
+    assert lut.shape == (256, 3) and lut.dtype == np.uint8
+    assert not np.array_equal(lut[0], lut[255])
+
+def test_decimate_keeps_min_and_max():
+    y = np.sin(np.linspace(0, 20, 10000))
+    (x, yd) = decimate(y, 100)
+    assert len(yd) <= 200
+    assert yd.max() == y.max() and yd.min() == y.min()
+    (x, yd) = decimate(y[:50], 100)
+    np.testing.assert_array_equal(yd, y[:50])
+
+def test_image_preview_puts_in_the_tk_thread_only():
+    (image, master) = (FakeImage(), FakeMaster())
+    preview = ImagePreview(image, master)
+    worker = threading.Thread(target=lambda: [preview.show(np.full((4, 4), i)) for i in range(5)])
+    worker.start()
+    worker.join()
+    assert image.puts == []
+    master.run()
+    #only the newest frame is put
+    assert image.puts == [pgm(np.full((4, 4), 4, np.uint8))]
+    master.run()
+    assert len(image.puts) == 1
+    #the loop keeps running
+    assert len(master.calls) == 1
+
+def test_image_preview_skips_unchanged_frames():
+    (image, master) = (FakeImage(), FakeMaster())
+    preview = ImagePreview(image, master)
+    frame = np.arange(16).reshape(4, 4)
+    assert preview.show(frame)
+    assert not preview.show(frame.copy())
+    assert preview.show(frame[:2])
+    assert preview.show(frame + 1)
+
+def test_image_preview_with_colormap():
+    (image, master) = (FakeImage(), FakeMaster())
+    lut = colormap_lut('viridis')
+    preview = ImagePreview(image, master, lut)
+    frame = np.array([[0, 255]], np.uint8)
+    preview.show(frame)
+    master.run()
+    assert image.puts == [ppm(lut[frame])]
+    #RGB frames are passed as they are
+    rgb = np.zeros((2, 2, 3), np.uint8)
+    preview.show(rgb)
+    master.run()
+    assert image.puts[-1] == ppm(rgb)
+
+def test_plot_preview_draws_the_newest_data_in_the_tk_thread():
+    (image, master) = (FakeImage(), FakeMaster())
+    preview = PlotPreview(image, master, size=(100, 80))
+    for i in range(3):
+        preview.post(np.sin(np.linspace(0, i + 1, 50)))
+    assert image.puts == [] and preview.skipped == 2
+    master.run()
+    assert len(image.puts) == 1 and image.puts[0].startswith(b'P6 100 80 255\n')
+    master.run()
+    assert len(image.puts) == 1
+
+def test_loops_end_with_the_window():
+    (image, master) = (FakeImage(), FakeMaster())
+    previews = [ImagePreview(image, master), PlotPreview(image, master, size=(100, 80))]
+    previews[0].show(np.zeros((2, 2)))
+    previews[1].post(np.zeros(10))
+    master.exists = False
+    master.run()
+    assert image.puts == [] and master.calls == []
+
+def test_trace_buffer_is_filled_in_place():
+    trace = TraceBuffer()
+    assert trace.take() is None
+    data = np.full((3, 8), np.nan)
+    data[:2] = [np.arange(8), np.arange(8) + 10]
+    trace.put(data)
+    buf = trace.data
+    rows = trace.take()
+    #the running pass and the one before, a copy
+    np.testing.assert_array_equal(rows, data[:2])
+    assert not np.shares_memory(rows, buf)
+    assert trace.take() is None
+    data[2] = 20
+    trace.put(data)
+    assert trace.data is buf
+    np.testing.assert_array_equal(trace.take(), data[1:])
+    #the caller may reuse its array right away
+    data[:] = 0
+    assert buf[2, 0] == 20
+    #a new shape gets a new buffer
+    trace.put(np.zeros(5))
+    assert trace.data is not buf
+    np.testing.assert_array_equal(trace.take(), [np.zeros(5)])
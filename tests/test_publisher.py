@@ -0,0 +1,59 @@
+import threading
+import time
+from NeaSNOMConnect import Publisher
+
+def test_coalescing():
+    release = threading.Event()
+    got = []
+    def slow(value):
+        got.append(value)
+        release.wait(5)
+    publisher = Publisher({'Cur_Data': [slow]}, {})
+    publisher.post('Cur_Data', 1)
+    #the first value is being delivered, the later ones replace each other
+    deadline = time.perf_counter() + 5
+    while not got and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    for value in (2, 3, 4):
+        publisher.post('Cur_Data', value)
+    release.set()
+    publisher.flush()
+    publisher.stop()
+    assert got == [1, 4]
+    assert publisher.dropped == {'Cur_Data': 2}
+    assert publisher.latency['Cur_Data'].count == 2
+
+def test_flush_ignores_the_interval():
+    got = []
+    publisher = Publisher({'Progress': [got.append], 'Fourier': []}, {'Progress': 10.})
+    publisher.post('Progress', 0.1)
+    publisher.flush()
+    assert got == [0.1]
+    #not due for 10 s
+    assert not publisher.wants('Progress')
+    publisher.post('Progress', 0.2)
+    time.sleep(0.05)
+    assert got == [0.1]
+    publisher.flush()
+    assert got == [0.1, 0.2]
+    publisher.stop()
+
+def test_nothing_without_observers():
+    publisher = Publisher({'Fourier': []}, {})
+    assert not publisher.wants('Fourier')
+    publisher.post('Fourier', [1, 2])
+    assert publisher._thread is None
+    publisher.flush()
+    publisher.stop()
+
+def test_failing_callback(capsys):
+    got = []
+    def fail(value):
+        raise ValueError(value)
+    publisher = Publisher({'Progress': [fail], 'Cur_Data': [got.append]}, {})
+    publisher.post('Progress', 1)
+    publisher.post('Cur_Data', 2)
+    publisher.flush()
+    publisher.stop()
+    assert got == [2]
+    assert 'Progress callback failed' in capsys.readouterr().out
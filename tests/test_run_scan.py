@@ -0,0 +1,26 @@
+import glob
+import os
+import subprocess
+import sys
+import pytest
+from ConfigHandler import ConfigHandler
+from test_journal import events, sim_config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_scan_with_the_simulation(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    config = str(tmp_path / 'scan.ini')
+    ConfigHandler().write_config(config, sim_config(''))
+    dest = tmp_path / 'out'
+    dest.mkdir()
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'RunScan.py'), 'scan', '--sim', '--speed', '5000',
+                             '--seed', '2', '--no-epics', '--config', config, '--dest', str(dest), '--iterations', '1'],
+                            cwd=str(tmp_path), capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Done: 1 iterations' in result.stdout
+    (path,) = glob.glob(str(dest / '*.hdf5'))
+    assert events(os.path.splitext(path)[0] + '.journal')[-1]['event'] == 'done'
+    with h5py.File(path, 'r') as hdf:
+        assert hdf['Data/AFM/Z'].shape == (151, 151)
+        assert 'Info' in hdf
@@ -0,0 +1,37 @@
+import numpy as np
+from SimNeaSNOM import SimSample
+
+def one_bacterium(pos):
+    sample = SimSample(bacteria=1, drift=(0., 0.), tilt=(0., 0.), stripes=0., noise=0., seed=0)
+    sample.pos[:] = pos
+    return sample
+
+def peak(image):
+    (i, j) = np.unravel_index(np.argmax(image), image.shape)
+    return j, i
+
+def test_afm_image_geometry():
+    #pixel (row i, col j) at x0 - dx/2 + j*dx/px, y0 - dy/2 + i*dy/py
+    sample = one_bacterium((52., 47.))
+    (forward, backward) = sample.afm_image(50., 50., 10., 10., 100, 100, 0.)
+    assert forward.shape == (100, 100)
+    for image in (forward, backward):
+        (j, i) = peak(image)
+        assert abs(j - 70) <= 2 and abs(i - 20) <= 2
+    assert 0.3 * 10**(-6) <= forward.max() <= 0.6 * 10**(-6)
+
+def test_rotated_scan():
+    sample = one_bacterium((52., 50.))
+    #rotated by 90 degrees the scan columns run along y
+    (forward, backward) = sample.afm_image(50., 50., 10., 10., 100, 100, 90.)
+    (j, i) = peak(forward)
+    assert abs(j - 50) <= 2 and abs(i - 30) <= 2
+
+def test_drift_moves_the_sample():
+    sample = one_bacterium((50., 50.))
+    sample.drift = np.array([1., 0.])
+    (before, _) = sample.afm_image(50., 50., 10., 10., 100, 100, 0.)
+    sample._t0 -= 2.
+    (after, _) = sample.afm_image(50., 50., 10., 10., 100, 100, 0.)
+    #2 um in x after 2 s
+    assert abs((peak(after)[0] - peak(before)[0]) - 20) <= 2